@@ -0,0 +1,475 @@
+import os
+import json
+import errno
+import hashlib
+import time
+import struct
+import shutil
+import datetime
+import logging
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from report_file import read_report_entries, trim_partial_line
+try:
+    import fcntl
+except ImportError:
+    # no reflinks on Windows
+    fcntl = None
+
+# The ioctl that makes a file share the blocks of another on btrfs and XFS
+FICLONE = 0x40049409
+# The ioctl that maps a file's extents to where they are on disk, and the structures it takes
+FS_IOC_FIEMAP = 0xC020660B
+fiemap_header = struct.Struct('=QQIIII')
+fiemap_extent = struct.Struct('=QQQQQIIII')
+# The kernel copies a file this much at a time
+copy_chunk_size = 64 * 1024 * 1024
+# Files are read this much at a time to verify them
+verify_block_size = 8 * 1024 * 1024
+# The errors that mean a way of copying isn't possible between two files, rather than that
+# something went wrong, so the next way should be tried
+unsupported_errors = {errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP, errno.ENOTSUP,
+                      errno.ENOTTY, errno.EINVAL, errno.ENOSYS, errno.EBADF}
+
+def copy_file_range_all(src, dst, size):
+    # copy_file_range lets the kernel copy the data itself, or the server for a file on a NAS
+    # mounted over NFS 4.2 or SMB, and shares blocks where the filesystem can. Returns the
+    # number of bytes copied.
+    offset = 0
+    while offset < size:
+        copied = os.copy_file_range(src, dst, min(copy_chunk_size, size - offset), offset, offset)
+        if copied == 0:
+            break
+        offset += copied
+    return offset
+
+def sendfile_all(src, dst, size):
+    # sendfile at least keeps the data in the kernel. Returns the number of bytes sent.
+    offset = 0
+    while offset < size:
+        sent = os.sendfile(dst, src, offset, min(copy_chunk_size, size - offset))
+        if sent == 0:
+            break
+        offset += sent
+    return offset
+
+def kernel_copy(source, destination):
+    # Copy a file's contents without passing them through Python, using the best way the
+    # kernel supports between the two files, and reading and writing it ourselves if none do.
+    # Returns the number of bytes copied, and raises an error if that falls short of the size
+    # of the source.
+    methods = [method for name, method in (('copy_file_range', copy_file_range_all), ('sendfile', sendfile_all))
+               if hasattr(os, name)]
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        size = os.fstat(src.fileno()).st_size
+        for method in methods:
+            try:
+                copied = method(src.fileno(), dst.fileno(), size)
+            except OSError as e:
+                if e.errno not in unsupported_errors:
+                    raise
+                logging.debug("kernel_copy - %s not possible for %s - %s", method.__name__, destination, e)
+                # start again from scratch with the next way
+                dst.seek(0)
+                dst.truncate()
+                continue
+            if copied == 0 and size > 0:
+                # some filesystems say nothing was copied rather than that they can't, just as
+                # shutil finds
+                logging.debug("kernel_copy - %s copied nothing for %s", method.__name__, destination)
+                continue
+            return check_copied(destination, copied, size)
+        shutil.copyfileobj(src, dst, copy_chunk_size)
+        return check_copied(destination, dst.tell(), size)
+
+def check_copied(destination, copied, size):
+    if copied < size:
+        raise OSError(errno.EIO, "copied {} of {} bytes".format(copied, size), destination)
+    return copied
+
+def checksum(filename):
+    # sha256 of a whole file, the same as the content hash a scan with dedupe records
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(verify_block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def compare_files(source, destination, source_checksum=None):
+    # Compare a destination with its source, returning (result, destination checksum) where
+    # result is identical, different or truncated. When the sizes differ that's all we need
+    # to know, so neither file is read. Otherwise both are checksummed at the same time, the
+    # destination on a thread of its own, unless we already know the source's checksum.
+    source_size = os.path.getsize(source)
+    destination_size = os.path.getsize(destination)
+    if destination_size < source_size:
+        return 'truncated', None
+    if destination_size > source_size:
+        return 'different', None
+    if source_checksum is None:
+        with ThreadPoolExecutor(max_workers=1) as reader:
+            destination_future = reader.submit(checksum, destination)
+            source_checksum = checksum(source)
+            destination_checksum = destination_future.result()
+    else:
+        destination_checksum = checksum(destination)
+    return ('identical' if destination_checksum == source_checksum else 'different'), destination_checksum
+
+def physical_offset(filename):
+    # Where the first extent of a file is on disk, or None if the filesystem won't say or the
+    # file has no data
+    if fcntl is None:
+        return None
+    request = bytearray(fiemap_header.pack(0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) + bytes(fiemap_extent.size))
+    try:
+        with open(filename, 'rb') as f:
+            fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, request)
+    except OSError:
+        return None
+    if fiemap_header.unpack_from(request)[3] == 0:
+        return None
+    return fiemap_extent.unpack_from(request, fiemap_header.size)[1]
+
+def source_location(filename):
+    # A sort key for roughly where a file is on its disk - the physical offset of its first
+    # extent where the filesystem tells us, otherwise its inode number, as filesystems tend
+    # to allocate inodes and data together. Files we can't find sort first, and fail fast.
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return (0, 0, 0)
+    offset = physical_offset(filename)
+    if offset is None:
+        return (stat.st_dev, 1, stat.st_ino)
+    return (stat.st_dev, 0, offset)
+
+def reflink(source, destination):
+    # make destination a copy of source that shares its blocks until either is changed
+    if fcntl is None:
+        raise OSError(errno.ENOTSUP, "reflinks are not supported on this platform")
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+def timestamp_of(preferred_ts):
+    # the preferred timestamp as seconds since the epoch, whether it's a datetime or has been
+    # through a json report and come back as a string
+    if preferred_ts is None:
+        return None
+    if isinstance(preferred_ts, str):
+        preferred_ts = datetime.datetime.fromisoformat(preferred_ts)
+    return preferred_ts.timestamp()
+
+class Copy_Engine:
+    '''
+        Class which copies files to their destinations several at a time, which keeps a slow
+        link to a NAS busy where copying one file at a time leaves it idle between files.
+        Files can be copied, or when the output is on the same filesystem as the input,
+        hardlinked or reflinked, which only takes a metadata update and no more disk space.
+        Whether a file can be linked is found out by trying, and a copy is made if it can't.
+        Files with the same contents as another can be linked to the other's copy instead,
+        with a hardlink or a relative symlink, or left out altogether.
+        Files are copied in the order they're given, or sorted by where they are on the source
+        disk, so a hard disk reads them with as little seeking as it can, or by destination
+        folder and then by where they are, so each folder is written in one go. Sorted files
+        are copied one at a time, as several at once would have the disk seeking between them
+        again. The rate of copying is logged at the end, to compare the orders by.
+        If given a manifest to write to, every copy is checksummed against its source before
+        it's put in place, and a destination that's already there is checked against its
+        source rather than assumed to be the same, with the results written to the manifest.
+        Every copy that completes is written to a journal, one json line per file, so a run
+        that is interrupted can be started again and skip the files already done without
+        looking at them, or at their destinations, again. Files are copied to a temporary name
+        and renamed into place, so a half copied file is never mistaken for a finished one.
+    '''
+    def __init__(self, journal_filename, workers=4, mode='copy', duplicates='copy', order='report',
+                 manifest_filename=None):
+        self.journal_filename = journal_filename
+        self.manifest_filename = manifest_filename
+        self.manifest_fh = None
+        # checksums of the sources we already know, from a scan with dedupe
+        self.content_hashes = {}
+        # several copies at once would undo a sorted order by reading files side by side
+        self.workers = workers if order == 'report' else 1
+        if self.workers < workers:
+            logging.info("Copy_Engine : __init__ - copying one file at a time, in %s order", order)
+        self.mode = mode
+        self.duplicates = duplicates
+        self.order = order
+        self.journal_fh = None
+        # (source, destination) pairs already copied, or found already there, on an earlier run,
+        # and whether each was verified
+        self.done = {}
+        # destinations claimed by a copy during this run, so two sources can't race for one
+        self.claimed = set()
+        # the source and status of each destination we know holds a file, on this run or an
+        # earlier one, and whether it was verified
+        self.placed = {}
+        # folders we know exist, so makedirs isn't called for every file
+        self.made_folders = set()
+        self.counts = collections.Counter()
+        self.bytes_copied = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        # read the journal of an earlier run, cutting off any line it was part way through
+        # writing when it stopped, and carry on appending to it
+        if os.path.isfile(self.journal_filename):
+            for entry in read_report_entries(self.journal_filename):
+                self.done[(entry['source'], entry['destination'])] = entry.get('verified', False)
+                self.placed[entry['destination']] = (entry['source'], entry.get('status'), entry.get('verified', False))
+            logging.info("Copy_Engine : open - %d files already done in journal %s", len(self.done), self.journal_filename)
+            trim_partial_line(self.journal_filename)
+        self.journal_fh = open(self.journal_filename, 'a')
+        if self.manifest_filename:
+            if os.path.isfile(self.manifest_filename):
+                trim_partial_line(self.manifest_filename)
+            self.manifest_fh = open(self.manifest_filename, 'a')
+
+    def close(self):
+        if self.journal_fh:
+            self.journal_fh.close()
+            self.journal_fh = None
+        if self.manifest_fh:
+            self.manifest_fh.close()
+            self.manifest_fh = None
+
+    def verify(self, source, destination, copy=None):
+        # Check a destination, or the copy about to become it, against its source and note the
+        # result in the manifest. Runs in the worker threads, so the manifest is written under
+        # the lock.
+        result, destination_checksum = compare_files(source, copy or destination, self.content_hashes.get(source))
+        with self.lock:
+            self.manifest_fh.write(json.dumps({'source': source, 'destination': destination, 'result': result,
+                                               'checksum': destination_checksum}) + '\n')
+            self.manifest_fh.flush()
+        return result
+
+    def make_folder(self, folder):
+        # Several threads may make the same folder at once, which makedirs copes with, so the
+        # set of folders made only saves calls and doesn't need a lock
+        if folder not in self.made_folders:
+            os.makedirs(folder, exist_ok=True)
+            self.made_folders.add(folder)
+
+    def check_existing(self, source, destination):
+        # The status of a destination that is there already. With a manifest it is checked
+        # against the source, and only one known to be the same is done with.
+        if self.manifest_fh:
+            result = self.verify(source, destination)
+            logging.warning("Copy_Engine : check_existing - destination file %s exists, %s", destination, result)
+            return 'exists' if result == 'identical' else result
+        logging.warning("Copy_Engine : check_existing - destination file %s exists", destination)
+        return 'exists'
+
+    def copy_file(self, source, destination, preferred_ts=None):
+        # Copy one file, run in a worker thread. Returns (status, source, destination).
+        try:
+            if not os.path.isfile(source):
+                logging.warning("Copy_Engine : copy_file - source file %s has gone", source)
+                return 'missing', source, destination
+            if os.path.isfile(destination):
+                # - if the destination file exists and is different, rename it to a numbered backup
+                return self.check_existing(source, destination), source, destination
+            logging.info("Copy_Engine : copy_file - copying %s to %s", source, destination)
+            self.make_folder(os.path.dirname(destination))
+            partial = destination + '.partial'
+            status = self.place_file(source, partial)
+            # Update the file modification timestamp - but not of a hardlink, as that would
+            # change the timestamp of the source file too
+            timestamp = timestamp_of(preferred_ts)
+            if timestamp is not None and status != 'hardlinked':
+                os.utime(partial, (timestamp, timestamp))
+            if self.manifest_fh and status == 'copied' and self.verify(source, destination, partial) != 'identical':
+                logging.error("Copy_Engine : copy_file - copy of %s doesn't match it, removing it", source)
+                os.remove(partial)
+                return 'mismatch', source, destination
+            os.replace(partial, destination)
+            return status, source, destination
+        except (OSError, ValueError) as e:
+            logging.error("Copy_Engine : copy_file - can't copy %s to %s - %s", source, destination, e)
+            return 'failed', source, destination
+
+    def place_file(self, source, destination):
+        # Put a copy of source at destination, the way the mode asks for if that's possible
+        # between the two, and return how it was done
+        if self.mode == 'hardlink':
+            try:
+                if os.path.lexists(destination):
+                    # left over from an interrupted run
+                    os.remove(destination)
+                os.link(source, destination)
+                return 'hardlinked'
+            except OSError as e:
+                if e.errno not in unsupported_errors:
+                    raise
+                logging.debug("Copy_Engine : place_file - can't hardlink %s, copying - %s", source, e)
+        elif self.mode == 'reflink':
+            try:
+                reflink(source, destination)
+                shutil.copymode(source, destination)
+                return 'reflinked'
+            except OSError as e:
+                if e.errno not in unsupported_errors:
+                    raise
+                logging.debug("Copy_Engine : place_file - can't reflink %s, copying - %s", source, e)
+        size = kernel_copy(source, destination)
+        shutil.copymode(source, destination)
+        with self.lock:
+            self.bytes_copied += size
+        return 'copied'
+
+    def holds_copy_of(self, destination, source):
+        # Whether a destination is known to hold the contents of a source - because it was that
+        # source that was put there, or one with the same content hash. A file that was already
+        # there, and not checked, might be anything.
+        placed_source, status, verified = self.placed.get(destination, (None, None, False))
+        if placed_source is None or (status == 'exists' and not verified):
+            return False
+        if placed_source == source:
+            return True
+        content_hash = self.content_hashes.get(source)
+        return content_hash is not None and self.content_hashes.get(placed_source) == content_hash
+
+    def link_file(self, source, destination, preferred_ts, original, original_destination):
+        # Link a file to the copy already made of another file with the same contents, run in a
+        # worker thread. Returns (status, source, destination) as copy_file does.
+        if self.duplicates == 'copy' or not self.holds_copy_of(original_destination, original):
+            # the copy it was to share failed, or another file went there instead, so it needs
+            # one of its own
+            return self.copy_file(source, destination, preferred_ts)
+        if self.duplicates == 'skip':
+            logging.debug("Copy_Engine : link_file - skipping %s, a copy of %s", source, original)
+            return 'skipped', source, destination
+        try:
+            if os.path.lexists(destination):
+                return self.check_existing(source, destination), source, destination
+            logging.info("Copy_Engine : link_file - linking %s to %s", destination, original_destination)
+            self.make_folder(os.path.dirname(destination))
+            partial = destination + '.partial'
+            if os.path.lexists(partial):
+                os.remove(partial)
+            if self.duplicates == 'symlink':
+                os.symlink(os.path.relpath(original_destination, os.path.dirname(destination)), partial)
+                status = 'symlinked'
+            else:
+                os.link(original_destination, partial)
+                status = 'hardlinked'
+            os.replace(partial, destination)
+            return status, source, destination
+        except OSError as e:
+            if e.errno not in unsupported_errors:
+                logging.error("Copy_Engine : link_file - can't link %s to %s - %s", destination, original_destination, e)
+                return 'failed', source, destination
+            logging.debug("Copy_Engine : link_file - can't link %s, copying - %s", destination, e)
+        return self.copy_file(source, destination, preferred_ts)
+
+    def record(self, result):
+        # Note down a finished copy in the journal. Only the main thread writes to it.
+        status, source, destination = result
+        self.counts[status] += 1
+        if status in ('copied', 'hardlinked', 'reflinked', 'symlinked', 'exists'):
+            # with a manifest, copies and files already there have been checked against their
+            # sources, but links are not compared, so a later run with a manifest checks them
+            verified = self.manifest_fh is not None and status in ('copied', 'exists')
+            self.placed[destination] = (source, status, verified)
+            self.journal_fh.write(json.dumps({'source': source, 'destination': destination, 'status': status,
+                                              'verified': verified}) + '\n')
+            self.journal_fh.flush()
+
+    def copy_all(self, copies, content_hashes=None):
+        # Copy an iterable of (source, destination, preferred_ts), with the checksums of any
+        # sources we know them for to verify against
+        if content_hashes is not None:
+            self.content_hashes = content_hashes
+        return self.run((source, destination, self.copy_file, (preferred_ts,))
+                        for source, destination, preferred_ts in copies)
+
+    def link_all(self, links):
+        # Link an iterable of (source, destination, preferred_ts, original, original destination),
+        # where the original has been copied already by copy_all
+        return self.run((source, destination, self.link_file, (preferred_ts, original, original_destination))
+                        for source, destination, preferred_ts, original, original_destination in links
+                        if not self.already_there(source, destination, original, original_destination))
+
+    def already_there(self, source, destination, original, original_destination):
+        # Whether a duplicate's destination already holds its original, as it does when an album
+        # copy gets the same name and date as the original, in which case there's nothing to do
+        placed_source = self.placed.get(destination, (None,))[0]
+        if destination == original_destination or (placed_source not in (None, source) and
+                                                    self.holds_copy_of(destination, original)):
+            logging.debug("Copy_Engine : already_there - %s already holds %s, a copy of %s", destination, original,
+                          source)
+            self.counts['skipped'] += 1
+            return True
+        return False
+
+    def pending_jobs(self, jobs):
+        # Leave out the jobs done on an earlier run, without looking at their files. When we're
+        # verifying, anything done without being verified is run again, which checks what is
+        # at its destination.
+        for job in jobs:
+            key = (job[0], job[1])
+            if key in self.done and (self.done[key] or self.manifest_fh is None):
+                self.counts['done'] += 1
+            else:
+                yield job
+
+    def job_key(self, job):
+        source, destination = job[:2]
+        if self.order == 'destination':
+            return os.path.dirname(destination), source_location(source)
+        return source_location(source)
+
+    def order_jobs(self, jobs):
+        # Sort the jobs still to do into the order asked for. Anything other than the report
+        # order needs every job, and where its file is, in hand first.
+        jobs = self.pending_jobs(jobs)
+        if self.order == 'report':
+            return jobs
+        start = time.monotonic()
+        jobs = sorted(jobs, key=self.job_key)
+        logging.info("Copy_Engine : order_jobs - sorted %d files by %s in %.1fs", len(jobs), self.order,
+                     time.monotonic() - start)
+        return jobs
+
+    def run(self, jobs):
+        # Run an iterable of (source, destination, function, arguments) on a pool of threads.
+        # Only a limited number of jobs are queued at once, so the report can be streamed in.
+        jobs = self.order_jobs(jobs)
+        pool = ThreadPoolExecutor(max_workers=self.workers)
+        pending = collections.deque()
+        start = time.monotonic()
+        start_bytes = self.bytes_copied
+        try:
+            for source, destination, function, arguments in jobs:
+                if destination in self.claimed:
+                    logging.warning("Copy_Engine : run - destination file %s is also the destination of another file, skipping %s",
+                                    destination, source)
+                    self.counts['clash'] += 1
+                    continue
+                self.claimed.add(destination)
+                pending.append(pool.submit(function, source, destination, *arguments))
+                if len(pending) >= self.workers * 4:
+                    self.record(pending.popleft().result())
+            while pending:
+                self.record(pending.popleft().result())
+        finally:
+            # if we're stopped part way, the copies already under way are finished and recorded
+            pool.shutdown(cancel_futures=True)
+            for future in pending:
+                if not future.cancelled():
+                    self.record(future.result())
+            logging.info("Copy_Engine : run - %s", dict(self.counts))
+            elapsed = time.monotonic() - start
+            copied = self.bytes_copied - start_bytes
+            logging.info("Copy_Engine : run - %s order, %.1f MB in %.1fs, %.1f MB/s", self.order, copied / 1e6, elapsed,
+                         copied / 1e6 / elapsed if elapsed else 0)
+        return self.counts
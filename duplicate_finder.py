@@ -0,0 +1,67 @@
+import hashlib
+import logging
+
+# Files are compared a block at a time, and the partial hash looks at the first and last block
+block_size = 1024 * 1024
+
+def full_hash(filename):
+    # sha256 of the whole file, read in large blocks
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def partial_hash(filename, size):
+    # A cheap hash of just the first and last blocks of a file. Files that differ almost
+    # always differ here, so only files that match need a full hash.
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        h.update(f.read(block_size))
+        if size > 2 * block_size:
+            f.seek(size - block_size)
+        h.update(f.read(block_size))
+    return h.hexdigest()
+
+def group_by(filenames, key):
+    # Group filenames by key(filename), leaving out any we can't read
+    groups = {}
+    for filename in filenames:
+        try:
+            groups.setdefault(key(filename), []).append(filename)
+        except OSError as e:
+            logging.error("group_by - can't read %s - %s", filename, e)
+    return groups
+
+def find_duplicates(source_files):
+    # Given a list of (filename, stat) pairs, find the files with exactly the same contents.
+    # Files are grouped by size, then by a partial hash of their first and last blocks, and
+    # only files that still match are hashed in full. Returns a dictionary for every file that
+    # has at least one copy, holding its content hash and the first file (in the order given)
+    # with the same contents, or None if this is that first file.
+    by_size = {}
+    for filename, stat in source_files:
+        if stat is not None and stat.st_size > 0:
+            by_size.setdefault(stat.st_size, []).append(filename)
+
+    duplicates = {}
+    for size, filenames in by_size.items():
+        if len(filenames) < 2:
+            continue
+        if size <= 2 * block_size:
+            # the partial hash would read the whole file anyway
+            candidates = [filenames]
+        else:
+            candidates = [c for c in group_by(filenames, lambda f: partial_hash(f, size)).values() if len(c) > 1]
+        for candidate in candidates:
+            for content_hash, same in group_by(candidate, full_hash).items():
+                if len(same) < 2:
+                    continue
+                for filename in same:
+                    duplicates[filename] = {
+                        'content_hash': content_hash,
+                        'duplicate_of': same[0] if filename != same[0] else None
+                    }
+    logging.info("find_duplicates - %d files are copies of another file",
+                 len([d for d in duplicates.values() if d['duplicate_of']]))
+    return duplicates
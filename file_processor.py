@@ -1,14 +1,22 @@
-from PIL import Image
+from PIL import Image, ExifTags
 import imagehash
 import exiftool
 import logging
+import io
 import json
 import datetime
 import os
 import re
 import magic
+import threading
+from json_mapper import summarise_sidecar
+from hash_index import hash_distance
+from video_fingerprint import video_fingerprint
+from quicktime import read_quicktime_metadata
+from raw_preview import extract_preview
 
 ext_video = ['.3gp', '.avi', '.mov', '.m4v', '.mp4']
+ext_quicktime = ['.3gp', '.mov', '.m4v', '.mp4']
 ext_image_PIL = ['.jpg', '.jpeg', '.heic', '.bmp', '.tif', '.tiff', '.png', '.gif']
 ext_non_PIL = ['.nef', '.dng', '.psd', '.pef']
 ext_json = ['.json']
@@ -42,6 +50,13 @@ def is_exif(ext):
 def is_video(ext):
     return ext.lower() in ext_video
 
+def is_quicktime(ext):
+    return ext.lower() in ext_quicktime
+
+def is_read_natively(ext):
+    # files whose metadata we normally read ourselves rather than with exiftool
+    return is_quicktime(ext) or is_image_PIL(ext)
+
 def is_image(ext):
     return is_image_PIL(ext) or is_non_PIL(ext)
 
@@ -54,6 +69,158 @@ def is_non_PIL(ext):
 def is_json(ext):
     return ext.lower() in ext_json
 
+class Exif_Session:
+    '''
+        Class which owns a single long lived exiftool process for the duration of a run. Starting
+        exiftool means spinning up a perl interpreter, so doing it once per media file is very
+        slow. Media files can be prefetched in batches (e.g. a whole folder at a time) and the
+        results are handed back one file at a time by get_metadata. A lock makes sure only
+        one thread talks to exiftool at a time.
+    '''
+    batch_size = 250
+
+    def __init__(self):
+        self.et = None
+        self.prefetched = {}
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        if self.et is None:
+            self.et = exiftool.ExifToolHelper()
+
+    def stop(self):
+        with self.lock:
+            if self.et is not None:
+                self.et.terminate()
+                self.et = None
+            self.prefetched = {}
+
+    def prefetch(self, filenames):
+        # Read metadata for a list of files with as few exiftool calls as possible. If a batch
+        # fails (normally because one broken file makes exiftool return an error status) then
+        # fall back to reading the files in that batch one by one, so only the broken file loses
+        # its metadata. exiftool isn't started until there is something for it to read.
+        if not filenames:
+            return
+        with self.lock:
+            self.start()
+            for start in range(0, len(filenames), self.batch_size):
+                self.prefetch_batch(filenames[start:start + self.batch_size])
+
+    def prefetch_batch(self, batch):
+        try:
+            metadata = self.et.get_metadata(batch)
+        except exiftool.exceptions.ExifToolExecuteException as e:
+            logging.warning("Exif_Session : prefetch - batch of %d files failed, reading individually - %s", len(batch), e)
+            for filename in batch:
+                try:
+                    self.prefetched[filename] = self.et.get_metadata(filename)
+                except exiftool.exceptions.ExifToolExecuteException as e:
+                    # remember the error so it is reported against the right file later
+                    self.prefetched[filename] = e
+            return
+        self.store_batch(batch, metadata)
+
+    def store_batch(self, batch, metadata):
+        # exiftool returns one dictionary per file, tagged with the SourceFile it came from
+        metadata = metadata or []
+        by_source = {d['SourceFile']: d for d in metadata if 'SourceFile' in d}
+        if len(by_source) != len(metadata) and len(metadata) == len(batch):
+            # no usable SourceFile tags, but exiftool always answers in the order it was asked
+            by_source = dict(zip(batch, metadata))
+        for filename in batch:
+            self.prefetched[filename] = [by_source[filename]] if filename in by_source else []
+
+    def clear(self):
+        with self.lock:
+            self.prefetched = {}
+
+    def get_metadata(self, filename):
+        # Return the metadata for a single file, using the prefetched results if we have them
+        with self.lock:
+            if filename in self.prefetched:
+                metadata = self.prefetched.pop(filename)
+                if isinstance(metadata, Exception):
+                    raise metadata
+                return metadata
+            self.start()
+            return self.et.get_metadata(filename)
+
+# Perceptual hashes are 16x16 bits, which phash works out from a greyscale image 4 times that size
+hash_size = 16
+hash_image_size = hash_size * 4
+
+def reduce_for_hash(image, mode='L'):
+    # Decode no more of an image than the hash needs. JPEGs are decoded straight to greyscale at
+    # 1/2, 1/4 or 1/8 scale, and anything still large is shrunk with a cheap box filter. At least
+    # 8 times phash's own image size is kept in each direction, so its anti-aliased resize still
+    # does the real work and the hash comes out the same - any less and the odd bit flips.
+    target = hash_image_size * 8
+    image.draft(mode, (target, target))
+    image = image.convert(mode)
+    factor = min(image.size[0] // target, image.size[1] // target)
+    if factor > 1:
+        image = image.reduce(factor)
+    return image
+
+def open_image(image):
+    # images are opened from a file, or from the bytes of a preview embedded in another file
+    return Image.open(io.BytesIO(image) if isinstance(image, bytes) else image)
+
+def phash_file(source, fast=False):
+    # the file is closed as soon as the hash is done, rather than whenever PIL gets round to it
+    with open_image(source) as image:
+        if fast:
+            image = reduce_for_hash(image)
+        return compact_hash(imagehash.phash(image, hash_size=hash_size))
+
+def compact_hash(hash):
+    # Hashes are kept as the fixed width hex strings they are written to the report as, rather
+    # than as ImageHash objects which each carry a numpy array around with them
+    return str(hash) if hash is not None else None
+
+def image_hashes(image):
+    # Every kind of hash we keep, all worked out from the one decoded image. The greyscale
+    # version is made once and shared by the hashes that only need brightness.
+    grey = image.convert('L')
+    return {
+        'phash': compact_hash(imagehash.phash(grey, hash_size=hash_size)),
+        'dhash': compact_hash(imagehash.dhash(grey, hash_size=hash_size)),
+        'ahash': compact_hash(imagehash.average_hash(grey, hash_size=hash_size)),
+        'colorhash': compact_hash(imagehash.colorhash(image)),
+    }
+
+def choose_destination(results, output_folder):
+    # Choose a timestamp for a processed file and, from that, where it should go in the output
+    # folder. Kept apart from File_Processor so the results for a duplicate file can be finished
+    # off once the original's exif data is known.
+    # if we're in a folder that contains a year, use this as a bad fallback time for the media
+    if results['folder_year']:
+        year_hint_time = datetime.datetime(results['folder_year'], 1, 1, 0, 0, 0, 0)
+    else:
+        year_hint_time = None
+    # choose a timestamp for the photo using these methods in preference order
+    results['preferred_ts'] = (
+        results['exif']['datetime_exif'] or 
+        results['json']['datetime_json'] or
+        results['filename_time']['datetime_filename'] or
+        year_hint_time or
+        results['file']['datetime_filemodif'] or
+        datetime.datetime(1972,2,26,9,0,0,0)
+    )
+    logging.debug("File_Processor : choose_destination - results: %s preferred_ts %s", results, results['preferred_ts'])
+    # come up with a proposed new name for the file
+    results['destination'] = "{0}/{1:%Y}/{1:%Y}_{1:%m}/{1:%Y-%m-%d_%H%M%S}_{2}".format(
+        output_folder, results['preferred_ts'], os.path.basename(results['source']))
+    return results
+
 class File_Processor:
     '''
         Class which processes individual media files, extracts metadata from a number of sources
@@ -63,10 +230,23 @@ class File_Processor:
         Produces a hashmap of results for each file processed which can be later used to rename
         and update the metadata in the file itself.
     '''
-    def __init__(self, json_mapper, year, outfolder):
+    def __init__(self, json_mapper, year, outfolder, exif_session=None, sidecars=None, metadata_cache=None,
+                 duplicates=None, hash_mode='full', multi_hash=False, cached=None):
         self.json_mapper = json_mapper
         self.year_hint = year
         self.output_folder = outfolder
+        self.exif_session = exif_session
+        self.sidecars = sidecars or {}
+        self.metadata_cache = metadata_cache
+        self.duplicates = duplicates or {}
+        # 'full' hashes the whole image, 'fast' a reduced one, and 'validate' does both and
+        # warns when they differ
+        self.hash_mode = hash_mode
+        # if set, work out a phash, dhash, average hash and colour hash for each image, not just a phash
+        self.multi_hash = multi_hash
+        # metadata cache entries already looked up for files, None for a miss, used instead of
+        # looking them up again
+        self.cached = cached or {}
 
     def exif_gps_helper(self, d):
         '''
@@ -88,7 +268,89 @@ class File_Processor:
                 result['longitude'] = d['EXIF:GPSLongitude']
         return result
         
-    def get_exif_metadata(self):
+    def get_quicktime_metadata(self, source):
+        # Read a video's creation time and location straight from its movie header, which is
+        # much quicker than asking exiftool. Returns None if the file isn't a movie we can read.
+        try:
+            movie = read_quicktime_metadata(source)
+        except OSError as e:
+            logging.error("File_Processor : get_quicktime_metadata - %s from %s", e, source)
+            return None
+        if movie is None:
+            logging.info("File_Processor : get_quicktime_metadata - no movie header in %s, trying exiftool", source)
+            return None
+        logging.debug("File_Processor : get_quicktime_metadata - %s %s", source, movie)
+        return {
+            'datetime_exif': movie['creation_time'],
+            'geodata_exif': movie['geodata'] or {'latitude': None, 'longitude': None},
+            'model_exif': None
+        }
+
+    def get_pil_metadata(self, source):
+        # Read the exif data of an image PIL understands straight from its header, without
+        # decoding the image or asking exiftool. The tags we use are named as exiftool would
+        # name them, so they are summarised in exactly the same way. Returns None if PIL can't
+        # read the file.
+        try:
+            with Image.open(source) as image:
+                exif = image.getexif()
+                exif_ifd = exif.get_ifd(ExifTags.IFD.Exif)
+                gps_ifd = exif.get_ifd(ExifTags.IFD.GPSInfo)
+        except (OSError, SyntaxError, ValueError) as e:
+            logging.info("File_Processor : get_pil_metadata - PIL can't read %s, trying exiftool - %s", source, e)
+            return None
+        d = {}
+        datetime_original = exif_ifd.get(ExifTags.Base.DateTimeOriginal) or exif.get(ExifTags.Base.DateTimeOriginal)
+        if datetime_original:
+            d['EXIF:DateTimeOriginal'] = str(datetime_original)
+        if exif.get(ExifTags.Base.Model):
+            d['EXIF:Model'] = str(exif[ExifTags.Base.Model]).strip('\x00 ')
+        for name in ['GPSLatitude', 'GPSLongitude']:
+            value = gps_ifd.get(ExifTags.GPS[name])
+            ref = gps_ifd.get(ExifTags.GPS[name + 'Ref'])
+            try:
+                if value is not None:
+                    # degrees, minutes and seconds, which exiftool would give us as decimal degrees
+                    d['EXIF:' + name] = sum(float(v) / 60 ** i for i, v in enumerate(value))
+            except (TypeError, ZeroDivisionError):
+                logging.warning("File_Processor : get_pil_metadata - bad %s %s in %s", name, value, source)
+            if ref:
+                d['EXIF:' + name + 'Ref'] = str(ref).strip('\x00 ')
+        logging.debug("File_Processor : get_pil_metadata - %s", d)
+        return self.summarise_exif([d])
+
+    def get_media_metadata(self, source):
+        # Videos have their header read directly, and so do images that PIL understands, with
+        # exiftool for anything odd. Everything else goes to exiftool.
+        fileext = os.path.splitext(source)[1]
+        if is_quicktime(fileext):
+            metadata_quicktime = self.get_quicktime_metadata(source)
+            if metadata_quicktime:
+                return metadata_quicktime
+        elif is_image_PIL(fileext):
+            metadata_pil = self.get_pil_metadata(source)
+            if metadata_pil:
+                return metadata_pil
+        return self.get_exif_metadata(source)
+
+    def summarise_exif(self, metadata):
+        # pick out the exif data we use from a list of tag dictionaries, as exiftool returns them
+        metadata_exif = {
+            'datetime_exif': None,
+            'geodata_exif': None,
+            'model_exif': None
+        }
+        for d in metadata:
+            if 'EXIF:DateTimeOriginal' in d:
+                metadata_exif['datetime_exif'] = find_date(d['EXIF:DateTimeOriginal'])                    
+            elif 'QuickTime:CreateDate' in d:
+                metadata_exif['datetime_exif'] = find_date(d['QuickTime:CreateDate'])
+            metadata_exif['geodata_exif'] = self.exif_gps_helper(d)
+            if 'EXIF:Model' in d:
+                metadata_exif['model_exif'] = d['EXIF:Model']
+        return metadata_exif
+
+    def get_exif_metadata(self, source):
         metadata_exif = {
             'datetime_exif': None,
             'geodata_exif': None,
@@ -96,36 +358,36 @@ class File_Processor:
         }
         # Look for exif data already existing
         try:
-            with exiftool.ExifToolHelper() as et:
-                metadata = et.get_metadata(self.source_media_filename)
-                logging.debug("File_Processor : get_exif_metadata - %s", metadata)
-                if metadata:
-                    for d in metadata:
-                        if 'EXIF:DateTimeOriginal' in d:
-                            metadata_exif['datetime_exif'] = find_date(d['EXIF:DateTimeOriginal'])                    
-                        elif 'QuickTime:CreateDate' in d:
-                            metadata_exif['datetime_exif'] = find_date(d['QuickTime:CreateDate'])
-                        metadata_exif['geodata_exif'] = self.exif_gps_helper(d)
-                        if 'EXIF:Model' in d:
-                            metadata_exif['model_exif'] = d['EXIF:Model']
-                else:
-                    logging.warning("File_Processor : get_exif_metadata - No metadata for %s", self.source_media_filename)
-        except exiftool.exceptions.ExifToolExecuteError as e:
+            if self.exif_session:
+                # share the long running exiftool process, which may already have this file prefetched
+                metadata = self.exif_session.get_metadata(source)
+            else:
+                with exiftool.ExifToolHelper() as et:
+                    metadata = et.get_metadata(source)
+            logging.debug("File_Processor : get_exif_metadata - %s", metadata)
+            if metadata:
+                metadata_exif = self.summarise_exif(metadata)
+            else:
+                logging.warning("File_Processor : get_exif_metadata - No metadata for %s", source)
+        except exiftool.exceptions.ExifToolExecuteException as e:
             logging.error("File_Processor : get_exif_metadata - Error reading exif data for %s - %s",
-                          self.source_media_filename, e)
+                          source, e)
         return metadata_exif
 
-    def get_filename_metadata(self):
+    def get_filename_metadata(self, basename):
         # Look for datetime in filename itself
         return {
-            'datetime_filename': find_date(self.source_media_basename),
+            'datetime_filename': find_date(basename),
         }
 
-    def get_file_metadata(self):
-        # read modification timestamp from candidate
+    def get_file_metadata(self, source, stat=None):
+        # read modification timestamp from candidate, reusing the stat results from the folder
+        # listing if we have them
+        if stat is None:
+            stat = os.stat(source)
         return {
-            'datetime_filemodif': datetime.datetime.fromtimestamp(os.path.getmtime(self.source_media_filename)),
-            'file_size': os.path.getsize(self.source_media_filename)
+            'datetime_filemodif': datetime.datetime.fromtimestamp(stat.st_mtime),
+            'file_size': stat.st_size
         }
 
     def read_json_file(self, json_filename):
@@ -133,95 +395,176 @@ class File_Processor:
             d = json.load(f)
         return d
     
-    def get_json_metadata(self):
+    def get_json_metadata(self, source):
         # Look for a matching json file
         metadata_json = {
             'datetime_json': None,
             'geodata_json': None
         }
-        if self.source_media_basename in self.json_mapper:
-            json_filename = os.path.dirname(self.source_media_filename)+"/"+self.json_mapper[self.source_media_basename]
-            d = self.read_json_file(json_filename)
+        basename = os.path.basename(source)
+        if basename in self.json_mapper:
+            json_basename = self.json_mapper[basename]
+            json_filename = os.path.dirname(source)+"/"+json_basename
+            # the json mapper will normally have already read the sidecar for us
+            if json_basename in self.sidecars:
+                sidecar = self.sidecars[json_basename]
+            else:
+                sidecar = summarise_sidecar(self.read_json_file(json_filename))
             # do some sense checks on the json data
-            if 'photoTakenTime' in d:
-                datetime_ts_json = d['photoTakenTime']['timestamp']
-                metadata_json['datetime_json'] = datetime.datetime.fromtimestamp(int(datetime_ts_json))
+            if sidecar['timestamp'] is not None:
+                metadata_json['datetime_json'] = datetime.datetime.fromtimestamp(sidecar['timestamp'])
             else:
                 logging.warning("File_Processor : get_json_metadata - No photoTakenTime in %s", json_filename)
-            if 'geoData' in d:
-                metadata_json['geodata_json'] = {
-                    'latitude': d['geoData']['latitude'],
-                    'longitude': d['geoData']['longitude'],
-                }
+            if sidecar['geodata'] is not None:
+                metadata_json['geodata_json'] = sidecar['geodata']
             else:
                 logging.warning("File_Processor : get_json_metadata - No geoData in %s", json_filename)
         else:
-            logging.debug("File_Processor : get_json_metadata - No json file for %s", self.source_media_filename)
+            logging.debug("File_Processor : get_json_metadata - No json file for %s", source)
         return metadata_json    
     
-    def get_hash(self):
-        if is_image_PIL(self.source_media_fileext):
-            return self.get_image_hash()
-        elif is_video(self.source_media_fileext):
-            return None
-            #return self.get_video_hash() # seems to get a lot of collisions
+    def get_hash(self, source):
+        fileext = os.path.splitext(source)[1]
+        if is_image_PIL(fileext):
+            return self.get_image_hash(source)
+        elif is_non_PIL(fileext):
+            # raw and Photoshop files are hashed from the JPEG preview inside them
+            preview = self.get_preview(source)
+            return self.get_image_hash(source, preview) if preview else None
+        elif is_video(fileext):
+            return self.get_video_hash(source)
         else:
             return None
 
-    #def get_video_hash(self):
-    #    return videohash.VideoHash(path=self.source_media_filename).hash_hex
+    def get_video_hash(self, source):
+        # videohash decoded frames and got a lot of collisions, so instead we fingerprint the
+        # container and samples of its bytes, which only matches copies of the same video
+        try:
+            return video_fingerprint(source)
+        except OSError as e:
+            logging.error("File_Processor : get_video_hash - %s from %s", e, source)
+            return None
 
-    def get_image_hash(self):        
+    def get_preview(self, source):
+        # the JPEG preview from a raw or Photoshop file, which is far quicker to decode than the raw data
+        try:
+            preview = extract_preview(source)
+        except OSError as e:
+            logging.error("File_Processor : get_preview - %s from %s", e, source)
+            return None
+        if preview is None:
+            logging.info("File_Processor : get_preview - no preview to hash in %s", source)
+        return preview
+
+    def get_image_hash(self, source, image=None):
         # Experimenting with different hash sizes and types. Average hash produced a lot of 
         # collisions with similar but different pictures - e.g. one taken immediately after
         # another. Perceptual hash worked better, but bumping hash size up from 8 to try 
         # and reduce collisions further.
+        # The image is read from source, unless we've been given the preview bytes to use instead.
+        if image is None:
+            image = source
         try:
-            hash = imagehash.phash(Image.open(self.source_media_filename), hash_size=16)
-            return hash
+            if self.hash_mode == 'validate':
+                hash = phash_file(image)
+                fast_hash = phash_file(image, fast=True)
+                if fast_hash != hash:
+                    logging.warning("File_Processor : get_image_hash - fast hash %s is %d bits from full hash %s for %s",
+                                    fast_hash, hash_distance(fast_hash, hash), hash, source)
+                return hash
+            return phash_file(image, fast=self.hash_mode == 'fast')
         except OSError as e:
-            logging.error("File_Processor : get_image_hash - %s from %s", e, self.source_media_filename)
+            logging.error("File_Processor : get_image_hash - %s from %s", e, source)
             return None
     
-    def process_file(self, source):
-        self.source_media_filename = source
-        self.source_media_basename = os.path.basename(source)
-        cfile, self.source_media_fileext = os.path.splitext(self.source_media_filename)
-        if is_exif(self.source_media_fileext):
+    def get_hashes(self, source):
+        # All the hash types for an image from a single decode, or None if it isn't an image we
+        # can hash. In fast mode the decode is a reduced one, as for the phash on its own.
+        fileext = os.path.splitext(source)[1]
+        if is_image_PIL(fileext):
+            image = source
+        elif is_non_PIL(fileext):
+            image = self.get_preview(source)
+            if image is None:
+                return None
+        else:
+            return None
+        try:
+            with open_image(image) as image:
+                if self.hash_mode == 'fast':
+                    image = reduce_for_hash(image, 'RGB')
+                return image_hashes(image)
+        except OSError as e:
+            logging.error("File_Processor : get_hashes - %s from %s", e, source)
+            return None
+
+    def get_hash_entry(self, source):
+        # The exif data and hashes for a file, as they are kept in the metadata cache
+        entry = {'exif': self.get_media_metadata(source)}
+        if self.multi_hash:
+            entry['hashes'] = self.get_hashes(source)
+        if self.multi_hash and is_image(os.path.splitext(source)[1]):
+            entry['hash'] = entry['hashes']['phash'] if entry['hashes'] else None
+        else:
+            entry['hash'] = self.get_hash(source)
+        return entry
+
+    def get_exif_and_hash(self, source, stat=None):
+        # The exif data and the hash are by far the slowest things to work out, so if we have a
+        # metadata cache look there before running exiftool or PIL over the file. Returns the
+        # exif data, the hash, and all the hashes if we're working out more than one type.
+        if self.metadata_cache is None:
+            cached = self.get_hash_entry(source)
+        else:
+            if stat is None:
+                stat = os.stat(source)
+            if source in self.cached:
+                # each file is only processed once, so its entry isn't needed after this
+                cached = self.cached.pop(source)
+            else:
+                cached = self.metadata_cache.get(source, stat)
+            if cached is None or (self.multi_hash and 'hashes' not in cached):
+                cached = self.get_hash_entry(source)
+                self.metadata_cache.put(source, stat, cached)
+        return cached['exif'], cached['hash'], cached.get('hashes')
+
+    def process_file(self, source, stat=None):
+        # Everything to do with the file being processed is kept local, not on self, so that
+        # one File_Processor can be shared by several threads working through a folder
+        basename = os.path.basename(source)
+        fileext = os.path.splitext(source)[1]
+        if is_exif(fileext):
+            duplicate = self.duplicates.get(source)
+            is_copy = duplicate is not None and duplicate['duplicate_of'] is not None
+            if is_copy:
+                # an exact copy of a file earlier in the scan - its exif data and hash are the same
+                # as the original's, and are filled in from there when the results are recorded
+                exif, hash, hashes = None, None, None
+            else:
+                exif, hash, hashes = self.get_exif_and_hash(source, stat)
             results = {
-                'source': self.source_media_filename,
+                'source': source,
                 'folder_year': self.year_hint,
-                'exif': self.get_exif_metadata(),
-                'file': self.get_file_metadata(),
-                'filename_time': self.get_filename_metadata(),
-                'hash': self.get_hash(),
-                'json': self.get_json_metadata()
+                'exif': exif,
+                'file': self.get_file_metadata(source, stat),
+                'filename_time': self.get_filename_metadata(basename),
+                'hash': hash,
+                'json': self.get_json_metadata(source)
             }
+            if self.multi_hash:
+                results['hashes'] = hashes
+            if duplicate:
+                results['content_hash'] = duplicate['content_hash']
+                results['duplicate_of'] = duplicate['duplicate_of']
             # if the file size is zero, log an error
             if results['file']['file_size'] == 0:
-                logging.error("File_Processor : process_file - Zero size file %s", self.source_media_filename)
-            # if we're in a folder that contains a year, use this as a bad fallback time for the media
-            if self.year_hint:
-                year_hint_time = datetime.datetime(self.year_hint, 1, 1, 0, 0, 0, 0)
-            else:
-                year_hint_time = None
-            # choose a timestamp for the photo using these methods in preference order
-            results['preferred_ts'] = (
-                results['exif']['datetime_exif'] or 
-                results['json']['datetime_json'] or
-                results['filename_time']['datetime_filename'] or
-                year_hint_time or
-                results['file']['datetime_filemodif'] or
-                datetime.datetime(1972,2,26,9,0,0,0)
-            )
-            logging.debug("File_Processor : process_file - results: %s preferred_ts %s", results, results['preferred_ts'])
-            # come up with a proposed new name for the file
-            destination = "{0}/{1:%Y}/{1:%Y}_{1:%m}/{1:%Y-%m-%d_%H%M%S}_{2}".format(self.output_folder, results['preferred_ts'], self.source_media_basename)
-            results['destination'] = destination
+                logging.error("File_Processor : process_file - Zero size file %s", source)
+            if not is_copy:
+                choose_destination(results, self.output_folder)
             return results
-        elif is_json(self.source_media_fileext):
+        elif is_json(fileext):
             pass
         else:
-            ftype = magic.from_file(self.source_media_filename, mime=True)
-            logging.error("File_Processor : process_file - Found an extension I don't like: %s %s (mime type is %s)", self.source_media_filename, self.source_media_fileext, ftype)
+            ftype = magic.from_file(source, mime=True)
+            logging.error("File_Processor : process_file - Found an extension I don't like: %s %s (mime type is %s)", source, fileext, ftype)
         return None
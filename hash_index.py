@@ -0,0 +1,148 @@
+import logging
+import numpy
+
+if hasattr(numpy, 'bitwise_count'):
+    popcount = numpy.bitwise_count
+else:
+    # older numpy has no popcount, so count the bits a byte at a time
+    byte_counts = numpy.array([bin(i).count('1') for i in range(256)], dtype=numpy.uint8)
+    def popcount(words):
+        return byte_counts[words.view(numpy.uint8)].reshape(words.shape + (8,)).sum(axis=-1, dtype=numpy.uint8)
+
+def hash_value(hash):
+    # Hashes are kept as fixed width hex strings, in the report and in memory, but are worked
+    # out as ImageHash objects, and both turn into the same integer
+    return int(str(hash), 16)
+
+def hash_distance(hash1, hash2):
+    # the number of bits two hashes differ by
+    return (hash_value(hash1) ^ hash_value(hash2)).bit_count()
+
+def pack_value(value, words):
+    # split an integer hash into uint64 words, lowest first
+    mask = (1 << 64) - 1
+    return [(value >> (64 * word)) & mask for word in range(words)]
+
+def pack_hashes(hashes, hash_bits=256):
+    # Pack hashes into a matrix with one row per hash and one uint64 column per 64 bits, so
+    # they can be compared in bulk without any Python objects in the way
+    words = hash_bits // 64
+    packed = numpy.zeros((len(hashes), words), dtype=numpy.uint64)
+    for row, hash in enumerate(hashes):
+        packed[row] = pack_value(hash_value(hash), words)
+    return packed
+
+def packed_distances(block1, block2):
+    # The distance between every row of block1 and every row of block2. Going a word at a time
+    # keeps the intermediate arrays small, which is several times faster than one big XOR.
+    distances = popcount(block1[:, None, 0] ^ block2[None, :, 0]).astype(numpy.uint16)
+    for word in range(1, block1.shape[1]):
+        distances += popcount(block1[:, None, word] ^ block2[None, :, word])
+    return distances
+
+class Hash_Index:
+    '''
+        Class which indexes perceptual hashes so that every hash within a few bits of a new
+        one can be found without comparing it against the whole library. It uses multi-index
+        hashing: each hash is cut into threshold+1 chunks and every chunk is indexed on its
+        own. Two hashes that differ by at most threshold bits must have at least one chunk
+        exactly the same, so only the hashes that share a chunk with the one we're looking
+        for need their full distance checked. A threshold of 0 is an exact match.
+        The hashes themselves are kept packed in a uint64 matrix, one row per file, which
+        packed() hands out without copying for comparing them in bulk.
+    '''
+    def __init__(self, threshold=0, hash_bits=256):
+        self.threshold = threshold
+        self.hash_bits = hash_bits
+        self.words = hash_bits // 64
+        # split the bits as evenly as we can into threshold+1 chunks, as (shift, mask) pairs
+        chunk_count = min(threshold + 1, hash_bits)
+        self.chunks = []
+        shift = 0
+        for i in range(chunk_count):
+            width = (hash_bits - shift) // (chunk_count - i)
+            self.chunks.append((shift, (1 << width) - 1))
+            shift += width
+        self.tables = [{} for chunk in self.chunks]
+        # the source of each row of hashes, in the order they were added, and the row for each source
+        self.sources = []
+        self.rows = {}
+        self.hashes = numpy.zeros((1024, self.words), dtype=numpy.uint64)
+
+    def __len__(self):
+        return len(self.sources)
+
+    def packed(self):
+        # the hashes added so far, row for row with sources
+        return self.hashes[:len(self.sources)]
+
+    def add(self, hash, source):
+        # a file is only indexed once, however many times the report it's in is read
+        if source in self.rows:
+            return
+        value = hash_value(hash)
+        row = len(self.sources)
+        if row == len(self.hashes):
+            # grow the matrix by doubling, so adding stays cheap on average
+            self.hashes = numpy.concatenate([self.hashes, numpy.zeros_like(self.hashes)])
+        self.hashes[row] = pack_value(value, self.words)
+        self.sources.append(source)
+        self.rows[source] = row
+        for (shift, mask), table in zip(self.chunks, self.tables):
+            table.setdefault((value >> shift) & mask, []).append(row)
+
+    def find(self, hash):
+        # Return (source, distance) for every indexed hash within threshold bits of this one,
+        # nearest first and otherwise in the order they were added
+        value = hash_value(hash)
+        candidates = set()
+        for (shift, mask), table in zip(self.chunks, self.tables):
+            candidates.update(table.get((value >> shift) & mask, ()))
+        if not candidates:
+            return []
+        rows = numpy.array(sorted(candidates))
+        query = numpy.array([pack_value(value, self.words)], dtype=numpy.uint64)
+        distances = packed_distances(query, self.hashes[rows])[0]
+        close = numpy.nonzero(distances <= self.threshold)[0]
+        matches = [(self.sources[rows[i]], int(distances[i])) for i in close]
+        logging.debug("Hash_Index : find - %d candidates, %d matches for %s", len(candidates), len(matches), hash)
+        return sorted(matches, key=lambda m: m[1])
+
+    def matches(self, hash1, hash2):
+        # whether two hashes are close enough to count as the same picture
+        if hash1 is None or hash2 is None:
+            return False
+        return hash_distance(hash1, hash2) <= self.threshold
+
+def find_clusters(packed, threshold=0, block_size=512):
+    # Group packed hashes into clusters of hashes that are within threshold bits of each other,
+    # directly or through a chain of others. Every pair is compared, a block of rows against
+    # a block of rows at a time to keep memory down, and the close pairs are joined up with a
+    # union-find. Returns lists of row numbers, for clusters of more than one hash only.
+    count = len(packed)
+    parent = list(range(count))
+
+    def find(row):
+        while parent[row] != row:
+            parent[row] = parent[parent[row]]
+            row = parent[row]
+        return row
+
+    for start in range(0, count, block_size):
+        block = packed[start:start + block_size]
+        for other_start in range(start, count, block_size):
+            close = packed_distances(block, packed[other_start:other_start + block_size]) <= threshold
+            if other_start == start:
+                # only look at each pair once, and not at a hash against itself
+                close = numpy.triu(close, k=1)
+            for row, other in zip(*numpy.nonzero(close)):
+                root, other_root = find(start + int(row)), find(other_start + int(other))
+                if root != other_root:
+                    parent[max(root, other_root)] = min(root, other_root)
+
+    clusters = {}
+    for row in range(count):
+        clusters.setdefault(find(row), []).append(row)
+    logging.info("find_clusters - %d hashes in %d clusters of more than one", count,
+                 len([c for c in clusters.values() if len(c) > 1]))
+    return [c for c in clusters.values() if len(c) > 1]
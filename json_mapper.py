@@ -1,131 +1,185 @@
-import glob
 import os
 import re
 import logging
 import json
+import itertools
 import sys
 
 class JSONMapperFatalException(Exception):
     pass
 
+def summarise_sidecar(json_document):
+    # Pick out just the parts of a sidecar that we use, so that a folder's worth of them can be
+    # kept in memory and each sidecar only needs to be read from disk and parsed once
+    summary = {
+        'title': json_document.get('title'),
+        'timestamp': None,
+        'geodata': None
+    }
+    if 'photoTakenTime' in json_document:
+        summary['timestamp'] = int(json_document['photoTakenTime']['timestamp'])
+    if 'geoData' in json_document:
+        summary['geodata'] = {
+            'latitude': json_document['geoData']['latitude'],
+            'longitude': json_document['geoData']['longitude'],
+        }
+    return summary
+
+class JSON_Sidecar:
+    '''
+        Class which holds everything we work out about a single json sidecar file while
+        mapping it to its media file.
+    '''
+    def __init__(self, json_filename):
+        self.json_filename = json_filename
+        self.json_basename = os.path.basename(json_filename)
+        self.json_basename_noext, self.json_fileext = os.path.splitext(self.json_basename)
+        self.json_document = None
+
 class JSON_Mapper:
     '''
         Class which processes a folder of media files which also may contain json sidecar files. It 
         attempts to map the media files to the corresponding json files. This process is complex
         due to the generally buggy way that Google has implemented Takeout for photos.
+        All the state for a mapping is local to map_folder, so one JSON_Mapper can map several
+        folders at once from different threads.
     '''
     def __init__(self, input_folder):
         self.input_folder = input_folder
         self.mapper = {}
+        self.sidecars = {}
 
-    def is_a_metadata_sidecar(self):
+    def is_a_metadata_sidecar(self, json_document):
         for required in ['title', 'description', 'imageViews']:
-            if required not in self.json_document:
+            if required not in json_document:
                 return False
         return True
     
     def create_mapper(self):
+        # map our own folder, adding to any mapping we already have
+        return self.map_folder(self.input_folder, self.mapper, sidecars=self.sidecars)
+
+    def list_folder(self, folder):
+        # the names of all the (non hidden) files in a folder
+        with os.scandir(folder) as it:
+            return set(e.name for e in it if not e.name.startswith('.') and not e.is_dir())
+
+    def map_folder(self, folder, mapper=None, names=None, sidecars=None):
         # find all json files in the specified input folder
         # open the file and read the details into a hashmap
         # try to identify the mapping from json file to target media file
         # needs some cleverness to work out when multiple files have same name!
-        for json_filename in glob.iglob(self.input_folder + "//*.json", recursive=False):
-            self.json_filename = json_filename
-            self.json_basename = os.path.basename(json_filename)
-            self.json_basename_noext, self.json_fileext = os.path.splitext(self.json_basename)
-            self.process_json()
-        return self.mapper
-
-    def process_target_media_filename(self):
-        self.target_media_filename = self.json_document['title']
-        self.target_media_filename_noext, self.target_media_fileext = os.path.splitext(self.target_media_filename)
-
-        if len(self.target_media_filename) > 46:
-            self.over_46_chars_media_filename = True
-            self.add_file_extension = True
+        # The folder is listed once (or the caller hands us its listing in names) and every
+        # check for whether a file exists is a lookup in that set, rather than a stat call.
+        # If a sidecars dictionary is given, it is filled in with a summary of every metadata
+        # sidecar, keyed on the json file name, so nobody needs to parse them again.
+        if mapper is None:
+            mapper = {}
+        files = set(names) if names is not None else self.list_folder(folder)
+        # numbered groups of files we have already matched up, so each group is only done once
+        resolved_groups = set()
+        for json_basename in sorted(n for n in files if n.endswith('.json')):
+            sidecar = JSON_Sidecar(os.path.join(folder, json_basename))
+            self.process_json(files, mapper, resolved_groups, sidecar)
+            if sidecars is not None and sidecar.json_document and self.is_a_metadata_sidecar(sidecar.json_document):
+                sidecars[json_basename] = summarise_sidecar(sidecar.json_document)
+        return mapper
+
+    def process_target_media_filename(self, sidecar):
+        sidecar.target_media_filename = sidecar.json_document['title']
+        sidecar.target_media_filename_noext, sidecar.target_media_fileext = os.path.splitext(sidecar.target_media_filename)
+
+        if len(sidecar.target_media_filename) > 46:
+            sidecar.over_46_chars_media_filename = True
+            sidecar.add_file_extension = True
         else:
-            self.over_46_chars_media_filename = False
-            if len(self.target_media_fileext)==0:
+            sidecar.over_46_chars_media_filename = False
+            if len(sidecar.target_media_fileext)==0:
                 # Google what the actual?
                 # Sometimes the json file target filename has no extension, but the media file is a jpg?!
-                self.target_media_fileext = '.jpg'
-                self.add_file_extension = True
+                sidecar.target_media_fileext = '.jpg'
+                sidecar.add_file_extension = True
             else:
-                self.add_file_extension = False
+                sidecar.add_file_extension = False
         # replace ' in title with _ and truncate to 46 characters
         # why? You'll need to ask Google
-        self.target_media_filename_truncated = self.target_media_filename.replace('\'', '_')[:46]
+        sidecar.target_media_filename_truncated = sidecar.target_media_filename.replace('\'', '_')[:46]
 
-    def process_json_basename_match(self):
+    def process_json_basename_match(self, files, mapper, sidecar):
         # most of the time the image file for image.ext is image.ext.json
 
         # if our 46 character truncation chops the middle of our file extension, then remove it
-        m = re.match(r"^(.*)\..?.?$", self.target_media_filename_truncated)
+        m = re.match(r"^(.*)\..?.?$", sidecar.target_media_filename_truncated)
         if m:
-            self.target_media_filename_truncated = m.group(1)
+            sidecar.target_media_filename_truncated = m.group(1)
         
         # if our media file is missing a file extension, add it back on
-        if self.add_file_extension:
-            self.target_media_filename_truncated += self.target_media_fileext
+        if sidecar.add_file_extension:
+            sidecar.target_media_filename_truncated += sidecar.target_media_fileext
         
         for check in ['normal', '47chars']:
             # check that the media file actually exists
-            if os.path.isfile(self.input_folder+'/'+self.target_media_filename_truncated):
+            if sidecar.target_media_filename_truncated in files:
                 # save the media file in the mapper - this is the happy path complete
-                logging.debug("JSON_Mapper : process_jason_basename_match - found file %s -> %s", self.target_media_filename_truncated, self.json_basename)
-                self.mapper[self.target_media_filename_truncated] = self.json_basename
+                logging.debug("JSON_Mapper : process_jason_basename_match - found file %s -> %s", sidecar.target_media_filename_truncated, sidecar.json_basename)
+                mapper[sidecar.target_media_filename_truncated] = sidecar.json_basename
                 if check=='47chars':
-                    logging.warning("JSON_Mapper : process_jason_basename_match - found file with 47 chars trick %s", self.target_media_filename_truncated)
+                    logging.warning("JSON_Mapper : process_jason_basename_match - found file with 47 chars trick %s", sidecar.target_media_filename_truncated)
                 break
             else:
                 # If the first file exists check fails, try media file but truncated to
                 # 47 characters instead of 46!
-                if self.over_46_chars_media_filename:
-                    self.target_media_filename_truncated =  self.target_media_filename.replace('\'', '_')[:47]+self.target_media_fileext
+                if sidecar.over_46_chars_media_filename:
+                    sidecar.target_media_filename_truncated =  sidecar.target_media_filename.replace('\'', '_')[:47]+sidecar.target_media_fileext
 
-        if self.target_media_filename_truncated not in self.mapper:
+        if sidecar.target_media_filename_truncated not in mapper:
             # we failed to make a match - log an error
-            logging.error("JSON_Mapper : process_jason_basename_match - media file not found %s", self.target_media_filename_truncated)
+            logging.error("JSON_Mapper : process_jason_basename_match - media file not found %s", sidecar.target_media_filename_truncated)
 
-    def process_json_basename_mismatch(self):
+    def process_json_basename_mismatch(self, files, mapper, resolved_groups, sidecar):
         # The media filename in the json file doesn't match the json document
         # The normal reason for this is that the media file and json document have been 
         # renamed with a numbered index.
 
         # Match a numbered index on the json file
-        m = re.match(r"(.*)\.\w{1,4}\(\d+\)$", self.json_basename_noext)
+        m = re.match(r"(.*)\.\w{1,4}\(\d+\)$", sidecar.json_basename_noext)
         if m:
-            # we now need to match up the numbered files to resolve ambiguities - we do this slightly
-            # inefficiently by always processing all of the numbered indexes whenever we find a single one
-            # so we're overprocessing the files, but the only sane way of doing this is to start from zero
-            # and count up so we're just going to have to live with that.
+            # we now need to match up the numbered files to resolve ambiguities - the only sane way of
+            # doing this is to start from zero and count up through the whole group. Every json file in
+            # the group would lead us to do the same walk, so remember which groups we have done and
+            # only walk each one once.
             base_numbering_file = m.group(1)
             # the target media file doesn't have truncated file extensions in it, but the json does!
-            m = re.match(r"^(.*)(\.\w{1,2})$", self.target_media_filename_truncated)
+            m = re.match(r"^(.*)(\.\w{1,2})$", sidecar.target_media_filename_truncated)
             if m:
-                logging.debug("target media file doesn't have truncated file extensions in it, but the json does! %s", self.target_media_filename_truncated)
-                self.target_media_filename_truncated = m.group(1)
-                self.target_media_fileext_for_json = m.group(2)
+                logging.debug("target media file doesn't have truncated file extensions in it, but the json does! %s", sidecar.target_media_filename_truncated)
+                sidecar.target_media_filename_truncated = m.group(1)
+                sidecar.target_media_fileext_for_json = m.group(2)
             else:
-                self.target_media_fileext_for_json = self.target_media_fileext
-            if self.add_file_extension:
-                self.target_media_filename_truncated += self.target_media_fileext
+                sidecar.target_media_fileext_for_json = sidecar.target_media_fileext
+            if sidecar.add_file_extension:
+                sidecar.target_media_filename_truncated += sidecar.target_media_fileext
 
-            if base_numbering_file+self.target_media_fileext==self.target_media_filename_truncated:
+            if base_numbering_file+sidecar.target_media_fileext==sidecar.target_media_filename_truncated:
+                group = (base_numbering_file, sidecar.target_media_fileext, sidecar.target_media_fileext_for_json, sidecar.json_fileext)
+                if group in resolved_groups:
+                    logging.debug("JSON_Mapper : process_jason_basename_mismatch - Numbered group already done %s", base_numbering_file)
+                    return
+                resolved_groups.add(group)
                 joffset = 0
-                # check all the numbered json files and media files line up correctly
-                for index in range(20):
+                # check all the numbered json files and media files line up correctly, however many there are
+                for index in itertools.count():
                     if index==0:
-                        checkm = base_numbering_file+self.target_media_fileext
-                        checkj = base_numbering_file+self.target_media_fileext_for_json+self.json_fileext
+                        checkm = base_numbering_file+sidecar.target_media_fileext
+                        checkj = base_numbering_file+sidecar.target_media_fileext_for_json+sidecar.json_fileext
                     else:
-                        checkm = "{}({}){}".format(base_numbering_file,index,self.target_media_fileext)
-                        checkj = "{}{}({}){}".format(base_numbering_file,self.target_media_fileext_for_json,index+joffset,self.json_fileext)
-                    media_exists = os.path.isfile(self.input_folder+'/'+checkm)
-                    json_exists = os.path.isfile(self.input_folder+'/'+checkj)
+                        checkm = "{}({}){}".format(base_numbering_file,index,sidecar.target_media_fileext)
+                        checkj = "{}{}({}){}".format(base_numbering_file,sidecar.target_media_fileext_for_json,index+joffset,sidecar.json_fileext)
+                    media_exists = checkm in files
+                    json_exists = checkj in files
                     if media_exists and json_exists:
-                        checkj2 = "{}({}){}{}".format(base_numbering_file,index,self.target_media_fileext_for_json,self.json_fileext)
-                        json2_exists = os.path.isfile(self.input_folder+'/'+checkj2)
+                        checkj2 = "{}({}){}{}".format(base_numbering_file,index,sidecar.target_media_fileext_for_json,sidecar.json_fileext)
+                        json2_exists = checkj2 in files
                         if json2_exists:
                             # if there was actually a media file uploaded called image(1).ext and google wants to write a second
                             # image(1).ext, then it will have the first as image(1).ext -> image(1).ext.json (note position of
@@ -137,11 +191,11 @@ class JSON_Mapper:
                             logging.warning("JSON_Mapper : process_jason_basename_mismatch - Index offset craziness: base file %s %d", base_numbering_file, joffset)
                         else:
                             logging.debug("JSON_Mapper : process_jason_basename_mismatch - Numbered file success %d %s %s", index, checkm, checkj)
-                            if checkm not in self.mapper:
-                                self.mapper[checkm] = checkj
+                            if checkm not in mapper:
+                                mapper[checkm] = checkj
                             else:
-                                if self.mapper[checkm] != checkj:
-                                    logging.error("JSON_Mapper : process_jason_basename_mismatch - hmm, json mapper already has different entry media %s json %s mapper has %s", checkm, checkj, self.mapper[checkm])
+                                if mapper[checkm] != checkj:
+                                    logging.error("JSON_Mapper : process_jason_basename_mismatch - hmm, json mapper already has different entry media %s json %s mapper has %s", checkm, checkj, mapper[checkm])
                     elif media_exists or json_exists:
                         # either a json file exists solo or a media file exists solo - either way, this isn't what we want ideally
                         logging.error("JSON_Mapper : process_jason_basename_mismatch - Numbered file fail at %d %s %s", index, checkm, checkj)
@@ -149,7 +203,7 @@ class JSON_Mapper:
                         if index==0:
                             # We've found a bug somewhere, because we started this little odyssey with a file with a nummbered extension, but failed
                             # to find the zeroth example. Stop, look, debug.
-                            logging.error("JSON_Mapper : process_jason_basename_mismatch - Numbered file fail at zero %d %s %s", index, self.json_basename_noext, self.target_media_filename_truncated, checkj, checkm)
+                            logging.error("JSON_Mapper : process_jason_basename_mismatch - Numbered file fail at zero %d %s %s", index, sidecar.json_basename_noext, sidecar.target_media_filename_truncated, checkj, checkm)
                             raise JSONMapperFatalException
                         # This is the expected path when we reach the end of the file numbering fun - we run out of files and go back to work
                         #logging.debug("Numbered file break at %d %s", index, base_numbering_file)
@@ -157,30 +211,30 @@ class JSON_Mapper:
             else:
                 # if we remove the (1) numbering from the file, and we still don't match what is in the json file
                 # this is a bug that needs investigation so stop
-                logging.error("JSON_Mapper : process_jason_basename_mismatch - Numbered MISMATCH json %s with target %s %s %s", self.json_basename_noext, self.target_media_filename, base_numbering_file, self.target_media_filename_truncated)
+                logging.error("JSON_Mapper : process_jason_basename_mismatch - Numbered MISMATCH json %s with target %s %s %s", sidecar.json_basename_noext, sidecar.target_media_filename, base_numbering_file, sidecar.target_media_filename_truncated)
                 raise JSONMapperFatalException
             pass
         else:
-            logging.error("JSON_Mapper : process_jason_basename_mismatch - Mismatch json %s with target %s", self.json_basename_noext, self.target_media_filename)
+            logging.error("JSON_Mapper : process_jason_basename_mismatch - Mismatch json %s with target %s", sidecar.json_basename_noext, sidecar.target_media_filename)
             raise JSONMapperFatalException
 
-    def process_json(self):
+    def process_json(self, files, mapper, resolved_groups, sidecar):
         # Open the json file and read it
-        with open(self.json_filename) as f:
-            self.json_document = json.load(f)
-            if self.is_a_metadata_sidecar():
-                logging.debug("JSON_Mapper : process_json - json doc %s", self.json_document)
+        with open(sidecar.json_filename) as f:
+            sidecar.json_document = json.load(f)
+            if self.is_a_metadata_sidecar(sidecar.json_document):
+                logging.debug("JSON_Mapper : process_json - json doc %s", sidecar.json_document)
             else:
-                logging.debug("JSON_Mapper : process_json - skipping json doc %s", self.json_document)
+                logging.debug("JSON_Mapper : process_json - skipping json doc %s", sidecar.json_document)
                 return
         # Perform various manipulations on the target media filename from the json
-        self.process_target_media_filename()
+        self.process_target_media_filename(sidecar)
         # Normally the json basename (input_file.jpg.json with .json removed) should simply
         # match the target media file (input_file.jpg)
-        if self.target_media_filename_truncated==self.json_basename_noext:
-            logging.debug("JSON_Mapper : process_json - basename match %s", self.json_basename_noext)
-            self.process_json_basename_match()
+        if sidecar.target_media_filename_truncated==sidecar.json_basename_noext:
+            logging.debug("JSON_Mapper : process_json - basename match %s", sidecar.json_basename_noext)
+            self.process_json_basename_match(files, mapper, sidecar)
         else:
             # But there are lots of cases where this simply isn't true
-            logging.debug("JSON_Mapper : process_json - basename mismatch %s with %s", self.json_basename_noext, self.target_media_filename_truncated)
-            self.process_json_basename_mismatch()
\ No newline at end of file
+            logging.debug("JSON_Mapper : process_json - basename mismatch %s with %s", sidecar.json_basename_noext, sidecar.target_media_filename_truncated)
+            self.process_json_basename_mismatch(files, mapper, resolved_groups, sidecar)
\ No newline at end of file
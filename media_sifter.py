@@ -1,15 +1,157 @@
 import os
 import re
-import glob
 import json
-import shutil
 import logging
 import traceback
+import collections
+import multiprocessing.util
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pillow_heif import register_heif_opener
 from json_mapper import JSON_Mapper, JSONMapperFatalException
-from file_processor import File_Processor
+from file_processor import File_Processor, Exif_Session, is_exif, is_read_natively, choose_destination
+from duplicate_finder import find_duplicates
+from metadata_cache import Metadata_Cache
+from hash_index import Hash_Index, find_clusters
+from report_store import Report_Store
+from copy_engine import Copy_Engine
+from report_file import read_report_entries, is_legacy_report, trim_partial_line, convert_legacy_report, \
+    restore_datetimes
 
 logger = logging.getLogger(__name__)
 
+def walk_folders(top):
+    # Walk the folder tree in a single pass, yielding each folder along with the DirEntry of
+    # every file directly inside it. DirEntry caches what it knows about a file, so files
+    # aren't stat'ed again and again as they are processed. Hidden files and folders are
+    # skipped, just as glob does.
+    try:
+        with os.scandir(top) as it:
+            entries = sorted((e for e in it if not e.name.startswith('.')), key=lambda e: e.name)
+    except OSError as e:
+        logging.error("Media_Sifter : walk_folders - can't read folder %s - %s", top, e)
+        return
+    yield top, [e for e in entries if not e.is_dir()]
+    for entry in entries:
+        if entry.is_dir():
+            yield from walk_folders(entry.path)
+
+def list_source_files(entries, skip=()):
+    # Turn a folder's DirEntry list into (filename, stat) pairs for the files that still need
+    # processing. Only media files need their stat results, which are picked up from the
+    # DirEntry so each file is stat'ed at most once.
+    source_files = []
+    for entry in entries:
+        if entry.path in skip:
+            logging.debug("Media_Sifter : list_source_files - skipping %s", entry.path)
+            continue
+        stat = None
+        if is_exif(os.path.splitext(entry.name)[1]):
+            try:
+                stat = entry.stat()
+            except OSError as e:
+                logging.error("Media_Sifter : list_source_files - can't stat %s - %s", entry.path, e)
+                continue
+        source_files.append((entry.path, stat))
+    return source_files
+
+def sift_folder(folder, names, source_files, output_folder, exif_session, thread_pool=None, metadata_cache=None,
+                duplicates=None, hash_mode='full', multi_hash=False):
+    # Work out the report entries for a list of (filename, stat) pairs from one folder, where
+    # names lists every file in the folder. Yields
+    # one set of results per media file so the caller can record them as they arrive. If a
+    # thread pool is given the files are processed by it, which hides a lot of the latency
+    # of reading files from a network share. Files listed in duplicates as copies of another
+    # file skip exif extraction and hashing, which the caller fills in from the original.
+    logging.info("Media_Sifter : sift_folder - Processing folder %s", folder)
+
+    match_year_in_folder_name = re.compile(r".*/.*([12]\d\d\d)$", re.I)
+    match = match_year_in_folder_name.match(folder)
+    if match:
+        year = int(match.group(1))
+    else:
+        year = None
+
+    # Before we do anything, create a mapping of all json files to image files
+    # in the current folder, resolving any conflicts as we go. The sidecars are summarised
+    # as they are read so the file processor doesn't need to read them again.
+    sidecars = {}
+    mapper_maker = JSON_Mapper(folder)
+    json_mapper = mapper_maker.map_folder(folder, names=names, sidecars=sidecars)
+
+    duplicates = duplicates or {}
+    # look every file up in the metadata cache once, here, and hand what we found to the file
+    # processor, rather than looking it up again there. Copies of other files aren't looked
+    # up, as they aren't read at all.
+    cached = {}
+    if metadata_cache:
+        cached = {f: metadata_cache.get(f, stat) for f, stat in source_files
+                  if stat is not None and not (f in duplicates and duplicates[f]['duplicate_of'])}
+    processor = File_Processor(json_mapper, year, output_folder, exif_session, sidecars, metadata_cache, duplicates,
+                               hash_mode, multi_hash, cached)
+
+    # read the exif data for the whole folder in as few exiftool calls as we can, leaving out
+    # copies of other files, videos and images we can read ourselves and anything we already
+    # have cached
+    exif_session.prefetch([f for f, stat in source_files if stat is not None and
+                           not is_read_natively(os.path.splitext(f)[1]) and
+                           not (f in duplicates and duplicates[f]['duplicate_of']) and
+                           not cached.get(f)])
+
+    #   for each photo or video file supported:
+    filenames = [f for f, stat in source_files]
+    stats = [stat for f, stat in source_files]
+    if thread_pool:
+        all_results = thread_pool.map(processor.process_file, filenames, stats)
+    else:
+        all_results = map(processor.process_file, filenames, stats)
+    for results in all_results:
+        if results:
+            yield results
+    exif_session.clear()
+    if metadata_cache:
+        metadata_cache.commit()
+
+# Each worker process in a parallel scan keeps its own exiftool process running, and its own
+# connection to the metadata cache
+worker_exif_session = None
+worker_thread_pool = None
+worker_metadata_cache = None
+worker_hash_mode = 'full'
+worker_multi_hash = False
+
+def init_sift_worker(threads=1, cache_filename=None, cache_verify=False, hash_mode='full', multi_hash=False):
+    # Workers may be started fresh rather than forked (spawn is the default on macOS and
+    # Windows), so they set up everything they need themselves, including opening HEIC files
+    global worker_exif_session, worker_thread_pool, worker_metadata_cache, worker_hash_mode, worker_multi_hash
+    register_heif_opener()
+    # exiftool is started by the first folder that needs it
+    worker_exif_session = Exif_Session()
+    if threads > 1:
+        worker_thread_pool = ThreadPoolExecutor(max_workers=threads)
+    if cache_filename:
+        worker_metadata_cache = Metadata_Cache(cache_filename, cache_verify, hash_mode)
+    worker_hash_mode = hash_mode
+    worker_multi_hash = multi_hash
+    # multiprocessing runs this as the worker exits, which atexit handlers don't get a chance to
+    multiprocessing.util.Finalize(None, stop_sift_worker, exitpriority=10)
+
+def stop_sift_worker():
+    global worker_exif_session, worker_thread_pool, worker_metadata_cache
+    if worker_exif_session:
+        worker_exif_session.stop()
+        worker_exif_session = None
+    if worker_thread_pool:
+        worker_thread_pool.shutdown()
+        worker_thread_pool = None
+    if worker_metadata_cache:
+        worker_metadata_cache.close()
+        worker_metadata_cache = None
+
+def sift_folder_worker(folder, names, source_files, output_folder, duplicates=None):
+    return list(sift_folder(folder, names, source_files, output_folder, worker_exif_session, worker_thread_pool,
+                            worker_metadata_cache, duplicates, worker_hash_mode,
+                            worker_multi_hash))
+
 class Media_Sifter:
     '''
         Class to manage the high level media sifting process. Given a top level folder, an
@@ -17,53 +159,119 @@ class Media_Sifter:
         within the input, generating a json report file that proposes what file changes
         should be made and metadata used to copy the input to the output.
     '''
-    def __init__(self, input_folder, output_folder, report_filename):
+    def __init__(self, input_folder, output_folder, report_filename, workers=1, threads=1,
+                 cache_filename=None, cache_verify=False, dedupe=False, hash_mode='full', hash_threshold=0,
+                 multi_hash=False, report_format='json', copy_workers=4,
+                 enact_mode='copy', enact_duplicates='copy', enact_order='report', enact_verify=False):
         self.input_folder = input_folder
         self.output_folder = output_folder
         self.report_filename = report_filename
-        self.report = {}
-        self.hasher = {}
+        self.workers = workers
+        self.threads = threads
+        self.thread_pool = None
+        self.copy_workers = copy_workers
+        self.enact_mode = enact_mode
+        self.enact_duplicates = enact_duplicates
+        self.enact_order = enact_order
+        self.enact_verify = enact_verify
+        self.cache_filename = cache_filename
+        self.cache_verify = cache_verify
+        self.metadata_cache = Metadata_Cache(cache_filename, cache_verify, hash_mode) if cache_filename else None
+        self.dedupe = dedupe
+        self.duplicates = {}
+        self.hash_mode = hash_mode
+        self.multi_hash = multi_hash
+        # the report is a dictionary of entries keyed on source, or for libraries too big for
+        # that a sqlite database that acts like one
+        self.report_format = report_format
+        self.report = Report_Store(report_filename) if report_format == 'sqlite' else {}
+        self.json_fh = None
+        # files whose hashes are within hash_threshold bits of each other count as the same picture
+        self.hasher = Hash_Index(hash_threshold)
         self.hash_collisions = {}
+        self.collision_groups = {}
+        self.exif_session = Exif_Session()
 
-    def sift_media_in_subfolder(self):
-        logging.info("Media_Sifter : sift_media_in_subfolder - Processing folder %s", self.current_folder)
+    def record_results(self, results):
+        # Add a processed file to the report, the hash lookup and the report file. This is the
+        # only place the report is written to, so in a parallel scan it runs in the main process.
+        source_file = results['source']
+        if results.get('duplicate_of'):
+            self.complete_duplicate(results)
+        logging.debug("Media_Sifter : record_results - %s", results)
+        self.report[source_file] = results
+        if results['hash'] is not None:
+            match = self.index_hash(source_file, results['hash'])
+            if match:
+                logging.warning("Media_Sifter : record_results - hash collision %s %s clashes with %s (%d bits apart)",
+                                results['hash'], match[0], source_file, match[1])
+        else:
+            logging.debug("Media_Sifter : record_results - unhashable %s", source_file)
+        if self.json_fh:
+            self.json_fh.write(json.dumps(results, default=str)+'\n')
+            self.json_fh.flush()
 
-        match_year_in_folder_name = re.compile(r".*/.*([12]\d\d\d)$", re.I)
-        match = match_year_in_folder_name.match(self.current_folder)
-        if match:
-            year = int(match.group(1))
+    def complete_duplicate(self, results):
+        # A copy of another file is processed without its exif data or hash, which are the same
+        # as the original's. The original comes first in the scan, so its results are already
+        # in the report and can be copied across before choosing where the copy should go. If
+        # the report was read back from a file, or is a sqlite report, its dates are strings.
+        original = self.report.get(results['duplicate_of'])
+        if original is None:
+            logging.error("Media_Sifter : complete_duplicate - original %s of %s not in report",
+                          results['duplicate_of'], results['source'])
+            results['exif'] = {'datetime_exif': None, 'geodata_exif': None, 'model_exif': None}
         else:
-            year = None
+            results['exif'] = restore_datetimes(original['exif'])
+            results['hash'] = original['hash']
+            if 'hashes' in results:
+                results['hashes'] = original.get('hashes')
+        choose_destination(results, self.output_folder)
 
-        # Before we do anything, create a mapping of all json files to image files
-        # in the current folder, resolving any conflicts as we go
-        mapper_maker = JSON_Mapper(self.current_folder)
-        json_mapper = mapper_maker.create_mapper()
+    def folder_duplicates(self, source_files):
+        # the part of the duplicates lookup that covers one folder's files
+        return {f: self.duplicates[f] for f, stat in source_files if f in self.duplicates}
 
-        processor = File_Processor(json_mapper, year, self.output_folder)
+    def find_duplicates(self, folders):
+        # Look through every file still to be processed for exact copies of each other. This
+        # needs the whole tree, so the folders are all listed up front and returned for the scan.
+        folders = list(folders)
+        source_files = []
+        for folder, entries in folders:
+            source_files.extend(list_source_files(entries, self.report))
+        self.duplicates = find_duplicates(source_files)
+        return folders
 
-        #   for each photo or video file supported:
-        for source_file in glob.iglob(self.current_folder + "//*", recursive=False):
-            if os.path.isdir(source_file): # filter dirs
-                continue
+    def sift_media_in_subfolder(self, folder, entries):
+        names = [e.name for e in entries]
+        source_files = list_source_files(entries, self.report)
+        for results in sift_folder(folder, names, source_files, self.output_folder, self.exif_session,
+                                   self.thread_pool, self.metadata_cache, self.folder_duplicates(source_files),
+                                   self.hash_mode, self.multi_hash):
+            self.record_results(results)
 
-            if source_file in self.report:
-                logging.debug("Media_Sifter : sift_media_in_subfolder - skipping %s", source_file)
-                continue    
-            results = processor.process_file(source_file)
-            if results:
-                logging.debug("Media_Sifter : sift_media_in_subfolder - %s", results)
-                self.report[source_file] = results
-                if results['hash'] is not None:
-                    if results['hash'] in self.hasher:
-                        logging.warning("Media_Sifter : sift_media_in_subfolder - hash collision %s %s clashes with %s",
-                                        results['hash'], self.hasher[results['hash']], source_file)
-                    else:    
-                        self.hasher[results['hash']] = source_file
-                else:
-                    logging.debug("Media_Sifter : sift_media_in_subfolder - unhashable %s", source_file)
-                self.json_fh.write(json.dumps(results, default=str)+',\n')
-                self.json_fh.flush()
+    def sift_media_in_parallel(self, folders):
+        # Farm folders out to a pool of worker processes. Results are recorded in the same order
+        # the folders were found, so the report comes out the same as a serial scan. Only a
+        # limited number of folders are queued at once to keep memory use down.
+        pool = ProcessPoolExecutor(max_workers=self.workers, initializer=init_sift_worker,
+                                   initargs=(self.threads, self.cache_filename, self.cache_verify, self.hash_mode,
+                                             self.multi_hash))
+        try:
+            pending = collections.deque()
+            for folder, entries in folders:
+                names = [e.name for e in entries]
+                source_files = list_source_files(entries, self.report)
+                pending.append(pool.submit(sift_folder_worker, folder, names, source_files, self.output_folder,
+                                           self.folder_duplicates(source_files)))
+                if len(pending) >= self.workers * 4:
+                    for results in pending.popleft().result():
+                        self.record_results(results)
+            while pending:
+                for results in pending.popleft().result():
+                    self.record_results(results)
+        finally:
+            pool.shutdown(cancel_futures=True)
 
     def get_backup_filename(self, input_file):
         # create a backup filename by appending a number to the end of the input file name
@@ -76,69 +284,118 @@ class Media_Sifter:
             backup_number += 1
         return backup_filename
     
-    def add_collision(self, hash, source):
-        if hash in self.hash_collisions:
-            self.hash_collisions[hash].append(source)
+    def index_hash(self, source, hash):
+        # Add a file's hash to the index. If it looks like a picture we already have, record the
+        # collision and return the closest match as (source, distance).
+        if self.report_format == 'sqlite' and self.hasher.threshold == 0:
+            # exact matches can be looked up in the report itself, without every hash in memory
+            matches = [(s, 0) for s in self.report.find_hash(hash) if s != source]
         else:
-            self.hash_collisions[hash] = [self.hasher[hash], source]
+            matches = [m for m in self.hasher.find(hash) if m[0] != source]
+            self.hasher.add(hash, source)
+        if not matches:
+            return None
+        self.add_collision(matches[0][0], source)
+        return matches[0]
+
+    def add_collision(self, original, source):
+        # Files that look like the same picture are gathered into groups, each one keyed on the
+        # first file in it
+        if source in self.collision_groups:
+            return
+        group = self.collision_groups.setdefault(original, original)
+        self.hash_collisions.setdefault(group, [group]).append(source)
+        self.collision_groups[source] = group
 
     def read_report(self, backup=True):
-        # if the report already exists, read its contents, then move it to a numbered backup
-        report = []
-        if os.path.isfile(self.report_filename):
-            logging.info("Media_Sifter : read_report - reading existing report file %s", self.report_filename)
-            with open(self.report_filename) as json_fh:
-                report = json.load(json_fh)
-            for entry in report:
-                if 'source' in entry:
-                    self.report[entry['source']] = entry
-                    if 'hash' in entry and entry['hash'] is not None:
-                        if entry['hash'] in self.hasher:
-                            logging.debug("Media_Sifter : read_report - hash collision %s %s clashes with %s",
-                                             entry['hash'], self.hasher[entry['hash']], entry['source'])
-                            self.add_collision(entry['hash'], entry['source'])
-                        else:    
-                            self.hasher[entry['hash']] = entry['source']
-                    else:
-                        logging.debug("Media_Sifter : read_report - null or missing hash %s",
-                                            entry['source'])
-
-            if backup:
-                # move the report file to a numbered backup
+        # If the report already exists, stream its entries into a hashmap keyed on source. When
+        # we're about to add to it (backup), a legacy JSON array report is converted to one entry
+        # per line, keeping the original as a numbered backup, and a line left half written by
+        # a crash is cut off the end, so that new entries can simply be appended.
+        if self.report_format == 'sqlite':
+            self.read_report_store(backup)
+            return
+        if not os.path.isfile(self.report_filename):
+            return
+        logging.info("Media_Sifter : read_report - reading existing report file %s", self.report_filename)
+        for entry in read_report_entries(self.report_filename):
+            if 'source' in entry:
+                self.report[entry['source']] = entry
+                if 'hash' in entry and entry['hash'] is not None:
+                    match = self.index_hash(entry['source'], entry['hash'])
+                    if match:
+                        logging.debug("Media_Sifter : read_report - hash collision %s %s clashes with %s (%d bits apart)",
+                                         entry['hash'], match[0], entry['source'], match[1])
+                else:
+                    logging.debug("Media_Sifter : read_report - null or missing hash %s",
+                                        entry['source'])
+
+        if backup:
+            if is_legacy_report(self.report_filename):
                 backup_filename = self.get_backup_filename(self.report_filename)
-                logging.info("Media_Sifter : read_report - backing up existing report file %s", backup_filename)
-                os.rename(self.report_filename, backup_filename)        
-    
+                logging.info("Media_Sifter : read_report - converting legacy report file, original kept as %s", backup_filename)
+                os.rename(self.report_filename, backup_filename)
+                convert_legacy_report(backup_filename, self.report_filename)
+            elif trim_partial_line(self.report_filename):
+                logging.warning("Media_Sifter : read_report - removed truncated last line from report file")
+
+    def read_report_store(self, backup=True):
+        # A sqlite report is used where it is, so there's nothing to load, except that finding
+        # near matches while scanning needs every hash in the index
+        self.report.open()
+        logging.info("Media_Sifter : read_report_store - %d entries in report database %s",
+                     len(self.report), self.report_filename)
+        if backup and self.hasher.threshold > 0:
+            for source, hash in self.report.hashes():
+                self.index_hash(source, hash)
+
     def sift_media(self):
         # If the report file already exists, read the contents into a hashmap using the source element as the key.
         # Then use this hashmap to skip files already processed.
         self.read_report()
 
-        # Open report file as a json for writing - append mode
-        with open(self.report_filename, 'a') as self.json_fh:
-            self.json_fh.write('[\n')
-            if len(self.report) != 0:
-                # if the report file already exists, we need to write out all the existing report entries
-                logging.debug("Media_Sifter : sift_media - writing existing report entries")
-                for entry in self.report:
-                    self.json_fh.write(json.dumps(self.report[entry], default=str)+', \n')  
-                self.json_fh.flush()
-            # recurse over all subdirectories
-            try:
-                for search_path in glob.iglob(self.input_folder + '/**', recursive=True):
-                    if os.path.isdir(search_path): # filter dirs
-                        self.current_folder = search_path
-                        self.sift_media_in_subfolder()
-            except JSONMapperFatalException as e:
-                logging.error("Media_Sifter : sift_media - fatal exception in json mapper to investigate %s", e)
-                logging.error(traceback.format_exc())
-            except KeyboardInterrupt:
-                logging.error("Media_Sifter : sift_media - Keyboard Interrupt - stopping")
-            except Exception as e:
-                logging.error("Media_Sifter : sift_media - other exception %s", e)
-                logging.error(traceback.format_exc())
-            # Make sure to properly close the json file
-            self.json_fh.write('{}]\n')
+        if self.report_format == 'sqlite':
+            with self.report:
+                self.sift_folders()
+        else:
+            # Open report file for writing one json entry per line - append mode, so the entries
+            # already there are left alone
+            with open(self.report_filename, 'a') as self.json_fh:
+                self.sift_folders()
+            self.json_fh = None
+
+    def sift_folders(self):
+        # recurse over all subdirectories, either one at a time sharing one exiftool process for
+        # the whole run, or spread over a pool of worker processes which have one each
+        try:
+            folders = walk_folders(self.input_folder)
+            if self.dedupe:
+                folders = self.find_duplicates(folders)
+            if self.workers > 1:
+                self.sift_media_in_parallel(folders)
+            else:
+                if self.threads > 1:
+                    self.thread_pool = ThreadPoolExecutor(max_workers=self.threads)
+                with self.exif_session:
+                    for folder, entries in folders:
+                        self.sift_media_in_subfolder(folder, entries)
+            if self.metadata_cache:
+                # we've seen everything, so forget about any files that have gone away
+                self.metadata_cache.evict_missing()
+        except JSONMapperFatalException as e:
+            logging.error("Media_Sifter : sift_folders - fatal exception in json mapper to investigate %s", e)
+            logging.error(traceback.format_exc())
+        except KeyboardInterrupt:
+            logging.error("Media_Sifter : sift_folders - Keyboard Interrupt - stopping")
+        except Exception as e:
+            logging.error("Media_Sifter : sift_folders - other exception %s", e)
+            logging.error(traceback.format_exc())
+        finally:
+            if self.thread_pool:
+                self.thread_pool.shutdown(cancel_futures=True)
+                self.thread_pool = None
+            if self.metadata_cache:
+                self.metadata_cache.close()
 
     def clean_destinations(self, destinations):
         # Given a set of destinations [a, b, c, d] see if the set can be simplified by removing
@@ -176,6 +433,40 @@ class Media_Sifter:
             logging.info("Media_Sifter : clean_destinations - destinations %s not cleaned", destinations)
             return destinations
 
+    def find_hash_clusters(self):
+        # Group every hashed file in the report into clusters that look like the same picture,
+        # comparing all the hashes at once rather than one by one as they were found. The hash
+        # index already holds every hash in the report, packed ready for this. Each cluster is
+        # keyed on the first file in it, as hash_collisions are.
+        if self.report_format == 'sqlite':
+            # a sqlite report can group exact matches itself, and only needs to hand out the
+            # packed hashes for near ones
+            if self.hasher.threshold == 0:
+                return {group[0]: group for group in self.report.hash_groups()}
+            ids, packed = self.report.packed_hashes()
+            clusters = find_clusters(packed, self.hasher.threshold)
+            return {self.report.source_of(ids[c[0]]): [self.report.source_of(ids[row]) for row in c] for c in clusters}
+        sources = self.hasher.sources
+        if self.hasher.threshold == 0:
+            # exact matches only need grouping, not every pair comparing
+            groups = {}
+            for source, packed in zip(sources, self.hasher.packed()):
+                groups.setdefault(packed.tobytes(), []).append(source)
+            return {group[0]: group for group in groups.values() if len(group) > 1}
+        clusters = find_clusters(self.hasher.packed(), self.hasher.threshold)
+        return {sources[c[0]]: [sources[row] for row in c] for c in clusters}
+
+    def destination_collisions(self):
+        # Every destination proposed for more than one file, as (destination, [(source, hash), ...])
+        # with the sources in report order
+        if self.report_format == 'sqlite':
+            return self.report.destination_collisions()
+        destinations = {}
+        for source, entry in self.report.items():
+            if entry.get('destination') is not None:
+                destinations.setdefault(entry['destination'], []).append((source, entry['hash']))
+        return [(destination, sources) for destination, sources in destinations.items() if len(sources) > 1]
+
     def analyse_report(self):
         # Analyse the generated report and look for inconsistencies or anything that needs 
         # addressing
@@ -183,37 +474,33 @@ class Media_Sifter:
         # Read the report but don't back it up as we're not making changes
         self.read_report(backup=False)
 
-        # Loop through all the entries in the report
-        destination_lookup = {}
-        for entry in self.report:
-            # Check 1. Are there multiple output files with same filename?
-            destination = self.report[entry]['destination']
-            if destination in destination_lookup:
-                # Two entries in the report, from two different sources, have the same destination
-                # Now check if they have the same hash
-                if self.report[entry]['hash'] == self.report[destination_lookup[destination]]['hash']:
+        # Check 1. Are there multiple output files with same filename?
+        for destination, sources in self.destination_collisions():
+            # Two or more entries in the report, from different sources, have the same destination
+            # Now check if they have the same hash as the first, or near enough
+            first_source, first_hash = sources[0]
+            for source, hash in sources[1:]:
+                if self.hasher.matches(hash, first_hash):
                     # This is fine - same hash, same photo, we should be able to discard one
                     pass
                 else:
                     # We have entries with different hashes that clash on the destination filename
                     # We will update the report output name to disambiguate them
                     logging.warning("Media_Sifter : analyse_report - destination collision %s %s clashes with %s",
-                                    destination, destination_lookup[destination], entry)
-            else:
-                destination_lookup[destination] = self.report[entry]['source']
-            
-            # Check 2. for date inconsistencies - e.g. one particular camera with date set wrong
-            # Compare exif date, filename date, folder year and json date
-            # Check that the chosen preferred date is the right one
-            pass # todo
-
-            # Check 3. if there is exif data that needs updating
-            # GPS, date
-            pass # todo
-
-        # Check 4. and loop through all hash collisions
-        for hash in self.hash_collisions:
-            destinations = [self.report[s]['destination'] for s in self.hash_collisions[hash]]
+                                    destination, first_source, source)
+
+        # Check 2. for date inconsistencies - e.g. one particular camera with date set wrong
+        # Compare exif date, filename date, folder year and json date
+        # Check that the chosen preferred date is the right one
+        pass # todo
+
+        # Check 3. if there is exif data that needs updating
+        # GPS, date
+        pass # todo
+
+        # Check 4. and loop through all clusters of files with the same, or near enough, hash
+        for group, sources in self.find_hash_clusters().items():
+            destinations = [self.report[s]['destination'] for s in sources]
             destinations = self.clean_destinations(destinations)
             # Do they all have the same output filename?
             if len(set(destinations)) == 1:
@@ -227,28 +514,62 @@ class Media_Sifter:
                 pass # todo
 
     def enact_report(self):
-        # Use the hashmap report to actually copy and update files to their new destination
-        for source in self.report:
-            logging.debug("Media_Sifter : enact_report - %s", source)
-            if 'destination' in self.report[source]:
-                destination = self.report[source]['destination']
-                if os.path.isfile(source):
-                    # if the source file exists, copy it to the destination
-                    # check if the destination file exists
-                    if os.path.isfile(destination):
-                        # - <maybe> If the file already exists, do a simplistic check to see if it is the same file contents
-                        # - if the destination file exists, check if it is the same file contents
-                        # - if the destination file exists and is different, rename it to a numbered backup
-                        logging.warning("Media_Sifter : enact_report - destination file %s exists", destination)
-                        pass
-                    else:
-                        # Copy the file from source to destination, creating any missing folders in the path
-                        logging.info("Media_Sifter : enact_report - copying %s to %s", source, destination)
-                        os.makedirs(os.path.dirname(destination), exist_ok=True)
-                        shutil.copy(source, destination)                        
-                        
-                        # Update the file modification timestamp
-                        os.utime(destination, (self.report[source]['preferred_ts'], self.report[source]['preferred_ts']))
+        # Use the hashmap report to actually copy and update files to their new destination,
+        # several at a time, keeping a journal next to the report of the copies made so far.
+        # Files with the same contents as another are only copied once, and then the others
+        # are linked to that copy or left out, unless we've been asked to copy them all. When
+        # verifying, the results go in a manifest next to the report too.
+        self.read_report(backup=False)
+        originals = self.content_originals() if self.enact_duplicates != 'copy' else {}
+        links = []
+        content_hashes = {}
+        manifest_filename = self.report_filename + '.verify' if self.enact_verify else None
+        with Copy_Engine(self.report_filename + '.journal', self.copy_workers, self.enact_mode,
+                         self.enact_duplicates, self.enact_order, manifest_filename) as engine:
+            engine.copy_all(self.report_copies(originals, links, content_hashes), content_hashes)
+            engine.link_all(links)
 
         # - <todo> Update missing exif data if needed
         pass
+
+    def content_originals(self):
+        # The first file with the same contents as each file in the report that has a copy. A
+        # scan with dedupe has already worked this out, otherwise it's worked out now.
+        originals = {}
+        source_files = []
+        content_hashes = False
+        for source in self.report:
+            entry = self.report[source]
+            content_hashes = content_hashes or 'content_hash' in entry
+            if entry.get('duplicate_of'):
+                originals[source] = entry['duplicate_of']
+            elif not content_hashes:
+                try:
+                    source_files.append((source, os.stat(source)))
+                except OSError as e:
+                    logging.warning("Media_Sifter : content_originals - can't stat %s - %s", source, e)
+        if not content_hashes:
+            logging.info("Media_Sifter : content_originals - report has no content hashes, looking for copies")
+            duplicates = find_duplicates(source_files)
+            originals = {f: d['duplicate_of'] for f, d in duplicates.items() if d['duplicate_of']}
+        return originals
+
+    def report_copies(self, originals=None, links=None, content_hashes=None):
+        # (source, destination, preferred_ts) for each file in the report to be copied. Files
+        # that are copies of another file in originals are added to links instead, as
+        # (source, destination, preferred_ts, original, original destination). The content hashes found
+        # by a scan with dedupe are added to content_hashes, to verify the copies against.
+        originals = originals or {}
+        for source in self.report:
+            entry = self.report[source]
+            logging.debug("Media_Sifter : report_copies - %s", source)
+            if 'destination' not in entry:
+                continue
+            if content_hashes is not None and entry.get('content_hash'):
+                content_hashes[source] = entry['content_hash']
+            original = self.report.get(originals[source]) if source in originals else None
+            if original and original.get('destination') and links is not None:
+                links.append((source, entry['destination'], entry.get('preferred_ts'), originals[source],
+                              original['destination']))
+            else:
+                yield source, entry['destination'], entry.get('preferred_ts')
@@ -0,0 +1,138 @@
+import os
+import pickle
+import sqlite3
+import hashlib
+import logging
+import threading
+
+class Metadata_Cache:
+    '''
+        Class which keeps a persistent cache of the expensive parts of processing a media file -
+        the exif data and the image hash - so that rescanning a library that has barely changed
+        doesn't have to run exiftool and PIL over every file again. Entries are keyed on a
+        fingerprint of the file (its name, size and modification time, and optionally a hash
+        of its first block) rather than its path, so files that have been moved, or extracted
+        again from a fresh Takeout zip, still hit the cache. The fingerprint also includes the
+        cache version and the hash mode, so entries worked out differently are never served.
+        The cache is a sqlite database, so several worker processes can share it. Writes are
+        held in memory and written in one short transaction a batch at a time, so no process
+        keeps the database locked against the others while it works.
+    '''
+    # Bump this whenever what goes into an entry changes, so older entries miss
+    cache_version = 2
+    commit_every = 500
+    verify_block_size = 65536
+    # how long to wait for another process writing to the cache, in seconds
+    lock_timeout = 60
+
+    def __init__(self, cache_filename, verify=False, hash_mode='full'):
+        self.cache_filename = cache_filename
+        self.verify = verify
+        self.hash_mode = hash_mode
+        self.db = None
+        # fingerprint -> (source, pickled entry), with None for the entry of a hit on a file
+        # that has moved, which only needs its source updating
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.cache_filename, timeout=self.lock_timeout, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS metadata "
+                            "(fingerprint TEXT PRIMARY KEY, source TEXT, entry BLOB)")
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.flush()
+                self.db.close()
+                self.db = None
+
+    def key_prefix(self):
+        return "v{}:{}:".format(self.cache_version, self.hash_mode)
+
+    def fingerprint(self, source, stat):
+        fingerprint = self.key_prefix() + "{}:{}:{}".format(os.path.basename(source), stat.st_size, stat.st_mtime_ns)
+        if self.verify:
+            # guard against files rewritten in place with the same size and timestamp
+            with open(source, 'rb') as f:
+                fingerprint += ":" + hashlib.sha1(f.read(self.verify_block_size)).hexdigest()
+        return fingerprint
+
+    def get(self, source, stat):
+        # Return the cached entry for a file, or None if we haven't seen it before. A hit also
+        # records where the file lives now, so it isn't evicted after a move. Sources are kept
+        # as absolute paths, so a run from another folder doesn't think they have gone.
+        fingerprint = self.fingerprint(source, stat)
+        source = os.path.abspath(source)
+        with self.lock:
+            self.open()
+            pending = self.pending.get(fingerprint)
+            if pending and pending[1] is not None:
+                row = pending
+            else:
+                row = self.db.execute("SELECT source, entry FROM metadata WHERE fingerprint=?",
+                                      (fingerprint,)).fetchone()
+                if row is None:
+                    return None
+            if row[0] != source:
+                # an entry still to be written moves along with the file, and one already written
+                # only needs its source updating
+                self.write_soon(fingerprint, source, pending[1] if pending else None)
+        logging.debug("Metadata_Cache : get - cache hit %s", source)
+        return pickle.loads(row[1])
+
+    def put(self, source, stat, entry):
+        fingerprint = self.fingerprint(source, stat)
+        with self.lock:
+            self.open()
+            self.write_soon(fingerprint, os.path.abspath(source), pickle.dumps(entry))
+
+    def commit(self):
+        with self.lock:
+            if self.db is not None:
+                self.flush()
+
+    def write_soon(self, fingerprint, source, entry):
+        # write in batches - committing every write would make the cache slower than exiftool
+        self.pending[fingerprint] = (source, entry)
+        if len(self.pending) >= self.commit_every:
+            self.flush()
+
+    def flush(self):
+        # Write everything pending in one transaction, which is the only time the database is
+        # locked against other processes writing to it
+        if not self.pending:
+            return
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO metadata (fingerprint, source, entry) VALUES (?, ?, ?)",
+                                [(fingerprint, source, entry) for fingerprint, (source, entry) in self.pending.items()
+                                 if entry is not None])
+            self.db.executemany("UPDATE metadata SET source=? WHERE fingerprint=?",
+                                [(source, fingerprint) for fingerprint, (source, entry) in self.pending.items()
+                                 if entry is None])
+        self.pending = {}
+
+    def evict_missing(self):
+        # Remove the entries for files that no longer exist where we last saw them, and any left
+        # by an older version of the cache, which can never be hit again
+        with self.lock:
+            self.open()
+            self.flush()
+            prefix = "v{}:".format(self.cache_version)
+            missing = [(fingerprint,) for fingerprint, source in
+                       self.db.execute("SELECT fingerprint, source FROM metadata")
+                       if not fingerprint.startswith(prefix) or not os.path.isfile(source)]
+            with self.db:
+                self.db.executemany("DELETE FROM metadata WHERE fingerprint=?", missing)
+        logging.info("Metadata_Cache : evict_missing - removed %d entries for missing files", len(missing))
+        return len(missing)
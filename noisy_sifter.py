@@ -7,41 +7,91 @@ from pillow_heif import register_heif_opener
 from media_sifter import Media_Sifter
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(
-    handlers=[
-        logging.handlers.RotatingFileHandler('noisy_sifter.log', maxBytes=75000000, backupCount=10),
-        logging.StreamHandler()
-    ],
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    level=logging.DEBUG
-)
-# Allow PIL to open HEIC files
-register_heif_opener()
 
-parser = argparse.ArgumentParser(
-                    prog='takeout_fixer_sifter',
-                    description='Sort photos and videos into subfolders by exif data and modification time ',
-                    epilog='Text at the bottom of help')
-parser.add_argument('infolder')           # positional argument
-parser.add_argument('outfolder')           # positional argument
-parser.add_argument('report')
-parser.add_argument('-s', '--scan', action='store_true') 
-parser.add_argument('-a', '--analyse', action='store_true') 
-parser.add_argument('-d', '--debug', action='store_true') 
-args = parser.parse_args()
-if args.debug:
-    logging.getLogger().setLevel(logging.DEBUG)
-else:
-    logging.getLogger().setLevel(logging.INFO)
+def main():
+    # Worker processes for --workers import this file afresh when they aren't forked, so
+    # nothing runs unless it is the script being run
+    logging.basicConfig(
+        handlers=[
+            logging.handlers.RotatingFileHandler('noisy_sifter.log', maxBytes=75000000, backupCount=10),
+            logging.StreamHandler()
+        ],
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        level=logging.DEBUG
+    )
+    # Allow PIL to open HEIC files
+    register_heif_opener()
 
-sifter = Media_Sifter(args.infolder, args.outfolder, args.report)
-if args.scan:
-    sifter.sift_media()
-elif args.analyse:
-    sifter.analyse_report()
-elif args.copyfiles:
-    sifter.enact_report()
-else:
-    logging.error("Noisy_Sifter : no action specified : "
-                  "use --scan to sift media, --analyse to check an existing report or "
-                  "--copyfiles to actually copy files to output folder")
+    parser = argparse.ArgumentParser(
+                        prog='takeout_fixer_sifter',
+                        description='Sort photos and videos into subfolders by exif data and modification time ',
+                        epilog='Text at the bottom of help')
+    parser.add_argument('infolder')           # positional argument
+    parser.add_argument('outfolder')           # positional argument
+    parser.add_argument('report')
+    parser.add_argument('-s', '--scan', action='store_true') 
+    parser.add_argument('-a', '--analyse', action='store_true') 
+    parser.add_argument('-c', '--copyfiles', action='store_true',
+                        help='copy files to the output folder as the report proposes')
+    parser.add_argument('-d', '--debug', action='store_true') 
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of worker processes to scan folders with')
+    parser.add_argument('-t', '--threads', type=int, default=1,
+                        help='number of threads per process to read media files with')
+    parser.add_argument('--cache',
+                        help='metadata cache file, so unchanged files are not processed again on a rescan')
+    parser.add_argument('--cache-verify', action='store_true',
+                        help='also check the first block of each file before trusting the metadata cache')
+    parser.add_argument('--dedupe', action='store_true',
+                        help='find exact copies of files first, and only read the metadata of one copy')
+    parser.add_argument('--hash-mode', choices=['full', 'fast', 'validate'], default='full',
+                        help='hash whole images, hash reduced images (much faster), or do both and '
+                             'warn where they differ')
+    parser.add_argument('--hash-threshold', type=int, default=0,
+                        help='how many bits two image hashes can differ by and still count as the same picture')
+    parser.add_argument('--multi-hash', action='store_true',
+                        help='store a difference, average and colour hash for each image as well as the perceptual hash')
+    parser.add_argument('--report-format', choices=['json', 'sqlite'], default='json',
+                        help='write the report as json lines, or keep it in a sqlite database for libraries '
+                             'too big to analyse in memory')
+    parser.add_argument('--copy-workers', type=int, default=4,
+                        help='number of files to copy at once with --copyfiles, in report order')
+    parser.add_argument('--enact-mode', choices=['copy', 'hardlink', 'reflink'], default='copy',
+                        help='copy files to the output folder, or hardlink or reflink them where the output is on '
+                             'the same filesystem (hardlinks keep the timestamp of the source file)')
+    parser.add_argument('--enact-duplicates', choices=['copy', 'hardlink', 'symlink', 'skip'], default='copy',
+                        help='copy every file with the same contents as another, or copy one of them and hardlink '
+                             'or relatively symlink the rest to it, or leave the rest out')
+    parser.add_argument('--enact-order', choices=['report', 'source', 'destination'], default='report',
+                        help='copy files in report order, in order of where they are on the source disk, or by '
+                             'destination folder and then where they are on the source disk - both of which '
+                             'copy one file at a time, so the disk reads them in that order')
+    parser.add_argument('--verify', action='store_true',
+                        help='check every copy, and any file already at a destination, against its source '
+                             'and write the results to a manifest next to the report')
+    args = parser.parse_args()
+    if args.debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+    else:
+        logging.getLogger().setLevel(logging.INFO)
+
+    sifter = Media_Sifter(args.infolder, args.outfolder, args.report, workers=args.workers,
+                          threads=args.threads, cache_filename=args.cache, cache_verify=args.cache_verify,
+                          dedupe=args.dedupe, hash_mode=args.hash_mode,
+                          hash_threshold=args.hash_threshold, multi_hash=args.multi_hash,
+                          report_format=args.report_format, copy_workers=args.copy_workers,
+                          enact_mode=args.enact_mode, enact_duplicates=args.enact_duplicates,
+                          enact_order=args.enact_order, enact_verify=args.verify)
+    if args.scan:
+        sifter.sift_media()
+    elif args.analyse:
+        sifter.analyse_report()
+    elif args.copyfiles:
+        sifter.enact_report()
+    else:
+        logging.error("Noisy_Sifter : no action specified : "
+                      "use --scan to sift media, --analyse to check an existing report or "
+                      "--copyfiles to actually copy files to output folder")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+import os
+import re
+import struct
+import datetime
+import logging
+
+# QuickTime times are seconds since the start of 1904
+quicktime_epoch = datetime.datetime(1904, 1, 1, 0, 0, 0, 0)
+# Header atoms we'll read into memory to pick through, larger ones are skipped
+max_header_atom_size = 65536
+
+def read_atoms(data, start=0, end=None):
+    # Yield (type, body) for each atom in a block of QuickTime/MP4 data
+    end = len(data) if end is None else end
+    offset = start
+    while offset + 8 <= end:
+        size, atom_type = struct.unpack('>I4s', data[offset:offset + 8])
+        header = 8
+        if size == 1:
+            if offset + 16 > end:
+                return
+            size = struct.unpack('>Q', data[offset + 8:offset + 16])[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header or offset + size > end:
+            return
+        yield atom_type, data[offset + header:offset + size]
+        offset += size
+
+def read_file_atoms(f, start, end):
+    # Yield (type, body offset, body size) for each atom between two offsets in an open file,
+    # reading only the atom headers, so we can skip over the (huge) media data
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        header = f.read(16)
+        if len(header) < 8:
+            return
+        size, atom_type = struct.unpack('>I4s', header[:8])
+        header_size = 8
+        if size == 1:
+            if len(header) < 16:
+                return
+            size = struct.unpack('>Q', header[8:16])[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size:
+            return
+        yield atom_type, offset + header_size, size - header_size
+        offset += size
+
+def find_top_level_atom(f, file_size, wanted):
+    # the offset and size of the body of the first top level atom of a type, or None
+    for atom_type, offset, size in read_file_atoms(f, 0, file_size):
+        if atom_type == wanted:
+            return offset, size
+    return None
+
+def parse_iso6709(location):
+    # Locations are stored as ISO 6709 strings like "+51.5072-000.1275+011.000/"
+    m = re.match(r'^([+-]\d+(?:\.\d+)?)([+-]\d+(?:\.\d+)?)', location)
+    if m:
+        return {'latitude': float(m.group(1)), 'longitude': float(m.group(2))}
+    return None
+
+def parse_mvhd(body):
+    # the creation time and duration (in seconds) from the movie header
+    if body[:1] == b'\x01':
+        creation, modification, timescale, duration = struct.unpack('>QQIQ', body[4:32])
+    else:
+        creation, modification, timescale, duration = struct.unpack('>IIII', body[4:20])
+    creation_time = quicktime_epoch + datetime.timedelta(seconds=creation) if creation else None
+    return creation_time, duration / timescale if timescale else None
+
+def parse_udta_location(body):
+    # older QuickTime files, and most cameras, keep the location in a user data xyz atom
+    for atom_type, data in read_atoms(body):
+        if atom_type == b'\xa9xyz':
+            length = struct.unpack('>H', data[:2])[0]
+            return parse_iso6709(data[4:4 + length].decode('latin-1'))
+    return None
+
+def parse_meta_location(body):
+    # iPhones keep it in the metadata item list, under a key named in a separate keys atom
+    # The meta atom is a full atom in MP4 files, with a version and flags in front
+    start = 0 if body[4:8] == b'hdlr' else 4
+    keys = []
+    items = {}
+    for atom_type, data in read_atoms(body, start):
+        if atom_type == b'keys':
+            for key_type, name in read_atoms(data, 8):
+                keys.append(name.decode('latin-1'))
+        elif atom_type == b'ilst':
+            for index, item in read_atoms(data):
+                for data_type, value in read_atoms(item):
+                    if data_type == b'data':
+                        items[struct.unpack('>I', index)[0]] = value[8:]
+    for index, key in enumerate(keys, 1):
+        if key == 'com.apple.quicktime.location.ISO6709' and index in items:
+            return parse_iso6709(items[index].decode('latin-1'))
+    return None
+
+def read_quicktime_metadata(filename):
+    # Read the creation time, duration and location of a QuickTime/MP4 video straight from its
+    # movie header, seeking from atom to atom so that only a few KB are read, wherever the
+    # movie header is in the file. Returns None if we can't find a movie header, so the caller
+    # can fall back to exiftool.
+    with open(filename, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        moov = find_top_level_atom(f, file_size, b'moov')
+        if moov is None:
+            return None
+        metadata = {'creation_time': None, 'duration': None, 'geodata': None}
+        found_header = False
+        for atom_type, offset, size in read_file_atoms(f, moov[0], moov[0] + moov[1]):
+            if atom_type not in (b'mvhd', b'udta', b'meta') or size > max_header_atom_size:
+                continue
+            f.seek(offset)
+            body = f.read(size)
+            try:
+                if atom_type == b'mvhd':
+                    metadata['creation_time'], metadata['duration'] = parse_mvhd(body)
+                    found_header = True
+                elif atom_type == b'udta':
+                    metadata['geodata'] = metadata['geodata'] or parse_udta_location(body)
+                else:
+                    metadata['geodata'] = metadata['geodata'] or parse_meta_location(body)
+            except (struct.error, UnicodeDecodeError, ValueError) as e:
+                logging.warning("read_quicktime_metadata - can't read %s atom in %s - %s", atom_type, filename, e)
+    if not found_header:
+        return None
+    return metadata
@@ -0,0 +1,139 @@
+import os
+import struct
+import logging
+
+# Sizes of the TIFF field types, for working out whether a value fits in its IFD entry
+tiff_type_sizes = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 13: 4}
+tiff_type_formats = {1: 'B', 3: 'H', 4: 'I', 6: 'b', 8: 'h', 9: 'i', 13: 'I'}
+# The TIFF tags that lead us to JPEG previews
+tag_new_subfile_type = 0x00FE
+tag_compression = 0x0103
+tag_strip_offsets = 0x0111
+tag_strip_byte_counts = 0x0117
+tag_sub_ifds = 0x014A
+tag_jpeg_offset = 0x0201
+tag_jpeg_length = 0x0202
+# Give up on files with silly numbers of IFDs, which are probably broken
+max_ifds = 32
+# Photoshop keeps a JPEG thumbnail in its image resources, under one of these ids
+psd_thumbnail_resources = (1036, 1033)
+
+def is_decodable_jpeg(data):
+    # PIL can decode baseline and progressive JPEGs, but not the lossless JPEG that raw image
+    # data is sometimes compressed with, so look at the start of frame marker to tell them apart
+    if data[:2] != b'\xff\xd8':
+        return False
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != 0xFF:
+            return False
+        marker = data[offset + 1]
+        if marker == 0xFF:
+            offset += 1
+            continue
+        if marker in (0xC0, 0xC1, 0xC2):
+            return True
+        if 0xC3 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            return False
+        offset += 2 + struct.unpack('>H', data[offset + 2:offset + 4])[0]
+    return False
+
+def read_ifd(f, offset, byte_order):
+    # Read the entries of one IFD into a dictionary of tag to list of values, keeping only the
+    # integer ones we need, and return it with the offset of the next IFD
+    f.seek(offset)
+    count = struct.unpack(byte_order + 'H', f.read(2))[0]
+    data = f.read(count * 12 + 4)
+    entries = {}
+    for i in range(count):
+        tag, field_type, value_count, value = struct.unpack(byte_order + 'HHI4s', data[i * 12:i * 12 + 12])
+        if field_type not in tiff_type_formats or value_count > 1024:
+            continue
+        size = tiff_type_sizes[field_type] * value_count
+        if size > 4:
+            here = f.tell()
+            f.seek(struct.unpack(byte_order + 'I', value)[0])
+            value = f.read(size)
+            f.seek(here)
+        entries[tag] = list(struct.unpack(byte_order + tiff_type_formats[field_type] * value_count, value[:size]))
+    next_ifd = struct.unpack(byte_order + 'I', data[count * 12:count * 12 + 4])[0]
+    return entries, next_ifd
+
+def tiff_preview_candidates(f):
+    # Walk every IFD in a TIFF based raw file (NEF, DNG, PEF), following both the chain of IFDs
+    # and any sub IFDs, and list the (offset, length) of every JPEG stored in them
+    header = f.read(8)
+    byte_order = {b'II': '<', b'MM': '>'}.get(header[:2])
+    if byte_order is None or struct.unpack(byte_order + 'H', header[2:4])[0] != 42:
+        return []
+    candidates = []
+    pending = [struct.unpack(byte_order + 'I', header[4:8])[0]]
+    seen = set()
+    while pending and len(seen) < max_ifds:
+        offset = pending.pop(0)
+        if offset == 0 or offset in seen:
+            continue
+        seen.add(offset)
+        entries, next_ifd = read_ifd(f, offset, byte_order)
+        pending.append(next_ifd)
+        pending.extend(entries.get(tag_sub_ifds, []))
+        if tag_jpeg_offset in entries and tag_jpeg_length in entries:
+            candidates.append((entries[tag_jpeg_offset][0], entries[tag_jpeg_length][0]))
+        elif (entries.get(tag_compression) in ([6], [7]) and entries.get(tag_new_subfile_type) != [0]
+              and len(entries.get(tag_strip_offsets, [])) == 1 and len(entries.get(tag_strip_byte_counts, [])) == 1):
+            # a JPEG stored as a single strip, which is how DNG keeps its previews - the main
+            # image (subfile type 0) is raw data even when it's JPEG compressed
+            candidates.append((entries[tag_strip_offsets][0], entries[tag_strip_byte_counts][0]))
+    return candidates
+
+def tiff_preview(f, file_size):
+    # the biggest JPEG preview in a TIFF based raw file that PIL can decode
+    for offset, length in sorted(tiff_preview_candidates(f), key=lambda c: c[1], reverse=True):
+        if length == 0 or offset + length > file_size:
+            continue
+        f.seek(offset)
+        data = f.read(length)
+        if is_decodable_jpeg(data):
+            return data
+    return None
+
+def psd_preview(f):
+    # Photoshop files keep a JPEG thumbnail in the image resources section, after the header
+    # and the colour mode data
+    header = f.read(26)
+    if header[:4] != b'8BPS':
+        return None
+    colour_mode_length = struct.unpack('>I', f.read(4))[0]
+    f.seek(colour_mode_length, os.SEEK_CUR)
+    resources_length = struct.unpack('>I', f.read(4))[0]
+    resources = f.read(resources_length)
+    offset = 0
+    thumbnails = {}
+    while offset + 12 <= len(resources) and resources[offset:offset + 4] == b'8BIM':
+        resource_id, name_length = struct.unpack('>HB', resources[offset + 4:offset + 7])
+        # the name is a pascal string padded to an even length, length byte included
+        offset += 6 + ((name_length + 2) & ~1)
+        size = struct.unpack('>I', resources[offset:offset + 4])[0]
+        data = resources[offset + 4:offset + 4 + size]
+        offset += 4 + ((size + 1) & ~1)
+        if resource_id in psd_thumbnail_resources and len(data) > 28:
+            # a 28 byte header, then the JPEG
+            thumbnails[resource_id] = data[28:]
+    for resource_id in psd_thumbnail_resources:
+        if resource_id in thumbnails and is_decodable_jpeg(thumbnails[resource_id]):
+            return thumbnails[resource_id]
+    return None
+
+def extract_preview(filename):
+    # Return the bytes of the JPEG preview embedded in a raw or Photoshop file, without decoding
+    # the raw data itself, or None if there isn't one we can use
+    with open(filename, 'rb') as f:
+        try:
+            if os.path.splitext(filename)[1].lower() == '.psd':
+                preview = psd_preview(f)
+            else:
+                preview = tiff_preview(f, os.fstat(f.fileno()).st_size)
+        except struct.error as e:
+            logging.warning("extract_preview - can't read the structure of %s - %s", filename, e)
+            return None
+    return preview
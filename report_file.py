@@ -0,0 +1,78 @@
+import os
+import json
+import datetime
+import logging
+
+# Reports are written one JSON entry per line, so a resumed scan only has to append to them.
+# Older reports were a single JSON array - an opening '[' line, one entry per line followed by
+# a comma, and a '{}]' line to close it - which can still be read, and converted.
+legacy_report_lines = {b'[', b'{}]', b''}
+# The end of a report is searched backwards for its last complete line this much at a time
+tail_block_size = 65536
+
+def restore_datetimes(section):
+    # Datetimes go into a report as strings, so turn the ones in a section of an entry read back
+    # from a report, such as its exif data, back into datetimes
+    return {key: datetime.datetime.fromisoformat(value) if key.startswith('datetime_') and isinstance(value, str)
+            else value for key, value in section.items()}
+
+def is_legacy_report(filename):
+    # whether a report is the old JSON array format, going by its first non blank character
+    with open(filename, 'rb') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                return line.startswith(b'[')
+    return False
+
+def read_report_entries(filename):
+    # Stream the entries of a report a line at a time, so the whole report is never held as
+    # one JSON document. Both formats are read the same way, as the legacy format has one
+    # entry per line too. A final line with no newline on the end was cut short by a crash,
+    # so it is left out, along with any line that isn't valid JSON.
+    with open(filename, 'rb') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.endswith(b'\n'):
+                logging.warning("read_report_entries - ignoring truncated last line %d in %s", line_number, filename)
+                return
+            line = line.strip().rstrip(b',').rstrip()
+            if line in legacy_report_lines:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                logging.warning("read_report_entries - ignoring unreadable line %d in %s - %s", line_number, filename, e)
+
+def complete_length(filename):
+    # The length of a report up to the end of its last complete line, which is where appending
+    # should carry on from. Anything after that is a line cut short by a crash.
+    with open(filename, 'rb') as f:
+        position = f.seek(0, os.SEEK_END)
+        while position > 0:
+            start = max(0, position - tail_block_size)
+            f.seek(start)
+            newline = f.read(position - start).rfind(b'\n')
+            if newline >= 0:
+                return start + newline + 1
+            position = start
+    return 0
+
+def trim_partial_line(filename):
+    # Cut a line left half written by a crash off the end of a report, so that new entries can
+    # be appended after the last complete one. Returns whether there was one.
+    length = complete_length(filename)
+    if length < os.path.getsize(filename):
+        os.truncate(filename, length)
+        return True
+    return False
+
+def convert_legacy_report(filename, output_filename):
+    # Write the entries of a legacy JSON array report out again as one entry per line
+    count = 0
+    with open(output_filename, 'w') as json_fh:
+        for entry in read_report_entries(filename):
+            if 'source' in entry:
+                json_fh.write(json.dumps(entry, default=str) + '\n')
+                count += 1
+    logging.info("convert_legacy_report - converted %d entries from %s to %s", count, filename, output_filename)
+    return count
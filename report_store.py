@@ -0,0 +1,159 @@
+import json
+import sqlite3
+import itertools
+import threading
+import numpy
+from hash_index import pack_value, hash_value
+
+class Report_Store:
+    '''
+        Class which keeps a report in a sqlite database instead of in memory, for libraries too
+        big to hold the whole report as a dictionary. It behaves like the dictionary of report
+        entries keyed on source that it replaces, so the rest of the sifter doesn't need to know
+        which one it has, and adds indexed queries for the checks that otherwise need every
+        entry in memory at once - the destinations used by more than one file and the files
+        that share a hash. Entries are kept in the order they were first added.
+    '''
+    commit_every = 500
+
+    def __init__(self, report_filename):
+        self.report_filename = report_filename
+        self.db = None
+        self.uncommitted = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.report_filename, timeout=60, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS report "
+                            "(id INTEGER PRIMARY KEY, source TEXT UNIQUE, hash TEXT, destination TEXT, preferred_ts TEXT, entry TEXT)")
+            for column in ('hash', 'destination', 'preferred_ts'):
+                self.db.execute("CREATE INDEX IF NOT EXISTS report_{0} ON report ({0})".format(column))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.commit()
+                self.db.close()
+                self.db = None
+                self.uncommitted = 0
+
+    def commit(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.commit()
+                self.uncommitted = 0
+
+    def commit_soon(self):
+        # commit in batches, as committing every entry would be the slowest part of a scan
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.db.commit()
+            self.uncommitted = 0
+
+    def query(self, sql, parameters=()):
+        with self.lock:
+            self.open()
+            return self.db.execute(sql, parameters).fetchall()
+
+    def __setitem__(self, source, entry):
+        preferred_ts = entry.get('preferred_ts')
+        with self.lock:
+            self.open()
+            # an upsert rather than a replace, so an entry keeps its place in the order
+            self.db.execute("INSERT INTO report (source, hash, destination, preferred_ts, entry) VALUES (?, ?, ?, ?, ?) "
+                            "ON CONFLICT(source) DO UPDATE SET hash=excluded.hash, destination=excluded.destination, "
+                            "preferred_ts=excluded.preferred_ts, entry=excluded.entry",
+                            (source, entry.get('hash'), entry.get('destination'),
+                             str(preferred_ts) if preferred_ts is not None else None,
+                             json.dumps(entry, default=str)))
+            self.commit_soon()
+
+    def get(self, source, default=None):
+        rows = self.query("SELECT entry FROM report WHERE source=?", (source,))
+        return json.loads(rows[0][0]) if rows else default
+
+    def __getitem__(self, source):
+        entry = self.get(source)
+        if entry is None:
+            raise KeyError(source)
+        return entry
+
+    def __contains__(self, source):
+        return bool(self.query("SELECT 1 FROM report WHERE source=?", (source,)))
+
+    def __len__(self):
+        return self.query("SELECT COUNT(*) FROM report")[0][0]
+
+    def rows(self, columns, where='1'):
+        # Yield the id and the given columns of each entry in the order they were added, a batch
+        # at a time, so the whole report is never in memory
+        last = 0
+        while True:
+            rows = self.query("SELECT id, {} FROM report WHERE ({}) AND id>? ORDER BY id LIMIT ?".format(columns, where),
+                              (last, self.commit_every))
+            if not rows:
+                return
+            yield from rows
+            last = rows[-1][0]
+
+    def __iter__(self):
+        for entry_id, source in self.rows('source'):
+            yield source
+
+    def hashes(self):
+        # (source, hash) for every entry with a hash
+        for entry_id, source, hash in self.rows('source, hash', 'hash IS NOT NULL'):
+            yield source, hash
+
+    def find_hash(self, hash):
+        # the sources of every entry with exactly this hash, in the order they were added
+        return [row[0] for row in self.query("SELECT source FROM report WHERE hash=? ORDER BY id", (str(hash),))]
+
+    def grouped(self, column):
+        # Yield (value, [(source, hash), ...]) for every value of a column shared by more than one
+        # entry, in the order each value was first added and then the order of the entries
+        rows = self.query("SELECT report.{0}, report.source, report.hash FROM report JOIN "
+                          "(SELECT {0}, MIN(id) AS first FROM report WHERE {0} IS NOT NULL "
+                          "GROUP BY {0} HAVING COUNT(*) > 1) AS shared ON report.{0} = shared.{0} "
+                          "ORDER BY shared.first, report.id".format(column))
+        for value, group in itertools.groupby(rows, key=lambda row: row[0]):
+            yield value, [(source, hash) for value, source, hash in group]
+
+    def destination_collisions(self):
+        # every destination proposed for more than one file, with the sources and their hashes
+        return self.grouped('destination')
+
+    def hash_groups(self):
+        # the sources of each group of entries with exactly the same hash
+        for hash, group in self.grouped('hash'):
+            yield [source for source, hash in group]
+
+    def packed_hashes(self, hash_bits=256):
+        # Every hash in the report packed into a uint64 matrix, one row per entry as for
+        # Hash_Index, along with the id of each row's entry to look its source up by later.
+        # Only the packed matrix is ever held, not the hashes or their sources.
+        words = hash_bits // 64
+        count = self.query("SELECT COUNT(*) FROM report WHERE hash IS NOT NULL")[0][0]
+        ids = numpy.zeros(count, dtype=numpy.int64)
+        packed = numpy.zeros((count, words), dtype=numpy.uint64)
+        row = 0
+        for entry_id, hash in self.rows('hash', 'hash IS NOT NULL'):
+            if row == count:
+                break
+            ids[row] = entry_id
+            packed[row] = pack_value(hash_value(hash), words)
+            row += 1
+        return ids[:row], packed[:row]
+
+    def source_of(self, entry_id):
+        return self.query("SELECT source FROM report WHERE id=?", (int(entry_id),))[0][0]
@@ -0,0 +1,351 @@
+import os
+import json
+import errno
+import datetime
+import logging
+import pytest
+import copy_engine
+from copy_engine import Copy_Engine
+
+def create_sources(tmp_path, names):
+    for name in names:
+        with open(str(tmp_path / name), 'w') as f:
+            f.write(name)
+    return [str(tmp_path / name) for name in names]
+
+def test_copy_all(tmp_path):
+    a, b, c = create_sources(tmp_path, ["a.jpg", "b.jpg", "c.jpg"])
+    out = tmp_path / "out"
+    copies = [
+        (a, str(out / "2023" / "a.jpg"), '2023-12-01 14:01:23'),
+        (b, str(out / "2023" / "b.jpg"), datetime.datetime(2023, 12, 2, 9, 0, 0)),
+        (c, str(out / "2023" / "a.jpg"), None),           # clashes with a.jpg
+        (str(tmp_path / "gone.jpg"), str(out / "gone.jpg"), None),
+    ]
+    with Copy_Engine(str(tmp_path / "journal"), workers=2) as engine:
+        counts = engine.copy_all(copies)
+    assert counts == {'copied': 2, 'clash': 1, 'missing': 1}
+    with open(str(out / "2023" / "a.jpg")) as f:
+        assert f.read() == "a.jpg"
+    assert os.stat(str(out / "2023" / "a.jpg")).st_mtime == datetime.datetime(2023, 12, 1, 14, 1, 23).timestamp()
+    assert os.stat(str(out / "2023" / "b.jpg")).st_mtime == datetime.datetime(2023, 12, 2, 9, 0, 0).timestamp()
+    assert sorted(os.listdir(str(out / "2023"))) == ["a.jpg", "b.jpg"]
+
+def test_copy_all_resume(tmp_path, monkeypatch):
+    a, b, c = create_sources(tmp_path, ["a.jpg", "b.jpg", "c.jpg"])
+    out = tmp_path / "out"
+    copies = [(a, str(out / "a.jpg"), None), (b, str(out / "b.jpg"), None)]
+    with Copy_Engine(str(tmp_path / "journal")) as engine:
+        engine.copy_all(copies)
+    # a run stopped part way through writing to the journal
+    with open(str(tmp_path / "journal"), 'a') as f:
+        f.write('{"source": "' + c)
+    # files in the journal are skipped without looking at the source or destination again
+    looked_at = []
+    isfile = os.path.isfile
+    def mock_isfile(path):
+        looked_at.append(path)
+        return isfile(path)
+    monkeypatch.setattr(copy_engine.os.path, "isfile", mock_isfile)
+    with Copy_Engine(str(tmp_path / "journal")) as engine:
+        counts = engine.copy_all(copies + [(c, str(out / "c.jpg"), None)])
+    assert counts == {'done': 2, 'copied': 1}
+    assert a not in looked_at and b not in looked_at
+    with open(str(tmp_path / "journal")) as f:
+        assert len(f.read().splitlines()) == 3
+
+def test_kernel_copy_fallback(tmp_path, monkeypatch):
+    a, = create_sources(tmp_path, ["a.jpg"])
+    used = []
+    def unsupported(*args):
+        used.append('copy_file_range')
+        raise OSError(errno.EXDEV, "cross device")
+    monkeypatch.setattr(copy_engine.os, "copy_file_range", unsupported, raising=False)
+    sendfile = os.sendfile
+    def mock_sendfile(*args):
+        used.append('sendfile')
+        return sendfile(*args)
+    monkeypatch.setattr(copy_engine.os, "sendfile", mock_sendfile)
+    copy_engine.kernel_copy(a, str(tmp_path / "b.jpg"))
+    assert used[:2] == ['copy_file_range', 'sendfile']
+    with open(str(tmp_path / "b.jpg")) as f:
+        assert f.read() == "a.jpg"
+
+    # and if neither is possible the file is copied the ordinary way
+    def unsupported_sendfile(*args):
+        raise OSError(errno.EINVAL, "not supported")
+    monkeypatch.setattr(copy_engine.os, "sendfile", unsupported_sendfile)
+    copy_engine.kernel_copy(a, str(tmp_path / "c.jpg"))
+    with open(str(tmp_path / "c.jpg")) as f:
+        assert f.read() == "a.jpg"
+
+def test_kernel_copy_nothing_copied(tmp_path, monkeypatch):
+    # a copy_file_range that copies nothing, as on some filesystems, means trying the next way
+    a, = create_sources(tmp_path, ["a.jpg"])
+    sendfile = os.sendfile
+    monkeypatch.setattr(copy_engine.os, "copy_file_range", lambda *args: 0, raising=False)
+    assert copy_engine.kernel_copy(a, str(tmp_path / "b.jpg")) == 5
+    with open(str(tmp_path / "b.jpg")) as f:
+        assert f.read() == "a.jpg"
+    monkeypatch.setattr(copy_engine.os, "sendfile", lambda *args: 0)
+    assert copy_engine.kernel_copy(a, str(tmp_path / "c.jpg")) == 5
+    with open(str(tmp_path / "c.jpg")) as f:
+        assert f.read() == "a.jpg"
+
+    # but one that stops part way through is an error, not a finished copy
+    monkeypatch.setattr(copy_engine.os, "sendfile", lambda dst, src, offset, count: sendfile(dst, src, offset, 2)
+                        if offset == 0 else 0)
+    with pytest.raises(OSError):
+        copy_engine.kernel_copy(a, str(tmp_path / "d.jpg"))
+    out = tmp_path / "out"
+    with Copy_Engine(str(tmp_path / "journal")) as engine:
+        counts = engine.copy_all([(a, str(out / "d.jpg"), None)])
+    assert counts == {'failed': 1}
+    assert not os.path.exists(str(out / "d.jpg"))
+
+def test_copy_all_hardlink(tmp_path, monkeypatch):
+    a, b = create_sources(tmp_path, ["a.jpg", "b.jpg"])
+    source_mtime = os.stat(a).st_mtime
+    out = tmp_path / "out"
+    with Copy_Engine(str(tmp_path / "journal"), mode='hardlink') as engine:
+        counts = engine.copy_all([(a, str(out / "a.jpg"), '2023-12-01 14:01:23')])
+    assert counts == {'hardlinked': 1}
+    assert os.stat(str(out / "a.jpg")).st_ino == os.stat(a).st_ino
+    # the source keeps its own timestamp
+    assert os.stat(a).st_mtime == source_mtime
+
+    # files that can't be linked, e.g. on another filesystem, are copied
+    def cross_device(source, destination):
+        raise OSError(errno.EXDEV, "cross device")
+    monkeypatch.setattr(copy_engine.os, "link", cross_device)
+    with Copy_Engine(str(tmp_path / "journal"), mode='hardlink') as engine:
+        counts = engine.copy_all([(b, str(out / "b.jpg"), '2023-12-01 14:01:23')])
+    assert counts == {'copied': 1}
+    assert os.stat(str(out / "b.jpg")).st_ino != os.stat(b).st_ino
+    assert os.stat(str(out / "b.jpg")).st_mtime == datetime.datetime(2023, 12, 1, 14, 1, 23).timestamp()
+
+def test_copy_all_reflink(tmp_path, monkeypatch):
+    a, b = create_sources(tmp_path, ["a.jpg", "b.jpg"])
+    out = tmp_path / "out"
+    cloned = []
+    def mock_ioctl(fd, request, arg):
+        assert request == copy_engine.FICLONE
+        cloned.append(fd)
+        os.write(fd, os.pread(arg, 1024, 0))
+    monkeypatch.setattr(copy_engine.fcntl, "ioctl", mock_ioctl)
+    with Copy_Engine(str(tmp_path / "journal"), mode='reflink') as engine:
+        counts = engine.copy_all([(a, str(out / "a.jpg"), None)])
+    assert counts == {'reflinked': 1} and len(cloned) == 1
+    with open(str(out / "a.jpg")) as f:
+        assert f.read() == "a.jpg"
+
+    # a filesystem without reflinks gets a copy
+    def unsupported(fd, request, arg):
+        raise OSError(errno.EOPNOTSUPP, "not supported")
+    monkeypatch.setattr(copy_engine.fcntl, "ioctl", unsupported)
+    with Copy_Engine(str(tmp_path / "journal"), mode='reflink') as engine:
+        counts = engine.copy_all([(b, str(out / "b.jpg"), None)])
+    assert counts == {'copied': 1}
+    with open(str(out / "b.jpg")) as f:
+        assert f.read() == "b.jpg"
+
+@pytest.mark.parametrize("duplicates", ['hardlink', 'symlink', 'skip', 'copy'])
+def test_link_all(tmp_path, duplicates):
+    a, b, c = create_sources(tmp_path, ["a.jpg", "b.jpg", "c.jpg"])
+    out = tmp_path / "out"
+    original = str(out / "2023" / "a.jpg")
+    with Copy_Engine(str(tmp_path / "journal"), duplicates=duplicates) as engine:
+        engine.copy_all([(a, original, None)])
+        # c.jpg's original was never copied, so it gets a copy of its own
+        counts = engine.link_all([(b, str(out / "album" / "b.jpg"), None, a, original),
+                                  (c, str(out / "album" / "c.jpg"), None, c, str(out / "2023" / "gone.jpg"))])
+    status = {'hardlink': 'hardlinked', 'symlink': 'symlinked', 'skip': 'skipped', 'copy': 'copied'}[duplicates]
+    assert counts == ({'copied': 3} if duplicates == 'copy' else {'copied': 2, status: 1})
+    linked = str(out / "album" / "b.jpg")
+    if duplicates == 'skip':
+        assert not os.path.exists(linked)
+    else:
+        with open(linked) as f:
+            assert f.read() == ("b.jpg" if duplicates == 'copy' else "a.jpg")
+    if duplicates == 'hardlink':
+        assert os.stat(linked).st_ino == os.stat(original).st_ino
+    if duplicates == 'symlink':
+        assert os.readlink(linked) == os.path.join("..", "2023", "a.jpg")
+    with open(str(out / "album" / "c.jpg")) as f:
+        assert f.read() == "c.jpg"
+
+@pytest.mark.parametrize("order", ['report', 'source', 'destination'])
+def test_copy_all_order(tmp_path, monkeypatch, caplog, order):
+    caplog.set_level(logging.INFO)
+    sources = create_sources(tmp_path, ["a.jpg", "b.jpg", "c.jpg", "d.jpg"])
+    # pretend the files are on the disk in the opposite order to their names
+    locations = {source: (1, 0, 100 - i) for i, source in enumerate(sources)}
+    monkeypatch.setattr(copy_engine, "source_location", lambda source: locations[source])
+    out = tmp_path / "out"
+    destinations = [str(out / "x" / "a.jpg"), str(out / "y" / "b.jpg"), str(out / "x" / "c.jpg"), str(out / "y" / "d.jpg")]
+    copied = []
+    # a sorted order copies one file at a time however many workers are asked for, so they're
+    # read in that order
+    with Copy_Engine(str(tmp_path / "journal"), workers=1 if order == 'report' else 4, order=order) as engine:
+        assert engine.workers == 1
+        place_file = engine.place_file
+        def mock_place_file(source, destination):
+            copied.append(os.path.basename(source))
+            return place_file(source, destination)
+        engine.place_file = mock_place_file
+        engine.copy_all(zip(sources, destinations, [None] * 4))
+    assert copied == {'report': ["a.jpg", "b.jpg", "c.jpg", "d.jpg"],
+                      'source': ["d.jpg", "c.jpg", "b.jpg", "a.jpg"],
+                      'destination': ["c.jpg", "a.jpg", "d.jpg", "b.jpg"]}[order]
+    assert engine.bytes_copied == 20
+    assert "Copy_Engine : run - {} order, 0.0 MB in".format(order) in caplog.text
+
+def test_source_location(tmp_path):
+    a, = create_sources(tmp_path, ["a.jpg"])
+    device, kind, location = copy_engine.source_location(a)
+    assert device == os.stat(a).st_dev
+    # either where it is on disk, or its inode if the filesystem won't say
+    assert kind == 0 or location == os.stat(a).st_ino
+    assert copy_engine.source_location(str(tmp_path / "gone.jpg")) == (0, 0, 0)
+
+def test_compare_files(tmp_path):
+    a, same, different, short, long = create_sources(tmp_path, ["a.jpg", "same", "different", "short", "long"])
+    for name, contents in (("same", "a.jpg"), ("different", "b.jpg"), ("short", "a.j"), ("long", "a.jpg!")):
+        with open(str(tmp_path / name), 'w') as f:
+            f.write(contents)
+    assert copy_engine.compare_files(a, same) == ('identical', copy_engine.checksum(a))
+    assert copy_engine.compare_files(a, different) == ('different', copy_engine.checksum(different))
+    assert copy_engine.compare_files(a, short) == ('truncated', None)
+    assert copy_engine.compare_files(a, long) == ('different', None)
+    # a known checksum of the source is used rather than reading it again
+    assert copy_engine.compare_files(a, same, copy_engine.checksum(different))[0] == 'different'
+
+def test_copy_all_verify(tmp_path, caplog):
+    a, b, c, d = create_sources(tmp_path, ["a.jpg", "b.jpg", "c.jpg", "d.jpg"])
+    out = tmp_path / "out"
+    os.makedirs(str(out))
+    with open(str(out / "c.jpg"), 'w') as f:
+        f.write("c.j")
+    with open(str(out / "d.jpg"), 'w') as f:
+        f.write("d.jpg")
+    copies = [(a, str(out / "a.jpg"), None), (b, str(out / "b.jpg"), None),
+              (c, str(out / "c.jpg"), None), (d, str(out / "d.jpg"), None)]
+    manifest = str(tmp_path / "manifest")
+    with Copy_Engine(str(tmp_path / "journal"), manifest_filename=manifest) as engine:
+        # b.jpg's checksum from the scan doesn't match, as if it changed since
+        counts = engine.copy_all(copies, {b: copy_engine.checksum(a)})
+    assert counts == {'copied': 1, 'mismatch': 1, 'truncated': 1, 'exists': 1}
+    assert not os.path.exists(str(out / "b.jpg")) and not os.path.exists(str(out / "b.jpg.partial"))
+    with open(manifest) as f:
+        results = {os.path.basename(e['destination']): (e['result'], e['checksum']) for e in map(json.loads, f)}
+    assert results == {
+        'a.jpg': ('identical', copy_engine.checksum(a)),
+        'b.jpg': ('different', copy_engine.checksum(b)),
+        'c.jpg': ('truncated', None),
+        'd.jpg': ('identical', copy_engine.checksum(d)),
+    }
+    # only the files known to be right are done with
+    with open(str(tmp_path / "journal")) as f:
+        assert sorted(os.path.basename(json.loads(line)['destination']) for line in f) == ['a.jpg', 'd.jpg']
+
+def test_copy_all_verify_earlier_run(tmp_path):
+    # verifying after a run that didn't checks what that run copied, and only once
+    a, b = create_sources(tmp_path, ["a.jpg", "b.jpg"])
+    out = tmp_path / "out"
+    copies = [(a, str(out / "a.jpg"), None), (b, str(out / "b.jpg"), None)]
+    with Copy_Engine(str(tmp_path / "journal")) as engine:
+        assert engine.copy_all(copies) == {'copied': 2}
+    with open(str(out / "b.jpg"), 'w') as f:
+        f.write("b.jp")
+    manifest = str(tmp_path / "manifest")
+    with Copy_Engine(str(tmp_path / "journal"), manifest_filename=manifest) as engine:
+        assert engine.copy_all(copies) == {'exists': 1, 'truncated': 1}
+    with open(manifest) as f:
+        assert {os.path.basename(e['destination']): e['result'] for e in map(json.loads, f)} == {
+            'a.jpg': 'identical', 'b.jpg': 'truncated'}
+    with Copy_Engine(str(tmp_path / "journal"), manifest_filename=manifest) as engine:
+        assert engine.copy_all(copies) == {'done': 1, 'truncated': 1}
+    # without verifying, what was done is left alone as before
+    with Copy_Engine(str(tmp_path / "journal")) as engine:
+        assert engine.copy_all(copies) == {'done': 2}
+
+def test_link_all_clash(tmp_path):
+    # a.jpg and b.jpg both want D.jpg, and a.jpg gets it, so c.jpg, a copy of b.jpg, can't be
+    # linked to D.jpg and gets a copy of its own
+    a, b, c = create_sources(tmp_path, ["a.jpg", "b.jpg", "c.jpg"])
+    with open(c, 'w') as f:
+        f.write("b.jpg")
+    out = tmp_path / "out"
+    with Copy_Engine(str(tmp_path / "journal"), duplicates='hardlink') as engine:
+        engine.copy_all([(a, str(out / "D.jpg"), None), (b, str(out / "D.jpg"), None)])
+        counts = engine.link_all([(c, str(out / "E.jpg"), None, b, str(out / "D.jpg"))])
+    assert counts == {'copied': 2, 'clash': 1}
+    with open(str(out / "E.jpg")) as f:
+        assert f.read() == "b.jpg"
+
+    # nor can a destination that was there already, and hasn't been checked
+    with open(str(out / "F.jpg"), 'w') as f:
+        f.write("something else")
+    with Copy_Engine(str(tmp_path / "journal"), duplicates='hardlink') as engine:
+        engine.copy_all([(b, str(out / "F.jpg"), None)])
+        counts = engine.link_all([(c, str(out / "G.jpg"), None, b, str(out / "F.jpg"))])
+    assert counts == {'exists': 1, 'copied': 1}
+    with open(str(out / "G.jpg")) as f:
+        assert f.read() == "b.jpg"
+
+    # but a file with the same content hash as the original is as good as the original
+    with Copy_Engine(str(tmp_path / "journal"), duplicates='hardlink') as engine:
+        engine.copy_all([(b, str(out / "H.jpg"), None)], {b: "same", c: "same", a: "other"})
+        counts = engine.link_all([(a, str(out / "I.jpg"), None, c, str(out / "H.jpg"))])
+    assert counts == {'copied': 1, 'hardlinked': 1}
+    assert os.stat(str(out / "I.jpg")).st_ino == os.stat(str(out / "H.jpg")).st_ino
+
+def test_link_all_same_destination(tmp_path, caplog):
+    # an album copy that is to go to the same place as its original is already there, on the
+    # first run and every one after, and isn't a clash
+    a, b, c = create_sources(tmp_path, ["a.jpg", "b.jpg", "c.jpg"])
+    for name in (b, c):
+        with open(name, 'w') as f:
+            f.write("a.jpg")
+    out = tmp_path / "out"
+    for counts in ({'copied': 2, 'skipped': 2}, {'done': 2, 'skipped': 2}):
+        with Copy_Engine(str(tmp_path / "journal"), duplicates='hardlink') as engine:
+            engine.copy_all([(a, str(out / "A.jpg"), None), (c, str(out / "C.jpg"), None)],
+                            {a: "same", b: "same", c: "same"})
+            # b.jpg is to go where a.jpg went, or where c.jpg, with the same contents, went
+            assert engine.link_all([(b, str(out / "A.jpg"), None, a, str(out / "A.jpg")),
+                                    (b, str(out / "C.jpg"), None, a, str(out / "A.jpg"))]) == counts
+        assert "also the destination" not in caplog.text
+    with open(str(out / "C.jpg")) as f:
+        assert f.read() == "a.jpg"
+
+def test_link_all_verify(tmp_path):
+    # with a manifest, a destination a duplicate finds already there is checked like a copy's
+    a, b, c = create_sources(tmp_path, ["a.jpg", "b.jpg", "c.jpg"])
+    with open(b, 'w') as f:
+        f.write("a.jpg")
+    with open(c, 'w') as f:
+        f.write("a.jpg")
+    out = tmp_path / "out"
+    os.makedirs(str(out))
+    with open(str(out / "B.jpg"), 'w') as f:
+        f.write("a.jpg")
+    with open(str(out / "C.jpg"), 'w') as f:
+        f.write("a.jp")
+    manifest = str(tmp_path / "manifest")
+    with Copy_Engine(str(tmp_path / "journal"), duplicates='hardlink', manifest_filename=manifest) as engine:
+        engine.copy_all([(a, str(out / "A.jpg"), None)])
+        counts = engine.link_all([(b, str(out / "B.jpg"), None, a, str(out / "A.jpg")),
+                                  (c, str(out / "C.jpg"), None, a, str(out / "A.jpg"))])
+    assert counts == {'copied': 1, 'exists': 1, 'truncated': 1}
+    with open(manifest) as f:
+        results = {os.path.basename(e['destination']): e['result'] for e in map(json.loads, f)}
+    assert results == {'A.jpg': 'identical', 'B.jpg': 'identical', 'C.jpg': 'truncated'}
+    # only the destination known to be the same is done with
+    with open(str(tmp_path / "journal")) as f:
+        assert sorted(os.path.basename(json.loads(line)['destination']) for line in f) == ['A.jpg', 'B.jpg']
+    # and once checked it holds b.jpg as surely as if we had copied it there, so copies of b.jpg
+    # can be linked to it
+    with Copy_Engine(str(tmp_path / "journal"), duplicates='hardlink', manifest_filename=manifest) as engine:
+        counts = engine.link_all([(c, str(out / "D.jpg"), None, b, str(out / "B.jpg"))])
+    assert counts == {'hardlinked': 1}
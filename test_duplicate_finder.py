@@ -0,0 +1,54 @@
+import os
+import duplicate_finder
+
+def create_files(tmp_path, files):
+    source_files = []
+    for name, contents in files:
+        filename = str(tmp_path / name)
+        with open(filename, 'wb') as f:
+            f.write(contents)
+        source_files.append((filename, os.stat(filename)))
+    return source_files
+
+def test_find_duplicates(tmp_path):
+    source_files = create_files(tmp_path, [
+        ("a.jpg", b"same photo"),
+        ("b.jpg", b"other one!"),    # same size, different contents
+        ("c.jpg", b"same photo"),
+        ("d.jpg", b"unique"),
+        ("e.jpg", b""),              # empty files are never duplicates
+        ("f.jpg", b""),
+    ])
+    duplicates = duplicate_finder.find_duplicates(source_files)
+    a, c = str(tmp_path / "a.jpg"), str(tmp_path / "c.jpg")
+    assert set(duplicates) == {a, c}
+    assert duplicates[a]['duplicate_of'] is None
+    assert duplicates[c]['duplicate_of'] == a
+    assert duplicates[a]['content_hash'] == duplicates[c]['content_hash'] == duplicate_finder.full_hash(a)
+
+def test_find_duplicates_large_files(tmp_path, monkeypatch):
+    # files bigger than two blocks are told apart by their first and last blocks before
+    # anything is hashed in full
+    monkeypatch.setattr(duplicate_finder, "block_size", 4)
+    source_files = create_files(tmp_path, [
+        ("a.jpg", b"head-middle-tail"),
+        ("b.jpg", b"HEAD-middle-tail"),
+        ("c.jpg", b"head-MIDDLE-tail"),
+        ("d.jpg", b"head-middle-tail"),
+    ])
+    hashed = []
+    full_hash = duplicate_finder.full_hash
+    def mock_full_hash(filename):
+        hashed.append(os.path.basename(filename))
+        return full_hash(filename)
+    monkeypatch.setattr(duplicate_finder, "full_hash", mock_full_hash)
+    duplicates = duplicate_finder.find_duplicates(source_files)
+    assert sorted(hashed) == ["a.jpg", "c.jpg", "d.jpg"]
+    assert set(duplicates) == {str(tmp_path / "a.jpg"), str(tmp_path / "d.jpg")}
+    assert duplicates[str(tmp_path / "d.jpg")]['duplicate_of'] == str(tmp_path / "a.jpg")
+
+def test_find_duplicates_unreadable(tmp_path, caplog):
+    source_files = create_files(tmp_path, [("a.jpg", b"same"), ("b.jpg", b"same")])
+    os.remove(source_files[1][0])
+    assert duplicate_finder.find_duplicates(source_files) == {}
+    assert "can't read" in caplog.text
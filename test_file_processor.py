@@ -1,10 +1,13 @@
 from typing import Any
 from file_processor import *
 import exiftool
-from PIL import Image
+from PIL import Image, ExifTags
 import imagehash
 import magic
 import pytest
+from metadata_cache import Metadata_Cache
+from hash_index import hash_distance
+import file_processor
 
 def test_find_date():
     assert find_date("2020-01-01") == datetime.datetime(2020,1,1,0,0)  
@@ -160,8 +163,7 @@ def test_file_processor_get_exif_metadata(monkeypatch):
         'EXIF:GPSLongitude': 2.0,
         'EXIF:GPSAltitude': 3.0,
     }]
-    fp.source_media_filename = test
-    md = fp.get_exif_metadata() 
+    md = fp.get_exif_metadata(test)
     assert md == {
         'datetime_exif': datetime.datetime(2023,12,1,14,1,23,0),
         'model_exif': 'Canon EOS-1D X Mark II',
@@ -177,8 +179,7 @@ def test_file_processor_get_exif_metadata(monkeypatch):
         'EXIF:GPSLongitude': 2.0,
         'EXIF:GPSAltitude': 3.0,
     }]
-    fp.source_media_filename = test2
-    md = fp.get_exif_metadata() 
+    md = fp.get_exif_metadata(test2)
     assert md == {
         'datetime_exif': datetime.datetime(2023,12,1,14,1,23,0),
         'model_exif': 'Canon EOS-1D X Mark II',
@@ -188,42 +189,183 @@ def test_file_processor_get_exif_metadata(monkeypatch):
         }
     }
 
+def test_get_media_metadata(monkeypatch):
+    # videos are read directly, with exiftool only for the ones we can't make sense of
+    exif_read = []
+    def mock_get_exif_metadata(self, source):
+        exif_read.append(source)
+        return {'datetime_exif': None, 'geodata_exif': None, 'model_exif': 'exiftool'}
+    monkeypatch.setattr(File_Processor, "get_exif_metadata", mock_get_exif_metadata)
+    def mock_read_quicktime_metadata(source):
+        if source == "folder/video.mov":
+            return {'creation_time': datetime.datetime(2023,12,1,14,1,23,0), 'duration': 10.0,
+                    'geodata': {'latitude': 1.0, 'longitude': 2.0}}
+        if source == "folder/missing.mp4":
+            raise FileNotFoundError(source)
+        return None
+    monkeypatch.setattr(file_processor, "read_quicktime_metadata", mock_read_quicktime_metadata)
+    fp = File_Processor({}, 2024, "test")
+    assert fp.get_media_metadata("folder/video.mov") == {
+        'datetime_exif': datetime.datetime(2023,12,1,14,1,23,0),
+        'geodata_exif': {'latitude': 1.0, 'longitude': 2.0},
+        'model_exif': None
+    }
+    assert exif_read == []
+    assert fp.get_media_metadata("folder/odd.mp4")['model_exif'] == 'exiftool'
+    assert fp.get_media_metadata("folder/missing.mp4")['model_exif'] == 'exiftool'
+    assert fp.get_media_metadata("folder/photo.jpg")['model_exif'] == 'exiftool'
+    assert exif_read == ["folder/odd.mp4", "folder/missing.mp4", "folder/photo.jpg"]
+
+def test_get_pil_metadata(tmp_path, monkeypatch):
+    # jpegs have their exif data read by PIL, into just what exiftool would have given us
+    filename = str(tmp_path / "photo.jpg")
+    exif = Image.Exif()
+    exif[ExifTags.Base.Model] = "Canon EOS-1D X Mark II"
+    exif.get_ifd(ExifTags.IFD.Exif)[ExifTags.Base.DateTimeOriginal] = "2023:12:01 14:01:23"
+    gps = exif.get_ifd(ExifTags.IFD.GPSInfo)
+    gps[ExifTags.GPS.GPSLatitudeRef] = 'S'
+    gps[ExifTags.GPS.GPSLatitude] = (1.0, 30.0, 36.0)
+    gps[ExifTags.GPS.GPSLongitudeRef] = 'E'
+    gps[ExifTags.GPS.GPSLongitude] = (2.0, 0.0, 0.0)
+    Image.new('RGB', (16, 16)).save(filename, exif=exif)
+    Image.new('RGB', (16, 16)).save(str(tmp_path / "plain.png"))
+    with open(str(tmp_path / "broken.jpg"), 'w') as f:
+        f.write("aaaa")
+    exif_read = []
+    def mock_get_exif_metadata(self, source):
+        exif_read.append(source)
+        return {'datetime_exif': None, 'geodata_exif': None, 'model_exif': 'exiftool'}
+    monkeypatch.setattr(File_Processor, "get_exif_metadata", mock_get_exif_metadata)
+
+    fp = File_Processor({}, 2024, "test")
+    md = fp.get_media_metadata(filename)
+    assert md['datetime_exif'] == datetime.datetime(2023,12,1,14,1,23,0)
+    assert md['model_exif'] == 'Canon EOS-1D X Mark II'
+    assert md['geodata_exif'] == {'latitude': pytest.approx(-1.51), 'longitude': 2.0}
+    assert fp.get_media_metadata(str(tmp_path / "plain.png")) == {
+        'datetime_exif': None,
+        'geodata_exif': {'latitude': None, 'longitude': None},
+        'model_exif': None
+    }
+    assert exif_read == []
+    # anything PIL can't read goes to exiftool
+    assert fp.get_media_metadata(str(tmp_path / "broken.jpg"))['model_exif'] == 'exiftool'
+    assert fp.get_media_metadata(str(tmp_path / "raw.nef"))['model_exif'] == 'exiftool'
+    assert exif_read == [str(tmp_path / "broken.jpg"), str(tmp_path / "raw.nef")]
+
+# mock exiftool which understands batches of files, and fails the whole batch if any
+# file in it is broken - just like the real exiftool
+class MockBatchExiftoolHelper:
+    calls = []
+    terminated = False
+
+    def get_metadata(self, filenames):
+        MockBatchExiftoolHelper.calls.append(filenames)
+        if not isinstance(filenames, list):
+            filenames = [filenames]
+        if "/my/path/broken.jpg" in filenames:
+            raise exiftool.exceptions.ExifToolExecuteError(1, "", "broken", filenames)
+        if "/my/path/undecodable.jpg" in filenames:
+            # exiftool worked, but its output couldn't be read back
+            raise exiftool.exceptions.ExifToolJSONInvalidError(0, "\xff", "", filenames)
+        return [{'SourceFile': f, 'EXIF:Model': os.path.basename(f)} for f in filenames]
+
+    def terminate(self):
+        MockBatchExiftoolHelper.terminated = True
+
+def test_exif_session_batch(monkeypatch):
+    monkeypatch.setattr(exiftool, "ExifToolHelper", MockBatchExiftoolHelper)
+    MockBatchExiftoolHelper.calls = []
+    MockBatchExiftoolHelper.terminated = False
+
+    with Exif_Session() as session:
+        session.prefetch(["/my/path/a.jpg", "/my/path/b.jpg"])
+        # the whole folder is read in one go
+        assert MockBatchExiftoolHelper.calls == [["/my/path/a.jpg", "/my/path/b.jpg"]]
+        assert session.get_metadata("/my/path/b.jpg") == [{'SourceFile': '/my/path/b.jpg', 'EXIF:Model': 'b.jpg'}]
+        assert session.get_metadata("/my/path/a.jpg") == [{'SourceFile': '/my/path/a.jpg', 'EXIF:Model': 'a.jpg'}]
+        assert len(MockBatchExiftoolHelper.calls) == 1
+        # files that weren't prefetched are read on demand
+        assert session.get_metadata("/my/path/c.jpg") == [{'SourceFile': '/my/path/c.jpg', 'EXIF:Model': 'c.jpg'}]
+        assert MockBatchExiftoolHelper.calls[-1] == "/my/path/c.jpg"
+    assert MockBatchExiftoolHelper.terminated == True
+
+def test_exif_session_broken_file(monkeypatch):
+    monkeypatch.setattr(exiftool, "ExifToolHelper", MockBatchExiftoolHelper)
+    MockBatchExiftoolHelper.calls = []
+
+    session = Exif_Session()
+    session.prefetch(["/my/path/a.jpg", "/my/path/broken.jpg", "/my/path/b.jpg"])
+    # the batch failed so each file was retried on its own
+    assert len(MockBatchExiftoolHelper.calls) == 4
+    assert session.get_metadata("/my/path/a.jpg") == [{'SourceFile': '/my/path/a.jpg', 'EXIF:Model': 'a.jpg'}]
+    assert session.get_metadata("/my/path/b.jpg") == [{'SourceFile': '/my/path/b.jpg', 'EXIF:Model': 'b.jpg'}]
+    with pytest.raises(exiftool.exceptions.ExifToolExecuteError):
+        session.get_metadata("/my/path/broken.jpg")
+
+    # the file processor logs the error and carries on without exif data
+    session.prefetch(["/my/path/broken.jpg"])
+    fp = File_Processor({}, 2024, "test", session)
+    assert fp.get_exif_metadata("/my/path/broken.jpg") == {
+        'datetime_exif': None,
+        'geodata_exif': None,
+        'model_exif': None
+    }
+
+def test_exif_session_unreadable_output(monkeypatch):
+    # a file exiftool gives back output for that can't be read only loses its own metadata too
+    monkeypatch.setattr(exiftool, "ExifToolHelper", MockBatchExiftoolHelper)
+    MockBatchExiftoolHelper.calls = []
+
+    session = Exif_Session()
+    session.prefetch(["/my/path/a.jpg", "/my/path/undecodable.jpg"])
+    assert len(MockBatchExiftoolHelper.calls) == 3
+    assert session.get_metadata("/my/path/a.jpg") == [{'SourceFile': '/my/path/a.jpg', 'EXIF:Model': 'a.jpg'}]
+    fp = File_Processor({}, 2024, "test", session)
+    assert fp.get_exif_metadata("/my/path/undecodable.jpg") == {
+        'datetime_exif': None,
+        'geodata_exif': None,
+        'model_exif': None
+    }
+    # and so does one read on its own
+    assert fp.get_exif_metadata("/my/path/undecodable.jpg")['model_exif'] == None
+    session.stop()
+
 def test_get_filename_metadata():
     mapper = {}
     year = 2024
     outfolder = "test"
 
     fp = File_Processor(mapper, year, outfolder)
-    fp.source_media_basename = "bobbins20120901_114223_edited.jpg"
-    md = fp.get_filename_metadata()
+    md = fp.get_filename_metadata("bobbins20120901_114223_edited.jpg")
     assert md == {
         'datetime_filename': datetime.datetime(2012, 9, 1, 11, 42, 23, 0),
     } 
 
-def test_file_metadata(monkeypatch):
+def test_file_metadata(fs, cwd):
     mapper = {}
     year = 2024
     outfolder = "test"
 
-    # mock the os.path.getmtime method to return whatever data is passed in
-    def mock_getmtime(data):
-        return data['datetime']
-    # mock the os.path.getsize method to return whatever data is passed in
-    def mock_getsize(data):
-        return data['size']
-    
-    # apply the monkeypatch for os.path.getmtime and os.path.getsize
-    monkeypatch.setattr(os.path, "getmtime", mock_getmtime)
-    monkeypatch.setattr(os.path, "getsize", mock_getsize)
+    fs.create_file("/my/path/file.jpg", contents=b"12345")
+    os.utime("/my/path/file.jpg", times=(
+        datetime.datetime(2023, 12, 1, 14, 1, 23, 0).timestamp(),
+        datetime.datetime(2023, 12, 1, 14, 1, 23, 0).timestamp()
+        ))
 
     fp = File_Processor(mapper, year, outfolder)
-    fp.source_media_filename = {
-        'datetime': datetime.datetime(2023, 12, 1, 14, 1, 23, 0).timestamp(),
-        'size': 12345,
-    }
-    md = fp.get_file_metadata()
+    md = fp.get_file_metadata("/my/path/file.jpg")
     assert md == {
         'datetime_filemodif': datetime.datetime(2023, 12, 1, 14, 1, 23, 0),
+        'file_size': 5,
+    }
+
+    # stat results handed over from the folder listing are used without touching the file
+    stat = os.stat_result((0, 0, 0, 0, 0, 0, 12345, 0,
+                           int(datetime.datetime(2022, 1, 1, 0, 0, 0, 0).timestamp()), 0))
+    md = fp.get_file_metadata("/my/path/missing.jpg", stat)
+    assert md == {
+        'datetime_filemodif': datetime.datetime(2022, 1, 1, 0, 0, 0, 0),
         'file_size': 12345,
     }
 
@@ -235,9 +377,7 @@ def test_json_metadata(monkeypatch):
     # Test that when json mapper is empty we get the empty metadata back
     fp = File_Processor(mapper, year, outfolder)
     fp.json_mapper = {}
-    fp.source_media_filename = "sponge/bobbins20120901_114223_edited.jpg"
-    fp.source_media_basename = "bobbins20120901_114223_edited.jpg"
-    md = fp.get_json_metadata()
+    md = fp.get_json_metadata("sponge/bobbins20120901_114223_edited.jpg")
     assert md == {
         'datetime_json': None,
         'geodata_json': None
@@ -258,12 +398,10 @@ def test_json_metadata(monkeypatch):
     # test that when there is a matching json mapper we get the correct metadata back
     monkeypatch.setattr(File_Processor, "read_json_file", mock_read_json_file)
     fp = File_Processor(mapper, year, outfolder)
-    fp.source_media_filename = "sponge/bobbins20120901_114223_edited.jpg"
-    fp.source_media_basename = "bobbins20120901_114223_edited.jpg"
     fp.json_mapper = {
-        fp.source_media_basename: fp.source_media_basename+".json"
+        "bobbins20120901_114223_edited.jpg": "bobbins20120901_114223_edited.jpg.json"
     }
-    md = fp.get_json_metadata()
+    md = fp.get_json_metadata("sponge/bobbins20120901_114223_edited.jpg")
     assert md == {
         'datetime_json': datetime.datetime(2023, 12, 1, 14, 1, 23, 0),
         'geodata_json': {
@@ -283,12 +421,10 @@ def test_json_metadata(monkeypatch):
     # test that when there is a matching json mapper we get the correct metadata back
     monkeypatch.setattr(File_Processor, "read_json_file", mock_read_json_file2)
     fp = File_Processor(mapper, year, outfolder)
-    fp.source_media_filename = "sponge/bobbins20120901_114223_edited.jpg"
-    fp.source_media_basename = "bobbins20120901_114223_edited.jpg"
     fp.json_mapper = {
-        fp.source_media_basename: fp.source_media_basename+".json"
+        "bobbins20120901_114223_edited.jpg": "bobbins20120901_114223_edited.jpg.json"
     }
-    md = fp.get_json_metadata()
+    md = fp.get_json_metadata("sponge/bobbins20120901_114223_edited.jpg")
     assert md == {
         'datetime_json': datetime.datetime(2023, 12, 1, 14, 1, 23, 0),
         'geodata_json': None
@@ -306,12 +442,10 @@ def test_json_metadata(monkeypatch):
     # test that when there is a matching json mapper we get the correct metadata back
     monkeypatch.setattr(File_Processor, "read_json_file", mock_read_json_file3)
     fp = File_Processor(mapper, year, outfolder)
-    fp.source_media_filename = "sponge/bobbins20120901_114223_edited.jpg"
-    fp.source_media_basename = "bobbins20120901_114223_edited.jpg"
     fp.json_mapper = {
-        fp.source_media_basename: fp.source_media_basename+".json"
+        "bobbins20120901_114223_edited.jpg": "bobbins20120901_114223_edited.jpg.json"
     }
-    md = fp.get_json_metadata()
+    md = fp.get_json_metadata("sponge/bobbins20120901_114223_edited.jpg")
     assert md == {
         'datetime_json': None,
         'geodata_json': {
@@ -320,46 +454,134 @@ def test_json_metadata(monkeypatch):
         }
     }
 
+def test_json_metadata_from_sidecars(monkeypatch):
+    # sidecars already read by the json mapper aren't read again
+    def mock_read_json_file(self, filename):
+        assert False
+    monkeypatch.setattr(File_Processor, "read_json_file", mock_read_json_file)
+    mapper = {"bobbins.jpg": "bobbins.jpg.json"}
+    sidecars = {
+        "bobbins.jpg.json": {
+            'title': "bobbins.jpg",
+            'timestamp': int(datetime.datetime(2023, 12, 1, 14, 1, 23, 0).timestamp()),
+            'geodata': {'latitude': 1.0, 'longitude': 2.0},
+        }
+    }
+    fp = File_Processor(mapper, 2024, "test", sidecars=sidecars)
+    assert fp.get_json_metadata("sponge/bobbins.jpg") == {
+        'datetime_json': datetime.datetime(2023, 12, 1, 14, 1, 23, 0),
+        'geodata_json': {'latitude': 1.0, 'longitude': 2.0},
+    }
+
+class MockImage(str):
+    # stands in for an open PIL image, and is just the name of the file it was opened from
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
 def test_get_hash(monkeypatch):
     mapper = {}
     year = 2024
     outfolder = "test"
 
     def mock_pil_open(filename):
-        return filename
+        return MockImage(filename)
     # apply the monkeypatch for PIL.open
     monkeypatch.setattr(Image, "open", mock_pil_open)
 
     def mock_imagehash_phash(image, hash_size):
-        if image == 'error':
+        if image == 'error.jpg':
             raise OSError
         return "hash"
     monkeypatch.setattr(imagehash, "phash", mock_imagehash_phash)
   
     # Test that when we ask for an image hash of unsupported we get None
     fp = File_Processor(mapper, year, outfolder)
-    fp.source_media_fileext = ".blob"
-    fp.source_media_filename = "sponge/bobbins20120901_114223_edited.blob"
-    assert fp.get_hash() == None
+    assert fp.get_hash("sponge/bobbins20120901_114223_edited.blob") == None
 
-    # Test that when we ask for an image hash of video we get None
+    # Test that when we ask for a hash of a video we can't read we get None
     fp = File_Processor(mapper, year, outfolder)
-    fp.source_media_fileext = ".avi"
-    fp.source_media_filename = "sponge/bobbins20120901_114223_edited.avi"
-    assert fp.get_hash() == None
+    assert fp.get_hash("sponge/bobbins20120901_114223_edited.avi") == None
 
     # Test that when we ask for an image hash of image that causes error we get None
     fp = File_Processor(mapper, year, outfolder)
-    fp.source_media_fileext = ".jpg"
-    fp.source_media_filename = "error"
-    assert fp.get_hash() == None
+    assert fp.get_hash("error.jpg") == None
 
     # Test that when we ask for an image hash of image we get the right hash
     fp = File_Processor(mapper, year, outfolder)
-    fp.source_media_fileext = ".jpg"
-    fp.source_media_filename = "sponge/bobbins20120901_114223_edited.jpg"
-    assert fp.get_hash() == "hash"
+    assert fp.get_hash("sponge/bobbins20120901_114223_edited.jpg") == "hash"
   
+def create_test_photo(filename):
+    # a large, smooth image, something like a photo, with plenty for phash to get hold of
+    pixels = [(x * 7 % 256, y * 5 % 256, (x * y) % 256) for y in range(30) for x in range(40)]
+    image = Image.new('RGB', (40, 30))
+    image.putdata(pixels)
+    image.resize((2400, 1800), Image.BICUBIC).save(filename)
+
+def test_get_image_hash_fast(tmp_path, caplog):
+    for name in ["photo.jpg", "photo.png"]:
+        filename = str(tmp_path / name)
+        create_test_photo(filename)
+        full_hash = File_Processor({}, None, "test").get_image_hash(filename)
+        fast_hash = File_Processor({}, None, "test", hash_mode='fast').get_image_hash(filename)
+        assert hash_distance(fast_hash, full_hash) <= 2
+        # validating gives the full hash, and says if the fast one is different
+        assert File_Processor({}, None, "test", hash_mode='validate').get_image_hash(filename) == full_hash
+        assert ("bits from full hash" in caplog.text) == (fast_hash != full_hash)
+        caplog.clear()
+
+def test_get_hashes(tmp_path, monkeypatch):
+    # every hash type comes from a single decode, and the phash is the same one we'd get alone
+    filename = str(tmp_path / "photo.jpg")
+    create_test_photo(filename)
+    opened = []
+    pil_open = Image.open
+    def mock_pil_open(filename):
+        opened.append(filename)
+        return pil_open(filename)
+    monkeypatch.setattr(Image, "open", mock_pil_open)
+    fp = File_Processor({}, None, "test", multi_hash=True)
+    hashes = fp.get_hashes(filename)
+    assert opened == [filename]
+    assert sorted(hashes) == ['ahash', 'colorhash', 'dhash', 'phash']
+    assert hashes['phash'] == fp.get_image_hash(filename)
+    assert hashes['dhash'] == str(imagehash.dhash(pil_open(filename), hash_size=16))
+    assert hashes['colorhash'] == str(imagehash.colorhash(pil_open(filename)))
+    # a fast decode is in colour rather than straight to greyscale, so its phash can be a bit or
+    # two out from a fast phash on its own, just as it can from the full one
+    fp = File_Processor({}, None, "test", hash_mode='fast', multi_hash=True)
+    opened.clear()
+    fast_hashes = fp.get_hashes(filename)
+    assert opened == [filename]
+    assert hash_distance(fast_hashes['phash'], hashes['phash']) <= 2
+    assert hash_distance(fast_hashes['dhash'], hashes['dhash']) <= 4
+    assert fp.get_hashes(str(tmp_path / "video.mp4")) == None
+    assert fp.get_hashes(str(tmp_path / "missing.jpg")) == None
+
+def test_get_hash_raw_preview(tmp_path, monkeypatch):
+    # raw files are hashed from their embedded preview, just like the JPEG it is
+    filename = str(tmp_path / "preview.jpg")
+    create_test_photo(filename)
+    with open(filename, 'rb') as f:
+        preview = f.read()
+    def mock_extract_preview(source):
+        return preview if source == "shoot.nef" else None
+    monkeypatch.setattr(file_processor, "extract_preview", mock_extract_preview)
+    fp = File_Processor({}, None, "test")
+    assert fp.get_hash("shoot.nef") == fp.get_hash(filename)
+    assert fp.get_hash("no_preview.dng") == None
+    fp = File_Processor({}, None, "test", multi_hash=True)
+    assert fp.get_hashes("shoot.nef") == fp.get_hashes(filename)
+
+def test_reduce_for_hash():
+    # big images are shrunk, but never below 8 times the size phash works at
+    image = reduce_for_hash(Image.new('RGB', (4000, 3000)))
+    assert image.mode == 'L'
+    assert image.size == (4000 // 5, 3000 // 5)
+    image = reduce_for_hash(Image.new('RGB', (600, 400)))
+    assert image.size == (600, 400)
+
 def test_process_file(monkeypatch):
     # test skipping json file
     mapper = {}
@@ -376,8 +598,8 @@ def test_process_file(monkeypatch):
     assert fp.process_file("folder/basename") == None
 
     # test processing a regular media file
-    def mock_get_exif_metadata(self):
-        if self.source_media_filename == "folder/test1.jpg":
+    def mock_get_exif_metadata(self, source):
+        if source == "folder/test1.jpg":
             return {
                 'datetime_exif': datetime.datetime(2023,12,1,14,1,23,0),
             }
@@ -385,8 +607,8 @@ def test_process_file(monkeypatch):
             return {
                 'datetime_exif': None
             }
-    def mock_get_file_metadata(self):
-        if self.source_media_filename == "folder/test5.jpg":
+    def mock_get_file_metadata(self, source, stat=None):
+        if source == "folder/test5.jpg":
             return {
                 'datetime_filemodif': datetime.datetime(2023,12,5,14,1,23,0),
                 'file_size': 12345,
@@ -396,8 +618,8 @@ def test_process_file(monkeypatch):
                 'datetime_filemodif': None,
                 'file_size': None,
             }
-    def mock_get_filename_metadata(self):
-        if self.source_media_filename == "folder/test3.jpg":
+    def mock_get_filename_metadata(self, basename):
+        if basename == "test3.jpg":
             return {
                 'datetime_filename': datetime.datetime(2023,12,3,14,1,23,0),
             }
@@ -405,10 +627,10 @@ def test_process_file(monkeypatch):
             return {
                 'datetime_filename': None,
             }
-    def mock_get_hash(self):
+    def mock_get_hash(self, source):
        return 'hash'
-    def mock_get_json_metadata(self):
-        if self.source_media_filename == "folder/test2.jpg":
+    def mock_get_json_metadata(self, source):
+        if source == "folder/test2.jpg":
             return {
                 'datetime_json': datetime.datetime(2023,12,2,14,1,23,0),
             }
@@ -533,3 +755,77 @@ def test_process_file(monkeypatch):
         'destination': 'test/2023/2023_12/2023-12-05_140123_test5.jpg'
     }
 
+
+def test_process_file_metadata_cache(fs, cwd, monkeypatch):
+    # the second time we see a file its exif data and hash come from the metadata cache
+    calls = []
+    def mock_get_exif_metadata(self, source):
+        calls.append(source)
+        return {'datetime_exif': datetime.datetime(2023,12,1,14,1,23,0), 'geodata_exif': None, 'model_exif': None}
+    def mock_get_hash(self, source):
+        calls.append(source)
+        return 'hash'
+    monkeypatch.setattr(File_Processor, "get_exif_metadata", mock_get_exif_metadata)
+    monkeypatch.setattr(File_Processor, "get_hash", mock_get_hash)
+    fs.create_file("/my/path/test1.jpg", contents=b"aaaa")
+
+    with Metadata_Cache(":memory:") as cache:
+        fp = File_Processor({}, 2024, "test", metadata_cache=cache)
+        first = fp.process_file("/my/path/test1.jpg")
+        assert len(calls) == 2
+        second = fp.process_file("/my/path/test1.jpg", os.stat("/my/path/test1.jpg"))
+        assert len(calls) == 2
+        assert first == second
+        assert second['destination'] == 'test/2023/2023_12/2023-12-01_140123_test1.jpg'
+
+    # asking for more hash types than the cache has means working them out again
+    def mock_get_hashes(self, source):
+        calls.append(source)
+        return {'phash': 'hash', 'dhash': 'dhash', 'ahash': 'ahash', 'colorhash': 'colorhash'}
+    monkeypatch.setattr(File_Processor, "get_hashes", mock_get_hashes)
+    with Metadata_Cache(":memory:") as cache:
+        fp = File_Processor({}, 2024, "test", metadata_cache=cache)
+        fp.process_file("/my/path/test1.jpg")
+        calls.clear()
+        fp = File_Processor({}, 2024, "test", metadata_cache=cache, multi_hash=True)
+        results = fp.process_file("/my/path/test1.jpg")
+        assert len(calls) == 2
+        assert results['hash'] == 'hash'
+        assert results['hashes']['dhash'] == 'dhash'
+        assert fp.process_file("/my/path/test1.jpg") == results
+        assert len(calls) == 2
+
+
+def test_process_file_cached_lookup(fs, cwd, monkeypatch):
+    # an entry already looked up in the metadata cache is used without looking it up again,
+    # and a file found to be missing from it is worked out and added
+    calls = []
+    def mock_get_exif_metadata(self, source):
+        calls.append(source)
+        return {'datetime_exif': datetime.datetime(2023,12,1,14,1,23,0), 'geodata_exif': None, 'model_exif': None}
+    def mock_get_hash(self, source):
+        calls.append(source)
+        return 'hash'
+    monkeypatch.setattr(File_Processor, "get_exif_metadata", mock_get_exif_metadata)
+    monkeypatch.setattr(File_Processor, "get_hash", mock_get_hash)
+    fs.create_file("/my/path/test1.jpg", contents=b"aaaa")
+    fs.create_file("/my/path/test2.jpg", contents=b"bbbb")
+    stat1, stat2 = os.stat("/my/path/test1.jpg"), os.stat("/my/path/test2.jpg")
+
+    with Metadata_Cache(":memory:") as cache:
+        entry = {'exif': {'datetime_exif': datetime.datetime(2022,1,2,3,4,5,0), 'geodata_exif': None,
+                          'model_exif': None}, 'hash': 'cached'}
+        def no_get(source, stat):
+            raise AssertionError("metadata cache looked up again")
+        monkeypatch.setattr(cache, "get", no_get)
+        fp = File_Processor({}, 2024, "test", metadata_cache=cache,
+                            cached={"/my/path/test1.jpg": entry, "/my/path/test2.jpg": None})
+        results = fp.process_file("/my/path/test1.jpg", stat1)
+        assert calls == []
+        assert results['hash'] == 'cached'
+        assert results['destination'] == 'test/2022/2022_01/2022-01-02_030405_test1.jpg'
+        results = fp.process_file("/my/path/test2.jpg", stat2)
+        assert len(calls) == 2
+        assert results['hash'] == 'hash'
+        monkeypatch.undo()
+        assert cache.get("/my/path/test2.jpg", stat2)['hash'] == 'hash'
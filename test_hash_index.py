@@ -0,0 +1,93 @@
+import random
+import imagehash
+import numpy
+from hash_index import Hash_Index, hash_distance, pack_hashes, find_clusters
+
+def flip_bits(value, bits):
+    for bit in bits:
+        value ^= 1 << bit
+    return value
+
+def test_hash_index_exact():
+    index = Hash_Index()
+    index.add("00ff", "a.jpg")
+    index.add("00fe", "b.jpg")
+    assert index.find("00ff") == [("a.jpg", 0)]
+    assert index.find("0fff") == []
+    # a file is only indexed once
+    index.add("00ff", "a.jpg")
+    assert len(index) == 2
+
+def test_hash_index_threshold():
+    index = Hash_Index(threshold=4)
+    base = random.Random(1).getrandbits(256)
+    index.add("{:064x}".format(base), "original.jpg")
+    index.add("{:064x}".format(flip_bits(base, [0, 100, 200])), "resized.jpg")
+    index.add("{:064x}".format(flip_bits(base, [1, 50, 99, 150, 255])), "different.jpg")
+    index.add("{:064x}".format(flip_bits(base, [3])), "recompressed.jpg")
+    assert index.find("{:064x}".format(base)) == [("original.jpg", 0), ("recompressed.jpg", 1), ("resized.jpg", 3)]
+    assert index.matches("{:064x}".format(base), "{:064x}".format(flip_bits(base, [7, 8, 9, 10])))
+    assert not index.matches("{:064x}".format(base), None)
+
+def test_hash_index_imagehash():
+    # hashes fresh from imagehash and hashes read back from a report as strings are the same thing
+    bits = numpy.array([[(x * y) % 3 == 0 for x in range(16)] for y in range(16)])
+    hash = imagehash.ImageHash(bits)
+    index = Hash_Index(threshold=2)
+    index.add(hash, "a.jpg")
+    assert index.find(str(hash)) == [("a.jpg", 0)]
+    assert hash_distance(hash, str(hash)) == 0
+
+def test_hash_index_matches_brute_force():
+    # whatever the threshold, the index finds exactly what comparing every pair would
+    rng = random.Random(2)
+    originals = [rng.getrandbits(256) for i in range(50)]
+    hashes = originals + [flip_bits(h, rng.sample(range(256), rng.randint(0, 12))) for h in originals]
+    for threshold in [0, 3, 8, 12]:
+        index = Hash_Index(threshold=threshold)
+        for i, h in enumerate(hashes):
+            index.add("{:064x}".format(h), i)
+        for h in hashes:
+            expected = sorted(i for i, other in enumerate(hashes) if bin(h ^ other).count('1') <= threshold)
+            assert sorted(i for i, distance in index.find("{:064x}".format(h))) == expected
+
+def test_pack_hashes():
+    packed = pack_hashes(["{:064x}".format((3 << 192) | (2 << 128) | (1 << 64) | 5), "0"])
+    assert packed.dtype == numpy.uint64
+    assert packed.tolist() == [[5, 1, 2, 3], [0, 0, 0, 0]]
+    assert pack_hashes([]).shape == (0, 4)
+
+def test_find_clusters():
+    rng = random.Random(3)
+    a, b = rng.getrandbits(256), rng.getrandbits(256)
+    hashes = [a, b, flip_bits(a, [1, 2]), rng.getrandbits(256), flip_bits(a, [1, 2, 3, 4]), b]
+    packed = pack_hashes(["{:064x}".format(h) for h in hashes])
+    assert find_clusters(packed) == [[1, 5]]
+    # the last copy of a is 4 bits from the first, but only 2 from the one in between
+    assert find_clusters(packed, threshold=2) == [[0, 2, 4], [1, 5]]
+    # splitting the work into small blocks makes no difference
+    assert find_clusters(packed, threshold=2, block_size=2) == [[0, 2, 4], [1, 5]]
+
+def test_find_clusters_matches_index():
+    rng = random.Random(4)
+    originals = [rng.getrandbits(256) for i in range(40)]
+    hashes = ["{:064x}".format(h) for h in originals + [flip_bits(h, rng.sample(range(256), rng.randint(0, 6))) for h in originals]]
+    packed = pack_hashes(hashes)
+    index = Hash_Index(threshold=6)
+    for i, h in enumerate(hashes):
+        index.add(h, i)
+    for cluster in find_clusters(packed, threshold=6, block_size=16):
+        for row in cluster:
+            assert any(other in cluster for other, distance in index.find(hashes[row]) if other != row)
+
+def test_hash_index_packed():
+    # the index keeps its hashes packed, and grows to hold as many as it's given
+    rng = random.Random(5)
+    hashes = ["{:064x}".format(rng.getrandbits(256)) for i in range(3000)]
+    index = Hash_Index()
+    for i, h in enumerate(hashes):
+        index.add(h, i)
+    assert len(index) == 3000
+    assert index.packed().base is not None
+    assert (index.packed() == pack_hashes(hashes)).all()
+    assert index.find(hashes[2500]) == [(2500, 0)]
@@ -1,33 +1,29 @@
 import json_mapper
 import pytest
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 # test code for the Media_Sifter class using pytest
 def test_is_a_metadata_sidecar():
     jm = json_mapper.JSON_Mapper('folder')
-    jm.json_document = {}
-    assert jm.is_a_metadata_sidecar() == False
-    jm.json_document = {
+    assert jm.is_a_metadata_sidecar({}) == False
+    assert jm.is_a_metadata_sidecar({
   "title": "IMG_0396.JPG",
   "description": "",
   "imageViews": "333",
-}
-    assert jm.is_a_metadata_sidecar() == True
-    jm.json_document = {
+}) == True
+    assert jm.is_a_metadata_sidecar({
   "description": "",
   "imageViews": "333",
-}
-    assert jm.is_a_metadata_sidecar() == False
-    jm.json_document = {
+}) == False
+    assert jm.is_a_metadata_sidecar({
   "title": "IMG_0396.JPG",
   "imageViews": "333",
-}
-    assert jm.is_a_metadata_sidecar() == False
-    jm.json_document = {
+}) == False
+    assert jm.is_a_metadata_sidecar({
   "title": "IMG_0396.JPG",
   "description": "",
-}
-    assert jm.is_a_metadata_sidecar() == False
+}) == False
 
 @pytest.fixture
 def cwd(fs, monkeypatch):
@@ -294,3 +290,128 @@ def test_create_mapper_long_filename_numbered(fs, cwd, caplog):
         '580D3E5E-2C01-44EC-AE9F-9D5D16AABBE1-EFFECTS(1).jpg':
           '580D3E5E-2C01-44EC-AE9F-9D5D16AABBE1-EFFECTS.j(1).json'
           }
+
+def test_map_folder_shared_mapper(fs, cwd, caplog):
+    # one mapper can be used for several folders at once, each getting its own mapping
+    file_json1 = """
+{
+  "title": "image.jpg",
+  "description": "",
+  "imageViews": "333"
+}
+"""
+    for folder in ["/my/path/a", "/my/path/b"]:
+        fs.create_file(folder + "/image.jpg.json", contents=file_json1)
+        fs.create_file(folder + "/image.jpg")
+        fs.create_file(folder + "/image.jpg(1).json", contents=file_json1)
+        fs.create_file(folder + "/image(1).jpg")
+    fs.create_file("/my/path/b/image.jpg(2).json", contents=file_json1)
+    fs.create_file("/my/path/b/image(2).jpg")
+
+    jm = json_mapper.JSON_Mapper('/my/path')
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        mapping_a, mapping_b = pool.map(jm.map_folder, ["/my/path/a", "/my/path/b"])
+    assert mapping_a == {
+        'image.jpg': 'image.jpg.json',
+        'image(1).jpg': 'image.jpg(1).json',
+    }
+    assert mapping_b == {
+        'image.jpg': 'image.jpg.json',
+        'image(1).jpg': 'image.jpg(1).json',
+        'image(2).jpg': 'image.jpg(2).json',
+    }
+    # the mapper's own mapping isn't touched
+    assert jm.mapper == {}
+
+def test_map_folder_uses_listing(fs, cwd, caplog):
+    # whether media files exist is decided from the folder listing, not by probing the disk
+    file_json1 = """
+{
+  "title": "image.jpg",
+  "description": "",
+  "imageViews": "333"
+}
+"""
+    fs.create_file("/my/path/image.jpg.json", contents=file_json1)
+    fs.create_file("/my/path/image.jpg(1).json", contents=file_json1)
+    jm = json_mapper.JSON_Mapper('/my/path')
+    mpr = jm.map_folder('/my/path', names=["image.jpg.json", "image.jpg", "image.jpg(1).json", "image(1).jpg"])
+    assert mpr == {
+        'image.jpg': 'image.jpg.json',
+        'image(1).jpg': 'image.jpg(1).json',
+    }
+    # folders with media file names don't count as media files when we list the folder
+    fs.create_dir("/my/path/image.jpg")
+    assert jm.map_folder('/my/path') == {}
+
+def test_create_mapper_large_numbered_group(fs, cwd, caplog):
+    # burst groups can have far more than 20 numbered files, and the group is only walked once
+    caplog.set_level(logging.DEBUG)
+    file_json1 = """
+{
+  "title": "burst.jpg",
+  "description": "",
+  "imageViews": "333"
+}
+"""
+    fs.create_file("/my/path/burst.jpg.json", contents=file_json1)
+    fs.create_file("/my/path/burst.jpg")
+    expected = {'burst.jpg': 'burst.jpg.json'}
+    for index in range(1, 30):
+        fs.create_file("/my/path/burst.jpg({}).json".format(index), contents=file_json1)
+        fs.create_file("/my/path/burst({}).jpg".format(index))
+        expected["burst({}).jpg".format(index)] = "burst.jpg({}).json".format(index)
+    jm = json_mapper.JSON_Mapper('/my/path')
+    assert jm.create_mapper() == expected
+    successes = [r for r in caplog.records if "Numbered file success" in r.getMessage()]
+    assert len(successes) == 30
+    already_done = [r for r in caplog.records if "Numbered group already done" in r.getMessage()]
+    assert len(already_done) == 28
+
+def test_map_folder_sidecars(fs, cwd, caplog):
+    # the mapper keeps a summary of each sidecar it reads
+    file_json1 = """
+{
+  "title": "image.jpg",
+  "description": "",
+  "imageViews": "333",
+  "photoTakenTime": {
+    "timestamp": "1552477146",
+    "formatted": "13 Mar 2019, 11:39:06 UTC"
+  },
+  "geoData": {
+    "latitude": 18.5,
+    "longitude": 73.9,
+    "altitude": 560.6
+  }
+}
+"""
+    file_json2 = """
+{
+  "title": "image2.jpg",
+  "description": "",
+  "imageViews": "333"
+}
+"""
+    fs.create_file("/my/path/image.jpg.json", contents=file_json1)
+    fs.create_file("/my/path/image.jpg")
+    fs.create_file("/my/path/image2.jpg.json", contents=file_json2)
+    fs.create_file("/my/path/image2.jpg")
+    fs.create_file("/my/path/metadata.json", contents="{}")
+    jm = json_mapper.JSON_Mapper('/my/path')
+    sidecars = {}
+    jm.map_folder('/my/path', sidecars=sidecars)
+    assert sidecars == {
+        'image.jpg.json': {
+            'title': 'image.jpg',
+            'timestamp': 1552477146,
+            'geodata': {'latitude': 18.5, 'longitude': 73.9},
+        },
+        'image2.jpg.json': {
+            'title': 'image2.jpg',
+            'timestamp': None,
+            'geodata': None,
+        },
+    }
+    jm.create_mapper()
+    assert jm.sidecars == sidecars
@@ -1,21 +1,34 @@
 import exiftool
 import pytest
 import os
+import json
 import datetime
 import logging
 from PIL import Image
 import imagehash
+import functools
+import multiprocessing
 import media_sifter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 # custom class to be the mock return value
 # will override the exiftool.ExifToolHelper returned from exiftool.ExifToolHelper()
 class MockExiftoolHelper:
-    # mock method always returns the data we pass in
+    # mock method returns exif data for the one file that has some - files can be passed
+    # singly or as a batch
     @staticmethod
     def get_metadata(test_data):
+        if not isinstance(test_data, list):
+            test_data = [test_data]
+        metadata = [MockExiftoolHelper.get_file_metadata(f) for f in test_data]
+        return [d for d in metadata if d] or None
+
+    @staticmethod
+    def get_file_metadata(test_data):
         # if we pass in the right file path, return the right data
         if test_data == "/my/path/media/folder3/file_exif.jpg":
-            return [{
+            return {
+                "SourceFile": test_data,
                 "File:FileModifyDate": "2022:12:09 12:34:56",
                 "File:FileName": "file_exif.jpg",
                 "File:FileSize": "1",
@@ -40,7 +53,7 @@ class MockExiftoolHelper:
                 'EXIF:GPSLongitude': 2.0,
                 'EXIF:GPSLongitudeRef': 'E',
                 'EXIF:GPSAltitude': 3.0,
-            }]
+            }
         return None
     
     def __init__(self):
@@ -49,6 +62,18 @@ class MockExiftoolHelper:
         return self
     def __exit__(self, exc_type, exc_value, traceback):
         pass
+    def terminate(self):
+        pass
+
+class MockImage(str):
+    # stands in for an open PIL image, and is just the name of the file it was opened from
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+    def getexif(self):
+        # the test files aren't real images, so their exif data comes from the mock exiftool
+        raise OSError("not an image")
 
 @pytest.fixture
 def cwd(fs, monkeypatch):
@@ -146,7 +171,7 @@ def test_sift_media_files(fs, cwd, caplog, monkeypatch):
     # allow creation of mock hashes - mock PIL open to just return the filename and mock the
     # imagehash phash to use this filename to lookup the hash in our test dictionary
     def mock_pil_open(filename):
-        return filename
+        return MockImage(filename)
     # apply the monkeypatch for PIL.open
     monkeypatch.setattr(Image, "open", mock_pil_open)
     def mock_imagehash_phash(image, hash_size):
@@ -262,3 +287,267 @@ def test_sift_media_files(fs, cwd, caplog, monkeypatch):
     #    ))
     # apply the monkeypatch for exiftool
     #monkeypatch.setattr(exiftool, "ExifToolHelper", MockExiftoolHelper)
+
+def test_sift_media_parallel(fs, cwd, caplog, monkeypatch):
+    # a parallel scan should produce exactly the same report, in the same order, as a serial one
+    create_example_filesystem(fs)
+    def mock_pil_open(filename):
+        return MockImage(filename)
+    monkeypatch.setattr(Image, "open", mock_pil_open)
+    def mock_imagehash_phash(image, hash_size):
+        return get_file_hash(image)
+    monkeypatch.setattr(imagehash, "phash", mock_imagehash_phash)
+    monkeypatch.setattr(exiftool, "ExifToolHelper", MockExiftoolHelper)
+    # worker processes can't see the fake filesystem, so use threads to stand in for them
+    monkeypatch.setattr(media_sifter, "ProcessPoolExecutor", ThreadPoolExecutor)
+
+    serial = media_sifter.Media_Sifter("/my/path/media", "output", "serial.json")
+    serial.sift_media()
+    parallel = media_sifter.Media_Sifter("/my/path/media", "output", "parallel.json", workers=3)
+    parallel.sift_media()
+    threaded = media_sifter.Media_Sifter("/my/path/media", "output", "threaded.json", threads=4)
+    threaded.sift_media()
+    assert list(threaded.report) == list(serial.report)
+    assert threaded.report == serial.report
+    assert list(parallel.report) == list(serial.report)
+    assert parallel.report == serial.report
+    assert parallel.hasher.sources == serial.hasher.sources
+    assert (parallel.hasher.packed() == serial.hasher.packed()).all()
+    assert parallel.hash_collisions == serial.hash_collisions == {
+        "/my/path/media/folder1/normal.jpg": ["/my/path/media/folder1/normal.jpg", "/my/path/media/folder5/normal2.jpg"]
+    }
+    with open("serial.json") as serial_fh, open("parallel.json") as parallel_fh:
+        assert serial_fh.read() == parallel_fh.read()
+
+    # analysing the report finds the same pictures that the scan did
+    assert serial.find_hash_clusters() == serial.hash_collisions
+
+    # resuming a parallel scan skips everything already in the report
+    parallel = media_sifter.Media_Sifter("/my/path/media", "output", "parallel.json", workers=3)
+    parallel.sift_media()
+    parallel.read_report(backup=False)
+    serial.read_report(backup=False)
+    assert parallel.report == serial.report
+
+def test_sift_media_worker_processes(tmp_path, monkeypatch):
+    # a real pool of worker processes, started afresh as they are on macOS and Windows, so the
+    # folders, the results and the worker set up all have to survive being pickled. The photos'
+    # exif data is read by PIL, so exiftool is never needed.
+    media = tmp_path / "media"
+    for folder, name, day, colour in [("folder1", "a.jpg", 1, (255, 0, 0)), ("folder1", "b.jpg", 2, (0, 255, 0)),
+                                      ("folder2", "c.jpg", 3, (0, 0, 255))]:
+        os.makedirs(str(media / folder), exist_ok=True)
+        exif = Image.Exif()
+        exif[0x9003] = "2023:12:{:02d} 14:01:23".format(day)  # DateTimeOriginal
+        Image.new("RGB", (64, 64), colour).save(str(media / folder / name), exif=exif)
+    spawn = multiprocessing.get_context("spawn")
+    monkeypatch.setattr(media_sifter, "ProcessPoolExecutor", functools.partial(ProcessPoolExecutor, mp_context=spawn))
+
+    ms = media_sifter.Media_Sifter(str(media), "output", str(tmp_path / "report.json"), workers=2,
+                                   cache_filename=str(tmp_path / "cache.db"))
+    ms.sift_media()
+    assert {os.path.basename(source): entry['destination'] for source, entry in ms.report.items()} == {
+        "a.jpg": "output/2023/2023_12/2023-12-01_140123_a.jpg",
+        "b.jpg": "output/2023/2023_12/2023-12-02_140123_b.jpg",
+        "c.jpg": "output/2023/2023_12/2023-12-03_140123_c.jpg",
+    }
+    assert all(entry['hash'] for entry in ms.report.values())
+
+@pytest.mark.parametrize("report_format", ['json', 'sqlite'])
+def test_sift_media_dedupe(tmp_path, fs, cwd, caplog, monkeypatch, report_format):
+    # an album copy of a photo gets the original's exif data and hash without exiftool or PIL
+    # ever seeing it, and the copy is still filed under its own name
+    def report_filename(name):
+        # sqlite doesn't go through the fake filesystem, so its reports go in a real folder
+        return str(tmp_path / (name + ".db")) if report_format == 'sqlite' else name + ".json"
+    create_nice_test_file(fs, "/my/path/media/folder3/file_exif.jpg", "3", file_contents="exif photo")
+    create_nice_test_file(fs, "/my/path/media/folder3/other.jpg", "4", file_contents="other photo")
+    create_nice_test_file(fs, "/my/path/media/my album/copy.jpg", None, file_contents="exif photo")
+    opened = []
+    def mock_pil_open(filename):
+        opened.append(filename)
+        return MockImage(filename)
+    monkeypatch.setattr(Image, "open", mock_pil_open)
+    def mock_imagehash_phash(image, hash_size):
+        return get_file_hash(image)
+    monkeypatch.setattr(imagehash, "phash", mock_imagehash_phash)
+    exif_read = []
+    class MockDedupeExiftoolHelper(MockExiftoolHelper):
+        @staticmethod
+        def get_metadata(test_data):
+            exif_read.extend(test_data if isinstance(test_data, list) else [test_data])
+            return MockExiftoolHelper.get_metadata(test_data)
+    monkeypatch.setattr(exiftool, "ExifToolHelper", MockDedupeExiftoolHelper)
+    monkeypatch.setattr(media_sifter, "ProcessPoolExecutor", ThreadPoolExecutor)
+
+    ms = media_sifter.Media_Sifter("/my/path/media", "output", report_filename("report"), dedupe=True,
+                                   report_format=report_format)
+    ms.sift_media()
+    assert len(ms.report) == 3
+    assert "/my/path/media/my album/copy.jpg" not in exif_read
+    assert "/my/path/media/my album/copy.jpg" not in opened
+    original = ms.report["/my/path/media/folder3/file_exif.jpg"]
+    copy = ms.report["/my/path/media/my album/copy.jpg"]
+    assert original['duplicate_of'] is None
+    assert copy['duplicate_of'] == "/my/path/media/folder3/file_exif.jpg"
+    assert copy['content_hash'] == original['content_hash']
+    assert copy['exif'] == original['exif']
+    assert copy['hash'] == "3"
+    assert copy['destination'] == "output/2023/2023_12/2023-12-01_140123_copy.jpg"
+    assert 'duplicate_of' not in ms.report["/my/path/media/folder3/other.jpg"]
+
+    # the copy can be finished off however the folders are shared out
+    parallel = media_sifter.Media_Sifter("/my/path/media", "output", report_filename("parallel"), workers=3,
+                                         dedupe=True, report_format=report_format)
+    parallel.sift_media()
+    assert {s: parallel.report[s] for s in parallel.report} == {s: ms.report[s] for s in ms.report}
+
+def test_sift_media_resume(fs, cwd, caplog, monkeypatch):
+    # a resumed scan appends to the report rather than rewriting it, after cutting off an entry
+    # left half written by a crash, and an old JSON array report is converted first
+    create_nice_test_file(fs, "/my/path/media/folder1/normal.jpg", "1")
+    monkeypatch.setattr(Image, "open", MockImage)
+    def mock_imagehash_phash(image, hash_size):
+        return get_file_hash(image)
+    monkeypatch.setattr(imagehash, "phash", mock_imagehash_phash)
+    monkeypatch.setattr(exiftool, "ExifToolHelper", MockExiftoolHelper)
+    ms = media_sifter.Media_Sifter("/my/path/media", "output", "report.json")
+    ms.sift_media()
+    with open("/my/path/report.json") as f:
+        first_scan = f.read()
+    assert first_scan.count('\n') == 1
+
+    create_nice_test_file(fs, "/my/path/media/folder2/other.jpg", "2")
+    with open("/my/path/report.json", 'a') as f:
+        f.write('{"source": "/my/path/media/folder2/oth')
+    resumed = media_sifter.Media_Sifter("/my/path/media", "output", "report.json")
+    resumed.sift_media()
+    with open("/my/path/report.json") as f:
+        second_scan = f.read()
+    assert second_scan.startswith(first_scan)
+    assert second_scan.count('\n') == 2
+    assert not os.path.exists("/my/path/report(1).json")
+    assert set(resumed.report) == {"/my/path/media/folder1/normal.jpg", "/my/path/media/folder2/other.jpg"}
+
+    with open("/my/path/legacy.json", 'w') as f:
+        f.write('[\n' + first_scan.replace('}\n', '}, \n') + '{}]\n')
+    legacy = media_sifter.Media_Sifter("/my/path/media", "output", "legacy.json")
+    legacy.sift_media()
+    with open("/my/path/legacy(1).json") as f:
+        assert f.read().startswith('[')
+    with open("/my/path/legacy.json") as f:
+        assert f.read() == second_scan
+    assert legacy.report == resumed.report
+
+def test_enact_report(fs, cwd, caplog, monkeypatch):
+    # the files in the report are copied to their destinations with their preferred timestamps,
+    # and a second run finds them all in the journal
+    caplog.set_level(logging.INFO)
+    create_nice_test_file(fs, "/my/path/media/folder1/normal.jpg", "1")
+    create_nice_test_file(fs, "/my/path/media/folder2/other.jpg", "2", file_contents="bbbb")
+    monkeypatch.setattr(Image, "open", MockImage)
+    def mock_imagehash_phash(image, hash_size):
+        return get_file_hash(image)
+    monkeypatch.setattr(imagehash, "phash", mock_imagehash_phash)
+    monkeypatch.setattr(exiftool, "ExifToolHelper", MockExiftoolHelper)
+    media_sifter.Media_Sifter("/my/path/media", "output", "report.json").sift_media()
+
+    ms = media_sifter.Media_Sifter("/my/path/media", "output", "report.json", enact_verify=True)
+    ms.enact_report()
+    destination = "/my/path/output/1972/1972_01/1972-01-01_000000_other.jpg"
+    with open(destination) as f:
+        assert f.read() == "bbbb"
+    assert os.stat(destination).st_mtime == datetime.datetime(1972, 1, 1, 0, 0, 0, 0).timestamp()
+    assert os.path.isfile("/my/path/output/1972/1972_01/1972-01-01_000000_normal.jpg")
+    assert os.path.isfile("/my/path/report.json.journal")
+    with open("/my/path/report.json.verify") as f:
+        assert [json.loads(line)['result'] for line in f] == ['identical', 'identical']
+
+    again = media_sifter.Media_Sifter("/my/path/media", "output", "report.json")
+    again.enact_report()
+    assert "Copy_Engine : run - {'done': 2}" in caplog.text
+
+def test_enact_report_duplicates(fs, cwd, caplog, monkeypatch):
+    # a photo that is also in an album is copied once, and its album copy linked to it
+    create_nice_test_file(fs, "/my/path/media/folder1/normal.jpg", "1", file_contents="same photo")
+    create_nice_test_file(fs, "/my/path/media/my album/normal(1).jpg", "1", file_contents="same photo")
+    create_nice_test_file(fs, "/my/path/media/folder2/other.jpg", "2", file_contents="other photo")
+    monkeypatch.setattr(Image, "open", MockImage)
+    def mock_imagehash_phash(image, hash_size):
+        return get_file_hash(image)
+    monkeypatch.setattr(imagehash, "phash", mock_imagehash_phash)
+    monkeypatch.setattr(exiftool, "ExifToolHelper", MockExiftoolHelper)
+    media_sifter.Media_Sifter("/my/path/media", "output", "report.json").sift_media()
+
+    # the report was made without dedupe, so the copies are found when enacting it
+    ms = media_sifter.Media_Sifter("/my/path/media", "output", "report.json", enact_duplicates='hardlink')
+    ms.read_report(backup=False)
+    assert ms.content_originals() == {"/my/path/media/my album/normal(1).jpg": "/my/path/media/folder1/normal.jpg"}
+    ms.enact_report()
+    original = "/my/path/output/1972/1972_01/1972-01-01_000000_normal.jpg"
+    linked = "/my/path/output/1972/1972_01/1972-01-01_000000_normal(1).jpg"
+    assert os.stat(linked).st_ino == os.stat(original).st_ino
+    assert os.stat("/my/path/output/1972/1972_01/1972-01-01_000000_other.jpg").st_ino != os.stat(original).st_ino
+
+@pytest.mark.parametrize("threshold", [0, 1])
+def test_analyse_report_store(tmp_path, caplog, monkeypatch, threshold):
+    # a sqlite report finds the same destination collisions and hash clusters as a json one
+    if threshold == 0:
+        # exact matches are grouped without comparing every pair of hashes
+        def no_find_clusters(packed, threshold=0):
+            raise AssertionError("find_clusters called for exact matches")
+        monkeypatch.setattr(media_sifter, "find_clusters", no_find_clusters)
+    entries = [
+        {'source': 'a.jpg', 'hash': '01', 'destination': 'out/x.jpg'},
+        {'source': 'b.jpg', 'hash': '02', 'destination': 'out/y.jpg'},
+        {'source': 'c.jpg', 'hash': '03', 'destination': 'out/x.jpg'},
+        {'source': 'd.jpg', 'hash': None, 'destination': 'out/z.jpg'},
+        {'source': 'e.jpg', 'hash': '01', 'destination': 'out/x(1).jpg'},
+    ]
+    warnings = {}
+    clusters = {}
+    for report_format, report_filename in (('json', 'report.json'), ('sqlite', 'report.db')):
+        ms = media_sifter.Media_Sifter(str(tmp_path), "out", str(tmp_path / report_filename),
+                                       hash_threshold=threshold, report_format=report_format)
+        for entry in entries:
+            ms.record_results(dict(entry))
+        caplog.clear()
+        ms.analyse_report()
+        warnings[report_format] = [r.getMessage() for r in caplog.records if r.levelname == 'WARNING']
+        clusters[report_format] = ms.find_hash_clusters()
+    assert warnings['sqlite'] == warnings['json']
+    assert clusters['sqlite'] == clusters['json']
+    collision = "Media_Sifter : analyse_report - destination collision out/x.jpg a.jpg clashes with c.jpg"
+    if threshold:
+        # 01, 02 and 03 are all within a bit of another, so a.jpg and c.jpg are the same picture
+        assert collision not in warnings['json']
+        assert clusters['json'] == {'a.jpg': ['a.jpg', 'b.jpg', 'c.jpg', 'e.jpg']}
+    else:
+        assert collision in warnings['json']
+        assert clusters['json'] == {'a.jpg': ['a.jpg', 'e.jpg']}
+
+def test_walk_folders(fs, cwd):
+    fs.create_file("/my/path/media/b.jpg")
+    fs.create_file("/my/path/media/a.jpg")
+    fs.create_file("/my/path/media/.hidden.jpg")
+    fs.create_file("/my/path/media/.hidden/skipped.jpg")
+    fs.create_file("/my/path/media/folder2/c.jpg")
+    fs.create_file("/my/path/media/folder1/sub/d.jpg")
+    fs.create_dir("/my/path/media/empty")
+    walked = [(folder, [e.path for e in entries]) for folder, entries in media_sifter.walk_folders("/my/path/media")]
+    assert walked == [
+        ("/my/path/media", ["/my/path/media/a.jpg", "/my/path/media/b.jpg"]),
+        ("/my/path/media/empty", []),
+        ("/my/path/media/folder1", []),
+        ("/my/path/media/folder1/sub", ["/my/path/media/folder1/sub/d.jpg"]),
+        ("/my/path/media/folder2", ["/my/path/media/folder2/c.jpg"]),
+    ]
+    # media files come with their stat results, other files don't need one
+    fs.create_file("/my/path/media/folder2/c.jpg.json")
+    fs.create_file("/my/path/media/folder2/skip.jpg")
+    folder, entries = list(media_sifter.walk_folders("/my/path/media/folder2"))[0]
+    source_files = media_sifter.list_source_files(entries, {"/my/path/media/folder2/skip.jpg": {}})
+    assert [(f, stat is not None) for f, stat in source_files] == [
+        ("/my/path/media/folder2/c.jpg", True),
+        ("/my/path/media/folder2/c.jpg.json", False),
+    ]
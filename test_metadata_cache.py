@@ -0,0 +1,107 @@
+import os
+import datetime
+from metadata_cache import Metadata_Cache
+
+def create_test_file(path, contents=b"aaaa"):
+    with open(path, 'wb') as f:
+        f.write(contents)
+    os.utime(path, times=(
+        datetime.datetime(1972, 1, 1, 0, 0, 0, 0).timestamp(),
+        datetime.datetime(1972, 1, 1, 0, 0, 0, 0).timestamp()
+        ))
+    return os.stat(path)
+
+def test_cache_get_put(tmp_path):
+    source = str(tmp_path / "image.jpg")
+    stat = create_test_file(source)
+    entry = {'exif': {'datetime_exif': datetime.datetime(2023, 12, 1, 14, 1, 23)}, 'hash': 'abcd'}
+    with Metadata_Cache(str(tmp_path / "cache.db")) as cache:
+        assert cache.get(source, stat) == None
+        cache.put(source, stat, entry)
+        assert cache.get(source, stat) == entry
+
+    # the cache persists between runs
+    with Metadata_Cache(str(tmp_path / "cache.db")) as cache:
+        assert cache.get(source, stat) == entry
+        # a modified file misses the cache
+        stat = create_test_file(source, b"aaaaa")
+        assert cache.get(source, stat) == None
+
+def test_cache_moved_file(tmp_path):
+    os.makedirs(tmp_path / "old")
+    os.makedirs(tmp_path / "new")
+    source = str(tmp_path / "old" / "image.jpg")
+    stat = create_test_file(source)
+    entry = {'exif': None, 'hash': 'abcd'}
+    with Metadata_Cache(str(tmp_path / "cache.db")) as cache:
+        cache.put(source, stat, entry)
+        # the same file somewhere else still hits the cache
+        os.rename(source, tmp_path / "new" / "image.jpg")
+        moved = str(tmp_path / "new" / "image.jpg")
+        assert cache.get(moved, os.stat(moved)) == entry
+        # and isn't evicted, because we know where it is now
+        assert cache.evict_missing() == 0
+        assert cache.get(moved, os.stat(moved)) == entry
+        # but is once it has gone
+        os.remove(moved)
+        assert cache.evict_missing() == 1
+        stat = create_test_file(moved)
+        assert cache.get(moved, stat) == None
+
+def test_cache_verify(tmp_path):
+    source = str(tmp_path / "image.jpg")
+    stat = create_test_file(source, b"aaaa")
+    entry = {'exif': None, 'hash': 'abcd'}
+    with Metadata_Cache(str(tmp_path / "cache.db"), verify=True) as cache:
+        cache.put(source, stat, entry)
+        assert cache.get(source, stat) == entry
+        # same size, same timestamp, different contents
+        stat = create_test_file(source, b"bbbb")
+        assert cache.get(source, stat) == None
+
+def test_cache_shared_between_processes(tmp_path):
+    # entries waiting to be written don't keep the database locked against other processes
+    # sharing the cache, and are still found before they are written
+    a = str(tmp_path / "a.jpg")
+    b = str(tmp_path / "b.jpg")
+    stat_a = create_test_file(a, b"aaaa")
+    stat_b = create_test_file(b, b"bbbbb")
+    with Metadata_Cache(str(tmp_path / "cache.db")) as first, Metadata_Cache(str(tmp_path / "cache.db")) as second:
+        second.lock_timeout = 0.1
+        first.put(a, stat_a, {'exif': None, 'hash': 'a'})
+        assert first.get(a, stat_a) == {'exif': None, 'hash': 'a'}
+        second.put(b, stat_b, {'exif': None, 'hash': 'b'})
+        second.commit()
+        assert first.get(b, stat_b) == {'exif': None, 'hash': 'b'}
+        assert second.get(a, stat_a) == None
+        first.commit()
+        assert second.get(a, stat_a) == {'exif': None, 'hash': 'a'}
+
+def test_cache_settings(tmp_path, monkeypatch):
+    # entries from another hash mode, or an older version of the cache, are never served
+    source = str(tmp_path / "image.jpg")
+    stat = create_test_file(source)
+    with Metadata_Cache(str(tmp_path / "cache.db")) as cache:
+        cache.put(source, stat, {'exif': None, 'hash': 'full'})
+    with Metadata_Cache(str(tmp_path / "cache.db"), hash_mode='fast') as cache:
+        assert cache.get(source, stat) == None
+        cache.put(source, stat, {'exif': None, 'hash': 'fast'})
+    with Metadata_Cache(str(tmp_path / "cache.db")) as cache:
+        assert cache.get(source, stat) == {'exif': None, 'hash': 'full'}
+    monkeypatch.setattr(Metadata_Cache, "cache_version", Metadata_Cache.cache_version + 1)
+    with Metadata_Cache(str(tmp_path / "cache.db")) as cache:
+        assert cache.get(source, stat) == None
+        # and are cleared out, as they never will be again
+        assert cache.evict_missing() == 2
+
+def test_cache_relative_paths(tmp_path, monkeypatch):
+    # files found by a scan from one folder aren't evicted by a run from another
+    os.makedirs(tmp_path / "elsewhere")
+    monkeypatch.chdir(tmp_path)
+    stat = create_test_file("image.jpg")
+    with Metadata_Cache(str(tmp_path / "cache.db")) as cache:
+        cache.put("image.jpg", stat, {'exif': None, 'hash': 'abcd'})
+    monkeypatch.chdir(tmp_path / "elsewhere")
+    with Metadata_Cache(str(tmp_path / "cache.db")) as cache:
+        assert cache.evict_missing() == 0
+        assert cache.get(str(tmp_path / "image.jpg"), stat) == {'exif': None, 'hash': 'abcd'}
@@ -0,0 +1,96 @@
+import io
+import struct
+import datetime
+import quicktime
+from quicktime import read_quicktime_metadata, find_top_level_atom, parse_iso6709
+
+def atom(atom_type, *bodies):
+    body = b''.join(bodies)
+    return struct.pack('>I4s', len(body) + 8, atom_type) + body
+
+def quicktime_seconds(dt):
+    return int((dt - datetime.datetime(1904, 1, 1)).total_seconds())
+
+def mvhd(created, duration=6000, timescale=600, version=0):
+    if version == 1:
+        return atom(b'mvhd', struct.pack('>B3xQQIQ', 1, created, created, timescale, duration), bytes(80))
+    return atom(b'mvhd', struct.pack('>B3xIIII', 0, created, created, timescale, duration), bytes(80))
+
+def udta_location(location):
+    return atom(b'udta', atom(b'\xa9xyz', struct.pack('>HH', len(location), 0x15c7), location.encode()))
+
+def meta_location(location):
+    # the way iPhones store it, as a named key and a numbered item
+    keys = atom(b'keys', struct.pack('>II', 0, 2),
+                atom(b'mdta', b'com.apple.quicktime.make'),
+                atom(b'mdta', b'com.apple.quicktime.location.ISO6709'))
+    ilst = atom(b'ilst',
+                atom(struct.pack('>I', 1), atom(b'data', struct.pack('>II', 1, 0), b'Apple')),
+                atom(struct.pack('>I', 2), atom(b'data', struct.pack('>II', 1, 0), location.encode())))
+    return atom(b'meta', atom(b'hdlr', bytes(8), b'mdta', bytes(12)), keys, ilst)
+
+def write_movie(filename, *moov_atoms, media_size=1024):
+    # camera style, with the media data first and the movie header at the end
+    with open(filename, 'wb') as f:
+        f.write(atom(b'ftyp', b'qt  ', bytes(4)))
+        f.write(atom(b'mdat', bytes(media_size)))
+        f.write(atom(b'moov', atom(b'trak', bytes(5000)), *moov_atoms))
+
+def test_read_quicktime_metadata(tmp_path):
+    created = datetime.datetime(2023, 12, 1, 14, 1, 23)
+    filename = str(tmp_path / "camera.mov")
+    write_movie(filename, mvhd(quicktime_seconds(created)), udta_location("+51.5072-000.1275+011.000/"))
+    assert read_quicktime_metadata(filename) == {
+        'creation_time': created,
+        'duration': 10.0,
+        'geodata': {'latitude': 51.5072, 'longitude': -0.1275},
+    }
+
+    filename = str(tmp_path / "iphone.mov")
+    write_movie(filename, mvhd(quicktime_seconds(created), version=1), meta_location("-33.8688+151.2093+005.000/"))
+    assert read_quicktime_metadata(filename) == {
+        'creation_time': created,
+        'duration': 10.0,
+        'geodata': {'latitude': -33.8688, 'longitude': 151.2093},
+    }
+
+    # no creation time and nowhere in particular
+    filename = str(tmp_path / "blank.mp4")
+    write_movie(filename, mvhd(0))
+    assert read_quicktime_metadata(filename) == {'creation_time': None, 'duration': 10.0, 'geodata': None}
+
+def test_read_quicktime_metadata_not_a_movie(tmp_path):
+    filename = str(tmp_path / "odd.mp4")
+    with open(filename, 'wb') as f:
+        f.write(b'RIFF\x00\x00\x00\x00AVI LIST')
+    assert read_quicktime_metadata(filename) is None
+    # a movie header with no mvhd in it isn't any use either
+    write_movie(filename, udta_location("+51.5072-000.1275/"))
+    assert read_quicktime_metadata(filename) is None
+
+def test_read_quicktime_metadata_bounded_reads(tmp_path, monkeypatch):
+    # only a few KB are read, even with the movie header after a lot of media data
+    filename = str(tmp_path / "big.mov")
+    write_movie(filename, mvhd(1), udta_location("+51.5072-000.1275/"), media_size=32 * 1024 * 1024)
+    read = []
+    class Counting_File(io.FileIO):
+        def read(self, size=-1):
+            data = super().read(size)
+            read.append(len(data))
+            return data
+    monkeypatch.setattr(quicktime, "open", lambda filename, mode: Counting_File(filename, 'r'), raising=False)
+    assert read_quicktime_metadata(filename)['geodata'] == {'latitude': 51.5072, 'longitude': -0.1275}
+    assert sum(read) < 4096
+
+def test_parse_iso6709():
+    assert parse_iso6709("+40.7128-074.0060/") == {'latitude': 40.7128, 'longitude': -74.006}
+    assert parse_iso6709("nowhere") is None
+
+def test_find_top_level_atom_64bit(tmp_path):
+    filename = str(tmp_path / "large.mov")
+    with open(filename, 'wb') as f:
+        f.write(atom(b'ftyp', b'qt  '))
+        f.write(struct.pack('>I4sQ', 1, b'mdat', 16 + 100) + bytes(100))
+        f.write(atom(b'moov', b'body'))
+    with open(filename, 'rb') as f:
+        assert find_top_level_atom(f, 12 + 116 + 12, b'moov') == (12 + 116 + 8, 4)
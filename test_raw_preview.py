@@ -0,0 +1,76 @@
+import io
+import struct
+import pytest
+from PIL import Image
+from raw_preview import extract_preview, is_decodable_jpeg
+
+def jpeg(size):
+    data = io.BytesIO()
+    Image.new('RGB', size, (200, 100, 50)).save(data, format='JPEG')
+    return data.getvalue()
+
+# lossless JPEG, as raw data is sometimes compressed with, which PIL can't decode
+lossless_jpeg = b'\xff\xd8\xff\xc3\x00\x0b\x10' + bytes(5000)
+
+def ifd(entries, next_ifd, byte_order):
+    data = struct.pack(byte_order + 'H', len(entries))
+    for tag, field_type, values in sorted(entries):
+        fmt = {3: 'H', 4: 'I'}[field_type]
+        value = struct.pack(byte_order + fmt * len(values), *values).ljust(4, b'\x00')
+        data += struct.pack(byte_order + 'HHI', tag, field_type, len(values)) + value
+    return data + struct.pack(byte_order + 'I', next_ifd)
+
+def write_raw(filename, byte_order, thumbnail, preview, raw):
+    # A NEF/DNG style file: IFD0 holds a thumbnail and points to a sub IFD with the full size
+    # preview, and the next IFD holds the raw data as a lossless JPEG strip
+    ifd0_offset, sub_ifd_offset, raw_ifd_offset = 8, 8 + 42, 8 + 42 + 30
+    thumbnail_offset = raw_ifd_offset + 54
+    preview_offset = thumbnail_offset + len(thumbnail)
+    raw_offset = preview_offset + len(preview)
+    with open(filename, 'wb') as f:
+        f.write((b'II' if byte_order == '<' else b'MM') + struct.pack(byte_order + 'HI', 42, ifd0_offset))
+        f.write(ifd([(0x0201, 4, [thumbnail_offset]), (0x0202, 4, [len(thumbnail)]), (0x014A, 4, [sub_ifd_offset])],
+                    raw_ifd_offset, byte_order))
+        f.write(ifd([(0x0201, 4, [preview_offset]), (0x0202, 4, [len(preview)])], 0, byte_order))
+        f.write(ifd([(0x00FE, 4, [0]), (0x0103, 3, [7]), (0x0111, 4, [raw_offset]), (0x0117, 4, [len(raw)])],
+                    0, byte_order))
+        f.write(thumbnail + preview + raw)
+
+@pytest.mark.parametrize("byte_order", ['<', '>'])
+def test_extract_tiff_preview(tmp_path, byte_order):
+    # the biggest preview is the one we want, but never the raw data
+    filename = str(tmp_path / "shoot.nef")
+    thumbnail, preview = jpeg((16, 12)), jpeg((160, 120))
+    write_raw(filename, byte_order, thumbnail, preview, lossless_jpeg)
+    assert extract_preview(filename) == preview
+    # without the full size preview, the thumbnail will do
+    write_raw(filename, byte_order, thumbnail, b'', lossless_jpeg)
+    assert extract_preview(filename) == thumbnail
+
+def test_extract_psd_preview(tmp_path):
+    filename = str(tmp_path / "layers.psd")
+    thumbnail = jpeg((32, 24))
+    resource = struct.pack('>IIIIIIHH', 1, 32, 24, 96, 96 * 24, len(thumbnail), 24, 1) + thumbnail
+    resources = (b'8BIM' + struct.pack('>HBB', 1005, 0, 0) + struct.pack('>I', 2) + b'xx' +
+                 b'8BIM' + struct.pack('>HBB', 1036, 0, 0) + struct.pack('>I', len(resource)) + resource)
+    if len(resource) % 2:
+        resources += b'\x00'
+    with open(filename, 'wb') as f:
+        f.write(b'8BPS' + struct.pack('>H6xHIIHH', 1, 3, 24, 32, 8, 3))
+        f.write(struct.pack('>I', 0))
+        f.write(struct.pack('>I', len(resources)) + resources)
+    assert extract_preview(filename) == thumbnail
+
+def test_extract_preview_nothing_to_find(tmp_path):
+    filename = str(tmp_path / "odd.pef")
+    with open(filename, 'wb') as f:
+        f.write(b'not a tiff at all')
+    assert extract_preview(filename) is None
+    with open(filename, 'wb') as f:
+        f.write(b'II*\x00\x08\x00\x00\x00\x05')
+    assert extract_preview(filename) is None
+
+def test_is_decodable_jpeg():
+    assert is_decodable_jpeg(jpeg((8, 8)))
+    assert not is_decodable_jpeg(lossless_jpeg)
+    assert not is_decodable_jpeg(b'\x00\x00')
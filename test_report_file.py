@@ -0,0 +1,38 @@
+import json
+import report_file
+
+def write_report(tmp_path, text):
+    filename = str(tmp_path / "report.json")
+    with open(filename, 'w') as f:
+        f.write(text)
+    return filename
+
+def test_read_report_entries(tmp_path):
+    filename = write_report(tmp_path, '{"source": "a.jpg"}\n{"source": "b.jpg"}\n')
+    assert list(report_file.read_report_entries(filename)) == [{'source': 'a.jpg'}, {'source': 'b.jpg'}]
+    assert not report_file.is_legacy_report(filename)
+    assert report_file.complete_length(filename) == len('{"source": "a.jpg"}\n{"source": "b.jpg"}\n')
+
+def test_read_report_entries_truncated(tmp_path):
+    # a crash part way through writing an entry leaves a line with no newline on the end
+    filename = write_report(tmp_path, '{"source": "a.jpg"}\nnot json\n{"source": "b.jpg"}\n{"source": "c.j')
+    assert list(report_file.read_report_entries(filename)) == [{'source': 'a.jpg'}, {'source': 'b.jpg'}]
+    assert report_file.complete_length(filename) == len('{"source": "a.jpg"}\nnot json\n{"source": "b.jpg"}\n')
+
+def test_complete_length_searches_back(tmp_path, monkeypatch):
+    monkeypatch.setattr(report_file, "tail_block_size", 4)
+    filename = write_report(tmp_path, '{"source": "a.jpg"}\n{"source": "a very long half written line')
+    assert report_file.complete_length(filename) == len('{"source": "a.jpg"}\n')
+    filename = write_report(tmp_path, 'no newline at all')
+    assert report_file.complete_length(filename) == 0
+
+def test_convert_legacy_report(tmp_path):
+    legacy = write_report(tmp_path, '[\n{"source": "a.jpg", "hash": "1"}, \n{"source": "b.jpg", "hash": "2"},\n{}]\n')
+    assert report_file.is_legacy_report(legacy)
+    # the brackets and the closing {} entry aren't entries
+    assert list(report_file.read_report_entries(legacy)) == [{'source': 'a.jpg', 'hash': '1'}, {'source': 'b.jpg', 'hash': '2'}]
+    converted = str(tmp_path / "converted.json")
+    assert report_file.convert_legacy_report(legacy, converted) == 2
+    with open(converted) as f:
+        assert [json.loads(line) for line in f] == [{'source': 'a.jpg', 'hash': '1'}, {'source': 'b.jpg', 'hash': '2'}]
+    assert not report_file.is_legacy_report(converted)
@@ -0,0 +1,47 @@
+import datetime
+import numpy
+from report_store import Report_Store
+from hash_index import pack_hashes
+
+def entry(source, hash, destination):
+    return {'source': source, 'hash': hash, 'destination': destination,
+            'preferred_ts': datetime.datetime(2023, 12, 1, 14, 1, 23)}
+
+def test_report_store(tmp_path):
+    with Report_Store(str(tmp_path / "report.db")) as report:
+        report['b.jpg'] = entry('b.jpg', 'aa', 'out/b.jpg')
+        report['a.jpg'] = entry('a.jpg', 'bb', 'out/a.jpg')
+        assert len(report) == 2
+        assert 'a.jpg' in report and 'c.jpg' not in report
+        assert report.get('c.jpg') is None
+        # entries come back as they would from a json report
+        assert report['a.jpg']['preferred_ts'] == '2023-12-01 14:01:23'
+        # updating an entry keeps its place
+        report['b.jpg'] = entry('b.jpg', 'cc', 'out/b.jpg')
+        assert list(report) == ['b.jpg', 'a.jpg']
+        assert report['b.jpg']['hash'] == 'cc'
+
+    # and the report persists between runs
+    with Report_Store(str(tmp_path / "report.db")) as report:
+        assert list(report.hashes()) == [('b.jpg', 'cc'), ('a.jpg', 'bb')]
+
+def test_report_store_queries(tmp_path, monkeypatch):
+    # read back a few entries at a time, to check batches join up
+    monkeypatch.setattr(Report_Store, "commit_every", 2)
+    with Report_Store(str(tmp_path / "report.db")) as report:
+        report['1.jpg'] = entry('1.jpg', '01', 'out/x.jpg')
+        report['2.jpg'] = entry('2.jpg', '02', 'out/y.jpg')
+        report['3.jpg'] = entry('3.jpg', '02', 'out/x.jpg')
+        report['4.jpg'] = entry('4.jpg', None, 'out/z.jpg')
+        report['5.jpg'] = entry('5.jpg', '01', 'out/x.jpg')
+        report['6.jpg'] = entry('6.jpg', '02', 'out/y.jpg')
+        assert list(report) == ['1.jpg', '2.jpg', '3.jpg', '4.jpg', '5.jpg', '6.jpg']
+        assert report.find_hash('02') == ['2.jpg', '3.jpg', '6.jpg']
+        assert list(report.destination_collisions()) == [
+            ('out/x.jpg', [('1.jpg', '01'), ('3.jpg', '02'), ('5.jpg', '01')]),
+            ('out/y.jpg', [('2.jpg', '02'), ('6.jpg', '02')]),
+        ]
+        assert list(report.hash_groups()) == [['1.jpg', '5.jpg'], ['2.jpg', '3.jpg', '6.jpg']]
+        ids, packed = report.packed_hashes()
+        assert [report.source_of(i) for i in ids] == ['1.jpg', '2.jpg', '3.jpg', '5.jpg', '6.jpg']
+        assert numpy.array_equal(packed, pack_hashes(['01', '02', '02', '01', '02']))
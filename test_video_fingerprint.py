@@ -0,0 +1,64 @@
+import io
+import struct
+import shutil
+import video_fingerprint
+from video_fingerprint import video_fingerprint as fingerprint, describe_movie
+
+def atom(atom_type, *bodies):
+    body = b''.join(bodies)
+    return struct.pack('>I4s', len(body) + 8, atom_type) + body
+
+def movie(sample_sizes, duration=3000, width=1920, height=1080):
+    # a minimal QuickTime movie header, with one video track
+    mvhd = atom(b'mvhd', struct.pack('>B3xIIII', 0, 0, 0, 600, duration), bytes(80))
+    tkhd = atom(b'tkhd', struct.pack('>B3xIIIII', 0, 0, 0, 1, 0, duration), bytes(52),
+                struct.pack('>II', width << 16, height << 16))
+    mdhd = atom(b'mdhd', struct.pack('>B3xIIII', 0, 0, 0, 30000, duration * 50), bytes(4))
+    hdlr = atom(b'hdlr', bytes(8), b'vide', bytes(13))
+    stsd = atom(b'stsd', struct.pack('>II', 0, 1), struct.pack('>I4s', 16, b'avc1'), bytes(8))
+    stsz = atom(b'stsz', struct.pack('>III', 0, 0, len(sample_sizes)), struct.pack('>%dI' % len(sample_sizes), *sample_sizes))
+    return atom(b'moov', mvhd, atom(b'trak', tkhd, atom(b'mdia', mdhd, hdlr, atom(b'minf', atom(b'stbl', stsd, stsz)))))
+
+def write_video(filename, moov, media_size=2 * 1024 * 1024, fill=b'\x5a'):
+    # camera style, with the media data first and the movie header at the end
+    with open(filename, 'wb') as f:
+        f.write(atom(b'ftyp', b'qt  ', bytes(4)))
+        f.write(atom(b'mdat', fill * media_size))
+        f.write(moov)
+
+def test_describe_movie():
+    facts = describe_movie(movie([100, 200, 300])[8:])
+    assert facts[:3] == ["mvhd:3000/600", "tkhd:1:3000:1920x1080", "mdhd:150000/30000"]
+    assert facts[3:5] == ["hdlr:vide", "stsd:avc1"]
+    assert facts[5].startswith("stsz:0:3:")
+
+def test_video_fingerprint(tmp_path):
+    original = str(tmp_path / "original.mov")
+    write_video(original, movie([100, 200, 300]))
+    copy = str(tmp_path / "copy.mov")
+    shutil.copy(original, copy)
+    assert fingerprint(copy) == fingerprint(original)
+    assert len(fingerprint(original)) == 64
+    # a re-encode that comes out the same size and length has different sized frames
+    reencode = str(tmp_path / "reencode.mov")
+    write_video(reencode, movie([100, 250, 250]))
+    assert fingerprint(reencode) != fingerprint(original)
+    # and a video with no movie header we can read falls back to the bytes alone
+    broken = str(tmp_path / "broken.avi")
+    with open(broken, 'wb') as f:
+        f.write(b'RIFF not a quicktime movie')
+    assert len(fingerprint(broken)) == 64
+
+def test_video_fingerprint_bounded_reads(tmp_path, monkeypatch):
+    # only the samples and the headers are read, however much media data there is
+    filename = str(tmp_path / "big.mp4")
+    write_video(filename, movie(list(range(1000))), media_size=64 * 1024 * 1024)
+    read = []
+    class Counting_File(io.FileIO):
+        def read(self, size=-1):
+            data = super().read(size)
+            read.append(len(data))
+            return data
+    monkeypatch.setattr(video_fingerprint, "open", lambda filename, mode: Counting_File(filename, 'r'), raising=False)
+    fingerprint(filename)
+    assert sum(read) < 1024 * 1024
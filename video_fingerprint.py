@@ -0,0 +1,86 @@
+import os
+import struct
+import hashlib
+import logging
+from quicktime import read_atoms, find_top_level_atom
+
+# Bytes are sampled from this many places spread evenly through the file, this much at each
+sample_count = 8
+sample_size = 65536
+# The movie header is read whole, but only up to this size - past that we rely on the samples
+max_moov_size = 16 * 1024 * 1024
+# Atoms that only hold other atoms, on the way down to the ones we want
+container_atoms = {b'moov', b'trak', b'mdia', b'minf', b'stbl'}
+
+def describe_atom(atom_type, body):
+    # The facts we keep from the atoms that describe the movie and its tracks. The sample size
+    # table is hashed rather than kept, and is what tells a re-encode apart from the original.
+    if atom_type in (b'mvhd', b'mdhd'):
+        if body[:1] == b'\x01':
+            timescale, duration = struct.unpack('>IQ', body[20:32])
+        else:
+            timescale, duration = struct.unpack('>II', body[12:20])
+        return "{}:{}/{}".format(atom_type.decode(), duration, timescale)
+    if atom_type == b'tkhd':
+        if body[:1] == b'\x01':
+            track_id, duration = struct.unpack('>I4xQ', body[20:36])
+        else:
+            track_id, duration = struct.unpack('>I4xI', body[12:24])
+        width, height = struct.unpack('>II', body[-8:])
+        return "tkhd:{}:{}:{}x{}".format(track_id, duration, width >> 16, height >> 16)
+    if atom_type == b'hdlr':
+        return "hdlr:{}".format(body[8:12].decode('latin-1'))
+    if atom_type == b'stsd' and len(body) >= 16:
+        return "stsd:{}".format(body[12:16].decode('latin-1'))
+    if atom_type == b'stsz':
+        sample_size, count = struct.unpack('>II', body[4:12])
+        return "stsz:{}:{}:{}".format(sample_size, count, hashlib.sha256(body[12:]).hexdigest())
+    return None
+
+def describe_movie(moov):
+    # walk down through the movie header atoms, describing the ones we know about
+    facts = []
+    for atom_type, body in read_atoms(moov):
+        if atom_type in container_atoms:
+            facts.extend(describe_movie(body))
+        else:
+            try:
+                fact = describe_atom(atom_type, body)
+            except (struct.error, UnicodeDecodeError):
+                fact = None
+            if fact:
+                facts.append(fact)
+    return facts
+
+def sample_offsets(file_size):
+    # where to take the byte samples from, always including the very start and end of the file
+    last = file_size - sample_size
+    return [last * i // (sample_count - 1) for i in range(sample_count)]
+
+def video_fingerprint(filename):
+    # A fingerprint for a video that doesn't need any frames decoding. It is made from the file
+    # size, samples of the raw bytes at fixed places through the file, and the duration, tracks,
+    # codecs and sample size table from the movie header. Copies of the same video have the
+    # same fingerprint, and a re-encode of it won't, as its bytes and sample sizes all change.
+    # At most a few hundred KB, plus the movie header, is read whatever the size of the video.
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        h.update("size:{}".format(file_size).encode())
+        moov = find_top_level_atom(f, file_size, b'moov')
+        if moov and moov[1] <= max_moov_size:
+            f.seek(moov[0])
+            facts = describe_movie(f.read(moov[1]))
+            logging.debug("video_fingerprint - %s %s", filename, facts)
+            h.update("\n".join(facts).encode())
+        elif moov:
+            logging.warning("video_fingerprint - movie header too big to read in %s", filename)
+        if file_size <= sample_count * sample_size:
+            # small enough to simply read it all
+            f.seek(0)
+            h.update(f.read())
+        else:
+            for offset in sample_offsets(file_size):
+                f.seek(offset)
+                h.update(f.read(sample_size))
+    return h.hexdigest()